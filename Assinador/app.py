@@ -1,21 +1,32 @@
 
 # Assinador de Documentos (Flask + PyMuPDF + PIL) - com segurança integrada (auth.py)
 # ------------------------------------------------------------------------------------
-import os, textwrap, hashlib
-from datetime import datetime, timedelta
+import os, glob, hashlib, threading, time, uuid, json, zipfile, mimetypes
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+import click
+from sqlalchemy import func, or_, cast, String, tuple_, select, literal
+from sqlalchemy.exc import IntegrityError
 from flask import (
     Flask, render_template, request, redirect, url_for, send_file,
-    abort, flash, session
+    abort, flash, session, jsonify, g
 )
 from urllib.parse import unquote
 from werkzeug.utils import secure_filename
-import qrcode
-from qrcode.constants import ERROR_CORRECT_Q, ERROR_CORRECT_H
-from PIL import Image, ImageDraw, ImageFont
-import fitz  # PyMuPDF
+from werkzeug.datastructures import ContentRange
 import re
+import stamping
+import preview
+import storage
+import governor
+import importacao
+import metricas
+from stamping import sha256_of_file
 # ORM
-from models import db, User
+from models import (db, User, SignedDocument, SigningJob, SigningRequestKey, DocumentMetadata,
+                    StoredBlob)
 from auth import normalize_cpf as auth_normalize_cpf, is_valid_cpf_digits, _hash as hash_pwd
 
 # Importa segurança
@@ -45,9 +56,150 @@ app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 # app.config["SESSION_COOKIE_SECURE"] = True  # em produção com HTTPS
 app.permanent_session_lifetime = timedelta(minutes=30)
 
+# ------------------ Limite de tentativas de login ------------------
+# "memoria" (por worker, com teto de chaves), "banco" (tabela login_attempts, compartilhada)
+# ou "redis" (LOGIN_RATE_REDIS_URL). Falhas sem bloqueio expiram após LOGIN_RATE_WINDOW (s).
+app.config["MAX_LOGIN_ATTEMPTS"] = int(os.environ.get("MAX_LOGIN_ATTEMPTS", "5"))
+app.config["LOCKOUT_SECONDS"] = int(os.environ.get("LOCKOUT_SECONDS", "150"))
+app.config["LOGIN_RATE_BACKEND"] = os.environ.get("LOGIN_RATE_BACKEND", "memoria").lower()
+app.config["LOGIN_RATE_WINDOW"] = int(os.environ.get("LOGIN_RATE_WINDOW", "900"))
+app.config["LOGIN_RATE_MAX_KEYS"] = int(os.environ.get("LOGIN_RATE_MAX_KEYS", "10000"))
+app.config["LOGIN_RATE_REDIS_URL"] = os.environ.get("LOGIN_RATE_REDIS_URL")   # ex.: redis://redis:6379/0
+
+# ------------------ Hash de credenciais (KDF) ------------------
+# hashes novos em "argon2" (argon2id) ou "pbkdf2" (werkzeug); os antigos são regravados
+# no login. KDF_WORKERS threads por worker do gunicorn (argon2: ~KDF_ARGON2_MEMORY_KIB
+# cada); com KDF_MAX_QUEUE pedidos pendentes, o login seguinte é recusado na hora (503).
+app.config["KDF_SCHEME"] = os.environ.get("KDF_SCHEME", "argon2").lower()
+app.config["KDF_WORKERS"] = int(os.environ.get("KDF_WORKERS", "2"))
+app.config["KDF_MAX_QUEUE"] = int(os.environ.get("KDF_MAX_QUEUE", "32"))
+app.config["KDF_TIMEOUT"] = float(os.environ.get("KDF_TIMEOUT", "10"))
+app.config["KDF_ARGON2_TIME_COST"] = int(os.environ.get("KDF_ARGON2_TIME_COST", "3"))
+app.config["KDF_ARGON2_MEMORY_KIB"] = int(os.environ.get("KDF_ARGON2_MEMORY_KIB", "65536"))
+app.config["KDF_ARGON2_PARALLELISM"] = int(os.environ.get("KDF_ARGON2_PARALLELISM", "4"))
+app.config["KDF_PBKDF2_ITERATIONS"] = int(os.environ.get("KDF_PBKDF2_ITERATIONS", "600000"))
+
+# ------------------ Importação de usuários em lote ------------------
+# processos que calculam os hashes de CPF (padrão: núcleos da máquina) e linhas por transação
+app.config["IMPORT_WORKERS"] = int(os.environ.get("IMPORT_WORKERS", "0")) or None
+app.config["IMPORT_BATCH_SIZE"] = int(os.environ.get("IMPORT_BATCH_SIZE", "500"))
+
+# ------------------ Registro de documentos assinados ------------------
+# intervalo mínimo (s) entre sincronizações automáticas da pasta com o registro
+app.config["REGISTRY_SYNC_INTERVAL"] = int(os.environ.get("REGISTRY_SYNC_INTERVAL", "300"))
+
+# ------------------ Gravação do PDF assinado ------------------
+# "incremental": anexa o carimbo ao original (bytes originais preservados como prefixo);
+# "completo": regrava o PDF inteiro. O incremental cai para o completo quando o PDF exige.
+app.config["PDF_SAVE_MODE"] = os.environ.get("PDF_SAVE_MODE", stamping.PDF_SAVE_INCREMENTAL)
+
+# ------------------ Otimização do PDF gerado ------------------
+# "" (desligada), "estrutura" (sem perdas) ou "imagens" (também reamostra imagens acima
+# de PDF_OPTIMIZE_DPI_MAX para PDF_OPTIMIZE_DPI_TARGET, em JPEG). O resultado só é usado
+# se ficar menor que o carimbado (e aí o PDF é regravado: deixa de ser incremental);
+# o ganho e o tempo de cada arquivo vão para o log.
+app.config["PDF_OPTIMIZE"] = os.environ.get("PDF_OPTIMIZE", "").lower()
+app.config["PDF_OPTIMIZE_DPI_MAX"] = float(os.environ.get("PDF_OPTIMIZE_DPI_MAX", "200"))
+app.config["PDF_OPTIMIZE_DPI_TARGET"] = float(os.environ.get("PDF_OPTIMIZE_DPI_TARGET", "150"))
+app.config["PDF_OPTIMIZE_JPEG_QUALITY"] = int(os.environ.get("PDF_OPTIMIZE_JPEG_QUALITY", "80"))
+
+# ------------------ Carimbo em imagens ------------------
+# "imagem": regrava o JPG/PNG (só a região do carimbo muda; JPEG com as tabelas originais)
+# "pdf": gera um PDF com a imagem original embutida e o carimbo vetorial por cima
+app.config["IMAGE_STAMP_OUTPUT"] = os.environ.get("IMAGE_STAMP_OUTPUT", "imagem")
+
+# ------------------ Fila de assinatura ------------------
+# processos do pool do worker (flask worker-assinatura) e tempo máximo de um pedido
+app.config["SIGN_WORKERS"] = int(os.environ.get("SIGN_WORKERS", "2"))
+app.config["SIGN_JOB_TIMEOUT"] = int(os.environ.get("SIGN_JOB_TIMEOUT", "600"))
+
+# ------------------ Pedidos repetidos ------------------
+# o mesmo pedido (original, signatário, posição e textos) repetido dentro de N minutos
+# recebe o arquivo já assinado, com a data/hora do primeiro carimbo. 0 desliga.
+app.config["SIGN_IDEMPOTENCY_MINUTES"] = float(os.environ.get("SIGN_IDEMPOTENCY_MINUTES", "10"))
+
+# ------------------ Assinatura em lote ------------------
+app.config["BATCH_WORKERS"] = int(os.environ.get("BATCH_WORKERS", "2"))
+app.config["BATCH_MAX_FILES"] = int(os.environ.get("BATCH_MAX_FILES", "100"))
+app.config["BATCH_MAX_BYTES"] = int(os.environ.get("BATCH_MAX_BYTES", str(500 * 1024 * 1024)))
+# horas que o .zip de um lote fica disponível para download (depois sai no próximo lote
+# ou no `flask limpar-armazem`)
+app.config["BATCH_ZIP_HOURS"] = float(os.environ.get("BATCH_ZIP_HOURS", "24"))
+
+# ------------------ Pré-visualização de páginas ------------------
+# teto do cache de páginas renderizadas em disco (os usados há mais tempo saem primeiro)
+app.config["PREVIEW_CACHE_MAX_BYTES"] = int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# ------------------ Controle de carga (por worker) ------------------
+# orçamento de memória (MB estimados) das operações pesadas simultâneas em cada worker:
+# análise, carimbo e render de páginas. Quem não couber espera até GOVERNOR_TIMEOUT (s)
+# e depois recebe 503 com Retry-After. Orçamento do nó ≈ capacidade × workers do gunicorn.
+app.config["GOVERNOR_CAPACITY_MB"] = int(os.environ.get("GOVERNOR_CAPACITY_MB", "512"))
+app.config["GOVERNOR_TIMEOUT"] = float(os.environ.get("GOVERNOR_TIMEOUT", "20"))
+app.config["GOVERNOR_RETRY_AFTER"] = int(os.environ.get("GOVERNOR_RETRY_AFTER", "5"))
+app.config["GOVERNOR_MAX_QUEUE"] = int(os.environ.get("GOVERNOR_MAX_QUEUE", "32"))
+
+# ------------------ Métricas (Prometheus) ------------------
+# GET /metrics no formato do Prometheus: tempo por rota e por etapa da assinatura, bytes,
+# páginas, tamanho dos documentos, verificações e KDF. Com vários workers (ou o worker da
+# fila), aponte METRICS_DIR para uma pasta local limpa a cada início (ex.: tmpfs): cada
+# processo grava ali o seu retrato a cada METRICS_FLUSH_SECONDS e o /metrics soma todos.
+# METRICS_TOKEN (opcional) exige "Authorization: Bearer <token>" no scrape.
+# Requisições acima de SLOW_REQUEST_MS (0 = desligado) vão para o log com o tempo por etapa.
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", "")
+app.config["METRICS_FLUSH_SECONDS"] = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+# pasta compartilhada entre nós: medidores de outro host sem gravação há mais que isto (s)
+# saem do /metrics (os do próprio host saem quando o processo termina). 0 = nunca.
+app.config["METRICS_STALE_SECONDS"] = float(os.environ.get("METRICS_STALE_SECONDS", "60"))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+app.config["SLOW_REQUEST_MS"] = float(os.environ.get("SLOW_REQUEST_MS", "0"))
+
+# ------------------ Armazenamento dos arquivos ------------------
+# uploads e assinados endereçados por SHA-256 (chave ab/cd/<hash>)
+# "local": em <STORAGE_DIR> (volume app_data); "s3": bucket S3/MinIO, com STORAGE_DIR
+# servindo de cache local por nó (vários nós atrás do balanceador sem NFS)
+app.config["STORAGE_BACKEND"] = os.environ.get("STORAGE_BACKEND", "local")
+app.config["STORAGE_DIR"] = os.environ.get("STORAGE_DIR", os.path.join(app.root_path, "storage"))
+app.config["S3_BUCKET"] = os.environ.get("S3_BUCKET", "assinador")
+app.config["S3_PREFIX"] = os.environ.get("S3_PREFIX", "")
+app.config["S3_ENDPOINT_URL"] = os.environ.get("S3_ENDPOINT_URL")      # ex.: http://minio:9000
+app.config["S3_ACCESS_KEY"] = os.environ.get("S3_ACCESS_KEY")
+app.config["S3_SECRET_KEY"] = os.environ.get("S3_SECRET_KEY")
+app.config["S3_REGION"] = os.environ.get("S3_REGION")
+# downloads por URL pré-assinada (redirect): os bytes não passam pelo worker Python
+app.config["S3_PRESIGNED_DOWNLOADS"] = os.environ.get("S3_PRESIGNED_DOWNLOADS", "1") == "1"
+# entrega dos assinados pelo servidor web, sem o worker Python copiar bytes:
+# "" (Flask envia), "x-accel" (nginx: location interna SENDFILE_ACCEL_PREFIX -> STORAGE_DIR)
+# ou "x-sendfile" (Apache mod_xsendfile / lighttpd). No nginx:
+#   location /_armazem/ { internal; alias /app/storage/; }
+app.config["SENDFILE_MODE"] = os.environ.get("SENDFILE_MODE", "").lower()
+app.config["SENDFILE_ACCEL_PREFIX"] = os.environ.get("SENDFILE_ACCEL_PREFIX", "/_armazem/")
+app.config["USE_X_SENDFILE"] = app.config["SENDFILE_MODE"] == "x-sendfile"
+# arquivos sem referência (uploads não assinados, versões substituídas) saem após N horas
+app.config["STORAGE_GC_HOURS"] = float(os.environ.get("STORAGE_GC_HOURS", "24"))
+# só com "s3": cópias locais sem uso há N horas saem do cache do nó (`flask limpar-armazem`),
+# e, com STORAGE_CACHE_MAX_BYTES (0 = sem teto), as usadas há mais tempo até caber nele
+app.config["STORAGE_CACHE_HOURS"] = float(os.environ.get("STORAGE_CACHE_HOURS", "24"))
+app.config["STORAGE_CACHE_MAX_BYTES"] = int(os.environ.get("STORAGE_CACHE_MAX_BYTES", "0"))
+armazem = storage.criar_armazem(app.config)
+governador = governor.Governador(app.config["GOVERNOR_CAPACITY_MB"], app.config["GOVERNOR_TIMEOUT"],
+                                 retry_after=app.config["GOVERNOR_RETRY_AFTER"],
+                                 max_fila=app.config["GOVERNOR_MAX_QUEUE"])
+
 # Blueprint de autenticação
 app.register_blueprint(auth_bp)
 
+# Estado por processo (caches, pool do lote, marcas das tarefas periódicas) é compartilhado
+# pelas threads do worker gthread: leituras/escritas dele passam por esta trava. O fitz tem
+# a sua (stamping.FITZ_LOCK).
+_estado_lock = threading.Lock()
+
+# Brasão e fontes do carimbo carregados uma vez por processo (início do worker)
+try:
+    stamping.precarregar()
+except Exception:
+    app.logger.exception("Falha ao pré-carregar recursos do carimbo")
+
 
 # ---------- Filtros/Utils ----------
 def fmt_dt(value):
@@ -65,13 +217,89 @@ def fmt_dt(value):
 app.jinja_env.filters["fmt_dt"] = fmt_dt
 
 
-def sha256_of_file(path: str) -> str:
+INGEST_CHUNK = 256 * 1024
+
+def sha256_of_stream(stream) -> str:
+    """SHA-256 de um upload lido em blocos (sem carregar o arquivo inteiro em memória)."""
     h = hashlib.sha256()
-    with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
+    lidos = 0
+    with metricas.etapa("hash"):
+        for chunk in iter(lambda: stream.read(INGEST_CHUNK), b''):
             h.update(chunk)
+            lidos += len(chunk)
+    HASH_BYTES.inc(lidos, origem="verificacao")
     return h.hexdigest()
 
+def _registrar_blob(sha256_hex: str, tamanho: int):
+    """Garante a linha em stored_blobs; conteúdo repetido só renova updated_at (protege da limpeza)."""
+    atualizados = (StoredBlob.query.filter_by(sha256=sha256_hex)
+                   .update({StoredBlob.updated_at: func.now()}, synchronize_session=False))
+    if not atualizados:
+        db.session.add(StoredBlob(sha256=sha256_hex, size_bytes=tamanho, refcount=0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # outro worker registrou o mesmo conteúdo
+
+def _ajustar_referencias(sha256_hex: str, delta: int):
+    """refcount += delta com um UPDATE atômico (sem ler antes); o commit fica com quem chamou."""
+    if sha256_hex:
+        (StoredBlob.query.filter_by(sha256=sha256_hex)
+         .update({StoredBlob.refcount: StoredBlob.refcount + delta,
+                  StoredBlob.updated_at: func.now()}, synchronize_session=False))
+
+def guardar_upload(arquivo):
+    """
+    Grava o upload (FileStorage ou stream binário) no armazém, calculando o SHA-256
+    no mesmo passe. Conteúdo já existente não ocupa disco de novo.
+    Devolve (sha256_hex, tamanho_em_bytes, caminho).
+    """
+    with metricas.etapa("upload"):
+        sha, tamanho, _ = armazem.guardar(getattr(arquivo, "stream", arquivo))
+    UPLOAD_BYTES.inc(tamanho)
+    HASH_BYTES.inc(tamanho, origem="upload")
+    _registrar_blob(sha, tamanho)
+    return sha, tamanho, armazem.caminho_local(sha)
+
+
+def registrar_documento_assinado(crc: str, caminho_assinado: str, nome_final: str,
+                                 original_sha256: str, sha256_hex: str, processo: str = "",
+                                 signatario: dict = None):
+    """
+    Move a saída do carimbo (`caminho_assinado`) para o armazém e grava o documento
+    no registro (tabela signed_documents), ajustando as referências do original e
+    do assinado. Reassinar o mesmo original gera o mesmo CRC, então o registro
+    existente é atualizado em vez de duplicado (e a versão anterior perde a referência).
+    `signatario` é o dict do usuário da sessão (o worker da fila o passa explicitamente).
+    """
+    usr = signatario if signatario is not None else (session.get("user") or {})
+    sha256_hex, tamanho, _ = armazem.incorporar(caminho_assinado, sha256_hex)
+    _registrar_blob(sha256_hex, tamanho)
+
+    doc = SignedDocument.query.filter_by(crc=crc).first()
+    sha_anterior, original_anterior = (doc.sha256, doc.original_sha256) if doc else (None, None)
+    if sha_anterior != sha256_hex:
+        _ajustar_referencias(sha_anterior, -1)
+        _ajustar_referencias(sha256_hex, +1)
+    if original_anterior != original_sha256:
+        _ajustar_referencias(original_anterior, -1)
+        _ajustar_referencias(original_sha256, +1)
+    if doc is None:
+        doc = SignedDocument(crc=crc)
+        db.session.add(doc)
+    doc.sha256          = sha256_hex
+    doc.original_sha256 = original_sha256
+    doc.filename        = nome_final
+    doc.stored_path     = storage.chave(sha256_hex)   # chave no armazém (legados: caminho em static/)
+    doc.size_bytes      = tamanho
+    doc.file_mtime      = None
+    doc.signer_email    = usr.get("email")
+    doc.signer_nome     = usr.get("nome")
+    doc.processo        = processo or None
+    doc.signed_at       = datetime.now(timezone.utc)
+    db.session.commit()
+    return doc
+
 
 def build_verification_url(crc: str) -> str:
     """
@@ -84,23 +312,6 @@ def build_verification_url(crc: str) -> str:
         return f"{base.rstrip('/')}{url_for('verificar')}"
     return url_for('verificar', _external=True)
 
-def make_qr_image(data: str, box_size: int = 12, border: int = 8, strong: bool = True):
-    """
-    Gera QR nítido com quiet zone maior.
-    - box_size: pixels por módulo (maior = mais nítido ao reduzir fisicamente)
-    - border:   quiet zone em módulos (>=4 recomendado; usamos 8 para garantir)
-    """
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=ERROR_CORRECT_H if strong else ERROR_CORRECT_Q,
-        box_size=box_size,
-        border=border,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    # Preto puro em fundo branco, sem alpha e sem downscale
-    return qr.make_image(fill_color="black", back_color="white").convert("RGB")
-
 def to_upper(s: str) -> str:
     return (s or "").strip().upper()
 
@@ -252,8 +463,145 @@ def cadastro():
     # GET
     email_q = (request.args.get("email") or "").strip().lower()
     usuario_editar = User.query.filter_by(email=email_q).first() if email_q else None
-    usuarios = User.query.order_by(User.created_at.desc()).all()
-    return render_template("cadastro.html", usuarios=usuarios, usuario_editar=usuario_editar)
+    return _pagina_cadastro(usuario_editar=usuario_editar)
+
+
+# ---------- Listagem/busca de usuários (admin) ----------
+# Página por cursor (keyset): ordem (created_at, id) decrescente e o cursor leva o
+# (created_at, id) do último usuário exibido — o custo de cada página não cresce com o
+# tamanho da tabela e o cursor vale mesmo que esse usuário seja excluído entre as páginas.
+# A busca (ILIKE '%termo%') usa os índices trigram de db_init/assinador_dump.sql.
+USUARIOS_POR_PAGINA = 50
+
+def _filtro_busca(termo: str):
+    like = "%" + re.sub(r"([\\%_])", r"\\\1", termo) + "%"
+    return or_(
+        User.nome.ilike(like, escape="\\"),
+        cast(User.email, String).ilike(like, escape="\\"),
+        User.matricula.ilike(like, escape="\\"),
+        User.orgao.ilike(like, escape="\\"),
+        User.setor.ilike(like, escape="\\"),
+    )
+
+def _cursor_usuarios(usuario) -> str:
+    return f"{usuario.created_at.isoformat()}_{usuario.id}"
+
+def _ler_cursor_usuarios(cursor: str):
+    """(created_at, id) do cursor; None se vier vazio ou adulterado (volta ao início)."""
+    quando, _, uid = (cursor or "").rpartition("_")
+    try:
+        return datetime.fromisoformat(quando), int(uid)
+    except ValueError:
+        return None
+
+def buscar_usuarios(termo: str = "", apos: str = None, limite: int = USUARIOS_POR_PAGINA, colunas=None):
+    """(usuários, cursor da próxima página ou None). `colunas` restringe o SELECT (type-ahead)
+    e precisa incluir User.id e User.created_at."""
+    consulta = User.query if colunas is None else db.session.query(*colunas)
+    if termo:
+        consulta = consulta.filter(_filtro_busca(termo))
+    cursor = _ler_cursor_usuarios(apos)
+    if cursor:
+        quando, uid = cursor
+        # (created_at, id) < cursor. Se o usuário do cursor ainda existe, vale o created_at
+        # como está gravado (no SQLite o texto gravado não bate com o datetime do cursor);
+        # se foi excluído, vale o do próprio cursor — a página seguinte não some.
+        gravado = select(User.created_at).where(User.id == uid).scalar_subquery()
+        ref = func.coalesce(gravado, literal(quando, User.created_at.type))
+        consulta = consulta.filter(tuple_(User.created_at, User.id) < tuple_(ref, uid))
+    itens = consulta.order_by(User.created_at.desc(), User.id.desc()).limit(limite + 1).all()
+    proximo = _cursor_usuarios(itens[limite - 1]) if len(itens) > limite else None
+    return itens[:limite], proximo
+
+def _pagina_cadastro(**extra):
+    termo = (request.args.get("q") or "").strip()
+    apos = request.args.get("apos") or None
+    usuarios, proximo = buscar_usuarios(termo, apos)
+    return render_template("cadastro.html", usuarios=usuarios, busca=termo, apos=apos,
+                           proximo=proximo, **extra)
+
+# mesmos índices de db_init/assinador_dump.sql, para bancos criados antes deles
+INDICES_BUSCA_PG = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_created_at_id ON users USING btree (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_users_nome_trgm ON users USING gin (nome gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_trgm ON users USING gin ((email::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_matricula_trgm ON users USING gin (matricula gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_orgao_trgm ON users USING gin (orgao gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_setor_trgm ON users USING gin (setor gin_trgm_ops)",
+)
+
+@app.cli.command("indices-busca")
+def indices_busca_cmd():
+    """Cria (se faltarem) os índices da listagem/busca de usuários no Postgres."""
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("Os índices trigram são do Postgres.")
+    with db.engine.begin() as con:
+        for sql in INDICES_BUSCA_PG:
+            con.exec_driver_sql(sql)
+    click.echo(f"{len(INDICES_BUSCA_PG)} comando(s) aplicados.")
+
+@app.get("/usuarios/buscar")
+@admin_required
+def usuarios_buscar():
+    """Sugestões para o campo de busca (type-ahead): poucos usuários, só os campos exibidos."""
+    termo = (request.args.get("q") or "").strip()
+    if len(termo) < 2:
+        return jsonify([])
+    limite = max(1, min(20, request.args.get("limite", 10, type=int)))
+    itens, _ = buscar_usuarios(termo, limite=limite,
+                               colunas=(User.id, User.created_at, User.nome, User.email,
+                                        User.matricula, User.orgao))
+    return jsonify([{"nome": u.nome, "email": u.email, "matricula": u.matricula, "orgao": u.orgao}
+                    for u in itens])
+
+def importar_usuarios(dados: bytes, nome_arquivo: str, atualizar_cpf: bool = False) -> dict:
+    """Importa a planilha (ver importacao.py) com os parâmetros de KDF/lote da aplicação."""
+    linhas = importacao.ler_planilha(dados, nome_arquivo)
+    kdf_config = {k: v for k, v in app.config.items() if k.startswith("KDF_")}
+    return importacao.importar(db.engine, User.__table__, linhas, kdf_config,
+                               atualizar_cpf=atualizar_cpf, workers=app.config["IMPORT_WORKERS"],
+                               lote=app.config["IMPORT_BATCH_SIZE"])
+
+@app.post("/cadastro/importar")
+@admin_required
+def cadastro_importar():
+    """Planilha CSV/XLSX (nome, email, cpf, orgao, setor, matricula, cargo) → cadastro em lote."""
+    if not validate_csrf_from_form():
+        return _pagina_cadastro(importacao_erro="CSRF inválido. Recarregue a página.")
+    planilha = request.files.get("planilha")
+    if not planilha or not planilha.filename:
+        return _pagina_cadastro(importacao_erro="Nenhuma planilha enviada.")
+    try:
+        relatorio = importar_usuarios(planilha.read(), planilha.filename,
+                                      atualizar_cpf=request.form.get("atualizar_cpf") == "1")
+    except (ValueError, RuntimeError) as e:
+        return _pagina_cadastro(importacao_erro=str(e))
+    if request.args.get("formato") == "csv":
+        # só o relatório de erros, para abrir na própria planilha
+        return app.response_class(importacao.relatorio_csv(relatorio["erros"]), mimetype="text/csv",
+                                  headers={"Content-Disposition": 'attachment; filename="erros_importacao.csv"'})
+    return _pagina_cadastro(importacao=relatorio)
+
+@app.cli.command("importar-usuarios")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--atualizar-cpf", is_flag=True, help="Também troca o CPF de quem já está cadastrado.")
+@click.option("--relatorio", type=click.Path(dir_okay=False), help="Grava os erros por linha neste CSV.")
+def importar_usuarios_cmd(arquivo, atualizar_cpf, relatorio):
+    """Importa/atualiza usuários de uma planilha CSV ou XLSX."""
+    with open(arquivo, "rb") as f:
+        try:
+            rel = importar_usuarios(f.read(), arquivo, atualizar_cpf=atualizar_cpf)
+        except (ValueError, RuntimeError) as e:
+            raise click.ClickException(str(e))
+    click.echo(f"{rel['linhas']} linha(s): {rel['criados']} criado(s), {rel['atualizados']} atualizado(s), "
+               f"{len(rel['erros'])} erro(s) em {rel['segundos']} s.")
+    if relatorio:
+        with open(relatorio, "w", encoding="utf-8-sig", newline="") as f:
+            f.write(importacao.relatorio_csv(rel["erros"]))
+    else:
+        for e in rel["erros"]:
+            click.echo(f"  linha {e['linha']} ({e['email'] or '-'}): {e['erro']}")
 
 
 @app.get("/editar/<path:email>")
@@ -282,13 +630,170 @@ def excluir():
 
 
 
+# ---------- Pré-análise dos uploads ----------
+# Os mesmos modelos (ofícios, encaminhamentos...) são assinados centenas de vezes por dia:
+# a análise é feita uma vez por conteúdo e fica na tabela document_metadata.
+META_CACHE_SIZE = 512
+_meta_cache = OrderedDict()
+
+def metadados_documento(sha256_hex: str, caminho: str, extensao: str) -> dict:
+    """
+    Metadados do upload (ver preview.analisar_documento) pelo SHA-256 do conteúdo:
+    memória do processo → tabela document_metadata → análise do arquivo (gravada).
+    """
+    with _estado_lock:
+        meta = _meta_cache.get(sha256_hex)
+        if meta is not None:
+            _meta_cache.move_to_end(sha256_hex)
+            return meta
+
+    reg = db.session.get(DocumentMetadata, sha256_hex)
+    if reg is None:
+        # abrir o PDF é a primeira operação pesada: só o tamanho do arquivo é conhecido
+        with governador.reservar(governor.custo_assinatura({"size_bytes": os.path.getsize(caminho)}),
+                                 "analise"):
+            with metricas.etapa("analise"):
+                analise = preview.analisar_documento(caminho, extensao)
+        reg = DocumentMetadata(sha256=sha256_hex, **analise)
+        db.session.add(reg)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # outro worker analisou o mesmo arquivo ao mesmo tempo
+            db.session.rollback()
+            reg = db.session.get(DocumentMetadata, sha256_hex)
+
+    meta = reg.to_dict()
+    with _estado_lock:
+        _meta_cache[sha256_hex] = meta
+        if len(_meta_cache) > META_CACHE_SIZE:
+            _meta_cache.popitem(last=False)
+    return meta
+
+
+# ---------- Controle de carga ----------
+def _resposta_ocupado(e: governor.Ocupado, **ctx_html):
+    """503 + Retry-After: JSON para chamadas do front (fetch), página de assinatura para o formulário."""
+    if ctx_html and request.form.get("assincrono") != "1":
+        resp = app.make_response((render_template("assinar.html", erro=f"⏳ {e}", **ctx_html), 503))
+    else:
+        resp = jsonify({"erro": str(e), "retry_after": e.retry_after})
+        resp.status_code = 503
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+@app.errorhandler(governor.Ocupado)
+def _ocupado(e):
+    return _resposta_ocupado(e)
+
+@app.get("/status/carga")
+def status_carga():
+    """Operações pesadas ativas/na fila, orçamento em uso e fila do KDF deste worker (monitoramento)."""
+    dados = governador.metricas()
+    servico_kdf = app.extensions.get("kdf")
+    if servico_kdf is not None:
+        dados["kdf"] = servico_kdf.metricas()
+    resp = jsonify(dados)
+    resp.cache_control.no_store = True
+    return resp
+
+
+# ---------- Métricas (Prometheus) ----------
+# Cada requisição tem um cronômetro (ver metricas.py): as etapas marcadas no caminho
+# (upload, hash, analise, fila_carga, qr, abrir, layout, inserir, gravar, otimizar,
+# sha256, registro, kdf...) viram o histograma por rota/etapa e o log de lentas.
+_reg = metricas.REGISTRO
+REQUISICAO_SEGUNDOS = _reg.histograma("assinador_requisicao_segundos", "Duração das requisições por rota.")
+ETAPA_SEGUNDOS = _reg.histograma("assinador_etapa_segundos", "Tempo por etapa dentro das requisições (e dos pedidos da fila).")
+LENTAS = _reg.contador("assinador_requisicoes_lentas_total", "Requisições acima de SLOW_REQUEST_MS.")
+UPLOAD_BYTES = _reg.contador("assinador_upload_bytes_total", "Bytes de documentos recebidos e gravados no armazém.")
+HASH_BYTES = _reg.contador("assinador_hash_bytes_total", "Bytes passados pelo SHA-256, por origem.")
+GERADO_BYTES = _reg.contador("assinador_assinado_bytes_total", "Bytes dos arquivos assinados gerados.")
+DOCUMENTOS = _reg.contador("assinador_documentos_assinados_total", "Documentos carimbados, por modo e tipo.")
+PAGINAS = _reg.contador("assinador_paginas_total", "Páginas dos documentos assinados.")
+DOCUMENTO_BYTES = _reg.histograma("assinador_documento_bytes", "Tamanho dos documentos assinados (original).",
+                                  metricas.BUCKETS_BYTES)
+DOCUMENTO_PAGINAS = _reg.histograma("assinador_documento_paginas", "Páginas dos documentos assinados.",
+                                    metricas.BUCKETS_PAGINAS)
+VERIFICACOES = _reg.contador("assinador_verificacoes_total", "Verificações (CRC/upload) por resultado.")
+REGISTRO_VARRIDOS = _reg.contador("assinador_registro_arquivos_varridos_total",
+                                  "Arquivos examinados na sincronização da pasta de assinados.")
+REGISTRO_HASHEADOS = _reg.contador("assinador_registro_arquivos_hasheados_total",
+                                   "Arquivos novos/alterados re-hasheados na sincronização.")
+_reg.medidor("assinador_governador_capacidade_mb", "Orçamento do controle de carga (MB estimados).",
+             lambda: governador.capacidade)
+_reg.medidor("assinador_governador_em_uso_mb", "Orçamento em uso (MB estimados).", lambda: governador.em_uso)
+_reg.medidor("assinador_governador_ativos", "Operações pesadas em andamento.",
+             lambda: [({"tipo": t}, n) for t, n in governador.metricas()["ativos_por_tipo"].items()])
+_reg.medidor("assinador_governador_na_fila", "Operações pesadas aguardando orçamento.",
+             lambda: governador.metricas()["na_fila"])
+_reg.medidor("assinador_kdf_pendentes", "Pedidos ao KDF na fila ou em cálculo.",
+             lambda: app.extensions["kdf"].pendentes if "kdf" in app.extensions else 0)
+
+def _publicar_metricas():
+    """Grava o retrato deste processo em METRICS_DIR (no máximo a cada METRICS_FLUSH_SECONDS)."""
+    pasta = app.config["METRICS_DIR"]
+    if not pasta:
+        return
+    try:
+        metricas.REGISTRO.gravar(pasta, app.config["METRICS_FLUSH_SECONDS"])
+    except OSError:
+        app.logger.exception("Falha ao gravar métricas em %s", pasta)
+
+def _resultado_verificacao(erro, match) -> str:
+    if erro:
+        return "erro"
+    return {True: "confere", False: "diverge"}.get(match, "consulta")
+
+@app.before_request
+def _iniciar_cronometro():
+    g.cronometro = metricas.Cronometro()
+    metricas.ativar(g.cronometro)
+
+@app.after_request
+def _medir_requisicao(resp):
+    cronometro = g.get("cronometro")
+    if cronometro is None:
+        return resp
+    total = cronometro.decorrido()
+    rota = request.endpoint or "desconhecida"
+    REQUISICAO_SEGUNDOS.observar(total, rota=rota, metodo=request.method, status=resp.status_code)
+    for etapa, segundos in cronometro.etapas.items():
+        ETAPA_SEGUNDOS.observar(segundos, rota=rota, etapa=etapa)
+
+    limite_ms = app.config["SLOW_REQUEST_MS"]
+    if limite_ms and total * 1000 >= limite_ms:
+        LENTAS.inc(rota=rota)
+        outros = max(0.0, total - sum(cronometro.etapas.values()))
+        app.logger.warning("Requisição lenta: %s %s → %d em %.0f ms [%s outros=%.0fms]",
+                           request.method, request.path, resp.status_code, total * 1000,
+                           cronometro.resumo(), outros * 1000)
+    _publicar_metricas()
+    return resp
+
+@app.teardown_request
+def _parar_cronometro(_exc):
+    metricas.ativar(None)
+
+@app.get("/metrics")
+def metrics():
+    """Métricas no formato de texto do Prometheus (todos os workers, com METRICS_DIR)."""
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization", "") != f"Bearer {token}":
+        abort(401)
+    texto = metricas.REGISTRO.exportar(app.config["METRICS_DIR"], app.config["METRICS_STALE_SECONDS"])
+    resp = app.response_class(texto, mimetype="text/plain")
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.cache_control.no_store = True
+    return resp
+
+
 # ---------- ASSINAR DOCUMENTO (somente logado) ----------
-@app.route("/assinar", methods=["GET", "POST"])
-@login_required
-def assinar():
-    usr = session.get("user") or {}
+
+def _dados_signatario(usr: dict):
+    """(nome, cpf mascarado, órgão) exibidos no carimbo, a partir do usuário da sessão."""
     nome = usr.get("nome") or "Desconhecido"
-    
+
     # 1. Obtenha o CPF completo.
     cpf_completo = usr.get("cpf")
 
@@ -297,7 +802,7 @@ def assinar():
         cpf_numeros = re.sub(r'[^0-9]', '', cpf_completo)
     else:
         cpf_numeros = ""
-    
+
     # 3. Formate o CPF para mostrar apenas os 5 primeiros dígitos.
     if cpf_numeros and len(cpf_numeros) >= 5:
         cpf_masked = f"{cpf_numeros[:5]}******"
@@ -306,335 +811,713 @@ def assinar():
         cpf_masked = "***********"
 
     orgao = usr.get("orgao") or "Deve aparecer o orgao"
-    
-    if request.method == "GET":
-        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao)
-
-    if not validate_csrf_from_form():
-        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro="❌ CSRF inválido. Recarregue a página.")
+    return nome, cpf_masked, orgao
 
-    if 'arquivo' not in request.files:
-        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro="❌ Nenhum arquivo enviado.")
-    arquivo = request.files['arquivo']
-    if not arquivo or arquivo.filename.strip() == '':
-        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro="❌ Arquivo inválido.")
+def _datahora_carimbo() -> str:
+    try:
+        from zoneinfo import ZoneInfo
+        _agora = datetime.now(ZoneInfo("America/Fortaleza"))
+    except Exception:
+        _agora = datetime.now()
+    return _agora.strftime('%d/%m/%Y %H:%M')
 
-    # Campos extras
-    matricula = (request.form.get('matricula') or '').strip()
-    status = (request.form.get('status', '') or '').strip()
-    cargo = (request.form.get('cargo', '') or '').strip()
-    processo = (request.form['processo'] or '').strip()
-    # Coordenadas e canvas (o front envia relativas ao canvas real)
-    def _float(val, default=0.0):
-        try:
-            return float(val)
-        except Exception:
-            return default
+def _float(val, default=0.0):
+    try:
+        return float(val)
+    except Exception:
+        return default
 
-    x = _float(request.form.get('x'))
-    y = _float(request.form.get('y'))
-    w = _float(request.form.get('w'))
-    h = _float(request.form.get('h'))
-    canvas_w = _float(request.form.get('canvas_w'), 1.0)
-    canvas_h = _float(request.form.get('canvas_h'), 1.0)
+def _imagem_em_pdf(dados) -> bool:
+    """Saída das imagens: campo `saida_imagem` do formulário ou IMAGE_STAMP_OUTPUT."""
+    return (dados.get("saida_imagem") or app.config["IMAGE_STAMP_OUTPUT"]) == "pdf"
 
+def _posicao(dados) -> dict:
+    """Coordenadas e canvas (o front envia relativas ao canvas real) + página."""
     # Página (para PDF) — robusto
     try:
-        page_num = int(request.form.get('page') or 1)
+        page_num = int(dados.get('page') or 1)
     except Exception:
         page_num = 1
-
-    # Upload
-    nome_arquivo = secure_filename(arquivo.filename)
+    return {
+        "x": _float(dados.get('x')),
+        "y": _float(dados.get('y')),
+        "w": _float(dados.get('w')),
+        "h": _float(dados.get('h')),
+        "canvas_w": _float(dados.get('canvas_w'), 1.0),
+        "canvas_h": _float(dados.get('canvas_h'), 1.0),
+        "page": page_num,
+        # páginas extras para replicar o carimbo (ex.: "todas", "ultima", "1-3,5")
+        "paginas": (dados.get('paginas') or '').strip(),
+    }
+
+def _validar_posicao(pos: dict, meta: dict) -> dict:
+    """
+    Confere a posição com a pré-análise do documento (sem abrir o PDF): página dentro
+    do documento, intervalo de páginas válido e retângulo dentro do canvas.
+    Levanta ValueError se o intervalo de páginas não fizer sentido.
+    """
+    pos = dict(pos)
+    total = meta["paginas"]
+    pos["page"] = max(1, min(total, pos["page"]))
+    if pos.get("paginas"):
+        stamping.resolver_paginas(pos["paginas"], total, pos["page"])
+
+    cw, ch = pos["canvas_w"], pos["canvas_h"]
+    if cw > 0 and ch > 0:
+        pos["w"] = max(0.0, min(pos["w"], cw))
+        pos["h"] = max(0.0, min(pos["h"], ch))
+        pos["x"] = max(0.0, min(pos["x"], cw - pos["w"]))
+        pos["y"] = max(0.0, min(pos["y"], ch - pos["h"]))
+    return pos
+
+def _politica_otimizacao():
+    """Parâmetros de stamping.otimizar_pdf conforme PDF_OPTIMIZE, ou None (desligada)."""
+    modo = app.config["PDF_OPTIMIZE"]
+    if modo not in (stamping.PDF_OTIMIZAR_ESTRUTURA, stamping.PDF_OTIMIZAR_IMAGENS):
+        return None
+    return {"modo": modo,
+            "dpi_max": app.config["PDF_OPTIMIZE_DPI_MAX"],
+            "dpi_alvo": app.config["PDF_OPTIMIZE_DPI_TARGET"],
+            "qualidade": app.config["PDF_OPTIMIZE_JPEG_QUALITY"]}
+
+def _relatar_carimbo(nome_final: str, resultado: dict, params: dict, modo: str):
+    """Métricas de um carimbo concluído (etapas, bytes, páginas) e log da otimização."""
+    etapas = resultado.get("etapas") or {}
+    for etapa, segundos in etapas.items():
+        # na requisição, entram no cronômetro dela; na fila não há requisição
+        metricas.registrar_etapa(etapa, segundos)
+        if modo == "fila":
+            ETAPA_SEGUNDOS.observar(segundos, rota="worker-assinatura", etapa=etapa)
+    tipo = "pdf" if params["extensao"] in stamping.PDF_EXTS else "imagem"
+    DOCUMENTOS.inc(modo=modo, tipo=tipo)
+    if params.get("size_bytes") is not None:
+        DOCUMENTO_BYTES.observar(params["size_bytes"], tipo=tipo)
+    if params.get("total_paginas"):
+        DOCUMENTO_PAGINAS.observar(params["total_paginas"], tipo=tipo)
+        PAGINAS.inc(params["total_paginas"], tipo=tipo)
+    GERADO_BYTES.inc(resultado["size"], tipo=tipo)
+    HASH_BYTES.inc(resultado["size"], origem="assinado")
+
+    rel = resultado.get("otimizacao")
+    if rel:
+        app.logger.info("Otimização (%s) de %s: %d → %d bytes (%.1f%%), %d imagem(ns), %.0f ms",
+                        rel["modo"], nome_final, rel["bytes_antes"], rel["bytes_depois"],
+                        100.0 * (rel["bytes_antes"] - rel["bytes_depois"]) / max(rel["bytes_antes"], 1),
+                        rel["imagens_reduzidas"], rel["ms"])
+
+def _preparar_carimbo(nome_arquivo: str, caminho_upload: str, original_sha256: str,
+                      ctx: dict, pos: dict):
+    """
+    Monta nome final, destino e os parâmetros do carimbo (tipos simples, serializáveis
+    para a fila/pool) para um upload já gravado. `ctx` traz os dados do signatário.
+    """
     extensao = os.path.splitext(nome_arquivo)[1].lower()
+    meta = metadados_documento(original_sha256, caminho_upload, extensao)
+    pos = _validar_posicao(pos, meta)
     nome_base = os.path.splitext(nome_arquivo)[0]
-
-    os.makedirs('static/arquivos/uploads', exist_ok=True)
-    caminho_upload = os.path.join('static/arquivos/uploads', nome_arquivo)
-    arquivo.save(caminho_upload)
-
-    # CRC curto baseado no arquivo original (para URL/consulta)
-    hash_crc = hashlib.sha256()
-    with open(caminho_upload, 'rb') as f:
-        hash_crc.update(f.read())
-    crc = hash_crc.hexdigest()[:10]
-
-    nome_final = f"assinado_{nome_base}_{crc}{extensao}"
-    os.makedirs('static/arquivos/assinados', exist_ok=True)
-    caminho_assinado = os.path.join("static/arquivos/assinados", nome_final)
-
-    # QR + brasão (QR pequeno 50x50 e brasão 35x50)
-    qr_url = build_verification_url(crc)
-    qr_img = make_qr_image(qr_url, box_size=6, border=4, strong=True)  # 50x50 final
-    qr_path = f"static/temp_qr_{crc}.png"
-    qr_img.save(qr_path, format="PNG")
-    brasao_path = "static/brasao/brasao.png"
-
+    crc = original_sha256[:10]
+
+    # imagem pode sair como PDF (original embutido sem recompressão + carimbo vetorial)
+    imagem_em_pdf = extensao in stamping.IMAGEM_EXTS and ctx.get("imagem_em_pdf", False)
+    nome_final = f"assinado_{nome_base}_{crc}{'.pdf' if imagem_em_pdf else extensao}"
+    # o carimbo grava na pasta temporária do armazém; registrar_documento_assinado incorpora
+    caminho_assinado = armazem.temporario(f"_{nome_final}")
+
+    params = {
+        "origem": caminho_upload,
+        "origem_sha256": original_sha256,   # o worker da fila pode estar em outro nó
+        "destino": caminho_assinado,
+        "extensao": extensao,
+        "crc": crc,
+        "qr_url": ctx["qr_url"],
+        "linhas": stamping.montar_linhas(ctx["nome"], ctx["cpf_masked"], ctx["matricula"],
+                                         ctx["orgao"], ctx["processo"], ctx["datahora"], crc),
+        "status": ctx["status"],
+        "orgao": ctx["orgao"],
+        "imagem_em_pdf": imagem_em_pdf,
+        # PDF criptografado não aceita gravação incremental: nem tenta
+        "pdf_save_mode": (stamping.PDF_SAVE_COMPLETO if meta["encrypted"]
+                          else app.config["PDF_SAVE_MODE"]),
+        "custo_mb": governor.custo_assinatura(meta),   # controle de carga (requisição síncrona)
+        "pdf_otimizar": _politica_otimizacao(),
+        "size_bytes": meta["size_bytes"],   # métricas (tamanho/páginas do original)
+        "total_paginas": meta["paginas"],
+        **pos,
+    }
+    return nome_final, params
+
+
+# ---------- Pedidos repetidos (idempotência) ----------
+def chave_idempotencia(original_sha256: str, nome_arquivo: str, ctx: dict, pos: dict,
+                       email: str) -> str:
+    """Hash de tudo o que muda o arquivo assinado, menos a data/hora (coberta pela janela)."""
+    dados = {
+        "original": original_sha256,
+        "arquivo": nome_arquivo,
+        "email": email,
+        **{k: ctx[k] for k in ("nome", "cpf_masked", "orgao", "matricula", "status",
+                               "processo", "imagem_em_pdf", "qr_url")},
+        **{k: (round(v, 2) if isinstance(v, float) else v) for k, v in pos.items()},
+    }
+    return hashlib.sha256(json.dumps(dados, sort_keys=True).encode("utf-8")).hexdigest()
+
+def assinatura_repetida(chave: str):
+    """
+    Pedido igual ainda dentro da janela, cujo resultado continua valendo: o assinado
+    ainda é a versão registrada para o CRC, ou o pedido da fila não falhou. Senão, None.
+    """
+    minutos = app.config["SIGN_IDEMPOTENCY_MINUTES"]
+    if minutos <= 0:
+        return None
+    limite = datetime.now(timezone.utc) - timedelta(minutes=minutos)
+    reg = (SigningRequestKey.query
+           .filter(SigningRequestKey.key == chave, SigningRequestKey.created_at >= limite)
+           .first())
+    if reg is None:
+        return None
+    if reg.sha256:
+        atual = SignedDocument.query.filter_by(crc=reg.crc, sha256=reg.sha256).first()
+        return reg if atual is not None else None
+    job = db.session.get(SigningJob, reg.job_id) if reg.job_id else None
+    return reg if job is not None and job.status != "erro" else None
+
+def lembrar_assinatura(chave: str, crc: str, nome_final: str, sha256_hex: str = None,
+                       job_id: str = None):
+    """Registra um pedido novo (síncrono: `sha256_hex`; fila: `job_id`); a janela começa agora."""
+    if app.config["SIGN_IDEMPOTENCY_MINUTES"] <= 0:
+        return
+    reg = db.session.get(SigningRequestKey, chave) or SigningRequestKey(key=chave)
+    reg.crc, reg.filename = crc, nome_final
+    reg.sha256, reg.job_id = sha256_hex, job_id
+    reg.created_at = datetime.now(timezone.utc)
+    db.session.add(reg)
     try:
-        from zoneinfo import ZoneInfo
-        _agora = datetime.now(ZoneInfo("America/Fortaleza"))
-    except Exception:
-        _agora = datetime.now()
+        db.session.commit()
+    except IntegrityError:
+        # o mesmo pedido foi registrado em paralelo (ex.: clique duplo): qualquer um serve
+        db.session.rollback()
+
+def _resposta_repetida(reg: SigningRequestKey, usr: dict, assincrono: bool, **ctx_html):
+    """Devolve o resultado do pedido anterior no formato do pedido atual."""
+    if assincrono:
+        job = db.session.get(SigningJob, reg.job_id) if reg.job_id else None
+        if job is None:
+            # o anterior foi síncrono: pedido já concluído, para o front acompanhar igual
+            job = SigningJob(id=uuid.uuid4().hex, status="concluido", progresso=100, params={},
+                             user_email=usr.get("email"), signatario=usr, filename=reg.filename,
+                             sha256=reg.sha256, finished_at=datetime.now(timezone.utc))
+            db.session.add(job)
+            db.session.commit()
+        return jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": url_for("assinar_status", job_id=job.id),
+        }), 202
+    return render_template(
+        "assinar.html", **ctx_html,
+        show_result=True, is_pdf=reg.filename.lower().endswith(stamping.PDF_EXTS),
+        signed_url=url_assinado(reg.filename, reg.sha256), arquivo=reg.filename,
+        sha256_hex=reg.sha256
+    )
 
-    _datahora = _agora.strftime('%d/%m/%Y %H:%M')
 
-    # --- CONFIGS de quebra e fontes ---
-    STATUS_WRAP_CHARS = 32  # limite de caracteres por linha do STATUS
+@app.route("/assinar", methods=["GET", "POST"])
+@login_required
+def assinar():
+    usr = session.get("user") or {}
+    nome, cpf_masked, orgao = _dados_signatario(usr)
 
-    linhas = [
-        "Assinado eletrônicamente por",
-        f"{nome}",
-        f"{cpf_masked}",
-        (f"Matrícula: {matricula}" if matricula else ""),
-        f"{orgao}",
-        # (STATUS será renderizado JÁ JÁ, aqui logo após o órgão)
-    ]
+    if request.method == "GET":
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao)
 
-    if processo:
-        linhas.append(f"Processo n°: {processo}")
+    if not validate_csrf_from_form():
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro="❌ CSRF inválido. Recarregue a página.")
 
-    
-    linhas.extend([
-        f"em: {_datahora}",
-        f"CRC: {crc}",
-    ])
+    # PDF já enviado ao /preview: vem só o upload_id (o navegador não manda o arquivo de
+    # novo); o campo do arquivo fica para imagens e para quando a prévia não terminou
+    previa = _upload_da_previa(request.form.get('upload_id'))
+    arquivo = request.files.get('arquivo')
+    if previa is None and arquivo is None:
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro="❌ Nenhum arquivo enviado.")
+    nome_original = request.form.get('upload_nome') if previa else arquivo.filename
+    if not (nome_original or '').strip():
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro="❌ Arquivo inválido.")
 
-    linhas = [l for l in linhas if l and l.strip()]
+    # Upload
+    nome_arquivo = secure_filename(nome_original)
+    extensao = os.path.splitext(nome_arquivo)[1].lower()
+    formatos = stamping.PDF_EXTS if previa else stamping.PDF_EXTS + stamping.IMAGEM_EXTS
+    if extensao not in formatos:
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao,
+                               erro="❌ Formato não suportado. Envie PDF/JPG/PNG.")
+
+    # CRC curto baseado no arquivo original (para URL/consulta), calculado durante a gravação
+    if previa:
+        original_sha256, caminho_upload = previa
+    else:
+        original_sha256, _, caminho_upload = guardar_upload(arquivo)
+    crc = original_sha256[:10]
 
+    # Campos extras
+    processo = (request.form['processo'] or '').strip()
+    ctx = {
+        "nome": nome, "cpf_masked": cpf_masked, "orgao": orgao,
+        "matricula": (request.form.get('matricula') or '').strip(),
+        "status": (request.form.get('status', '') or '').strip(),
+        "imagem_em_pdf": _imagem_em_pdf(request.form),
+        "processo": processo,
+        "datahora": _datahora_carimbo(),
+        "qr_url": build_verification_url(crc),
+    }
+    assincrono = request.form.get("assincrono") == "1"
+    pos = _posicao(request.form)
+
+    # Pedido repetido (ex.: reenvio após falha de rede): devolve o resultado anterior sem carimbar
+    chave = chave_idempotencia(original_sha256, nome_arquivo, ctx, pos, usr.get("email"))
+    repetido = assinatura_repetida(chave)
+    # (ainda na fila só vale para quem vai acompanhar o pedido)
+    if repetido is not None and (repetido.sha256 or assincrono):
+        return _resposta_repetida(repetido, usr, assincrono, nome=nome, cpf=cpf_masked, orgao=orgao)
 
     try:
-        if extensao == '.pdf':
-            doc = fitz.open(caminho_upload)
-
-            # Garantir página válida
-            total = doc.page_count
-            if page_num < 1:
-                page_num = 1
-            if page_num > total:
-                page_num = total
-
-            page = doc.load_page(page_num - 1)
-
-            pdf_w = page.rect.width
-            pdf_h = page.rect.height
-
-            # Salvaguarda: se canvas_w/h vierem 0 (por alguma razão), evita divisão por zero
-            if canvas_w <= 0: canvas_w = pdf_w
-            if canvas_h <= 0: canvas_h = pdf_h
-
-            # Escalas: do canvas (frontend) para a página real do PDF
-            escala_x = pdf_w / canvas_w
-            escala_y = pdf_h / canvas_h
-
-            ponto_x = int(x * escala_x)
-            ponto_y = int(y * escala_y)
-            ponto_w = max(1, int(w * escala_x))
-            ponto_h = max(1, int(h * escala_y))
-
-            
-            # ===== Escala pelo tamanho do retângulo (base pensado para A4) =====
-            BASE_W = 190.0  
-            BASE_H = 180.0  
-
-            s_w = ponto_w / BASE_W
-            s_h = ponto_h / BASE_H
-            s = max(0.6, min(4.0, min(s_w, s_h)))  # trava entre 60% e 400%
-
-            # mínimo ~20 mm (≈ 56.7 pt) para boa leitura
-            MIN_QR_PT_PDF = 25
-            qr_w = qr_h = max(MIN_QR_PT_PDF, int(round(35 * s)))
-
-            brasao_w = int(round(25 * s))
-            brasao_h = int(round(35 * s))
-            gap_pt = int(round(6 * s))
-
-            font_size_normal  = max(6, int(round(9 * s)))
-            font_size_status  = max(6, int(round(11 * s)))  # menor que o normal
-            espaco_entre_linhas = max(8, int(round(11 * s)))
-
-            # Centraliza ícones no topo do retângulo
-            total_icons_w = qr_w + gap_pt + brasao_w
-            x_icones = ponto_x + int((ponto_w - total_icons_w) / 2)
-            y_icones = ponto_y + int(round(10 * s))
-
-            #  Moldura debug 
-            #page.draw_rect(fitz.Rect(ponto_x, ponto_y, ponto_x + ponto_w, ponto_y + ponto_h),
-            #              color=(1, 0, 0), width=max(1, int(round(1*s))))
-
-            # Ícones
-            page.insert_image(
-                fitz.Rect(x_icones, y_icones, x_icones + qr_w, y_icones + qr_h),
-                filename=qr_path
-            )
-            page.insert_image(
-                fitz.Rect(x_icones + qr_w + gap_pt, y_icones,
-                        x_icones + qr_w + gap_pt + brasao_w, y_icones + brasao_h),
-                filename=brasao_path
-            )
-
-            # Texto (logo abaixo dos ícones)
-            inicio_y_texto = y_icones + max(qr_h, brasao_h) + int(round(8 * s))
-
-            def desenha_linha(texto, fonte_pt):
-                """Desenha uma linha (com wrap) centralizada no retângulo."""
-                nonlocal inicio_y_texto
-                chars_por_linha = max(20, int((ponto_w - 16) / (fonte_pt * 0.6)))
-                for sub in textwrap.wrap(texto, width=chars_por_linha):
-                    largura_sub = fitz.get_text_length(sub, fontname="helv", fontsize=fonte_pt)
-                    x_sub = ponto_x + (ponto_w - largura_sub) / 2
-                    page.insert_text(
-                        (x_sub, inicio_y_texto),
-                        sub,
-                        fontsize=fonte_pt,
-                        fontname="helv",
-                        color=(0, 0, 0)
-                    )
-                    inicio_y_texto += espaco_entre_linhas
-
-            def desenha_status_depois_do_orgao():
-                """Desenha o STATUS (se existir) com fonte menor e wrap, com respiros."""
-                nonlocal inicio_y_texto
-                if not status:
-                    return
-                for sub in textwrap.wrap(status, width=STATUS_WRAP_CHARS):
-                    largura_sub = fitz.get_text_length(sub, fontname="helv", fontsize=font_size_status)
-                    x_central = ponto_x + (ponto_w - largura_sub) / 2
-                    page.insert_text(
-                        (x_central, inicio_y_texto),
-                        sub,
-                        fontsize=font_size_status,  # menor
-                        fontname="helv",
-                        color=(0, 0, 0)
-                    )
-                    # espaçamento entre linhas do STATUS
-                    inicio_y_texto += font_size_status + int(round(2 * s))
-                # espaço extra após o bloco de STATUS
-                inicio_y_texto += int(round(6 * s))
-
-            # Loop principal: quando chegar na linha do órgão, injeta o STATUS logo depois
-            for linha in linhas:
-                if not linha.strip():
-                    # se sobrar algo vazio (ex.: matrícula vazia que escapou), só dá um respiro leve
-                    inicio_y_texto += int(round(5 * s))
-                    continue
+        nome_final, params = _preparar_carimbo(nome_arquivo, caminho_upload, original_sha256,
+                                               ctx, pos)
+    except governor.Ocupado as e:
+        return _resposta_ocupado(e, nome=nome, cpf=cpf_masked, orgao=orgao)
+    except Exception as e:
+        db.session.rollback()
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro=f"❌ Erro ao assinar: {e}")
+    caminho_assinado = params["destino"]
+
+    # Modo fila: enfileira e responde na hora; o worker (flask worker-assinatura) faz o carimbo
+    if assincrono:
+        job = enfileirar_assinatura(params, original_sha256, nome_final, processo, usr)
+        lembrar_assinatura(chave, crc, nome_final, job_id=job.id)
+        return jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": url_for("assinar_status", job_id=job.id),
+        }), 202
 
-                # desenha a linha atual com fonte "normal"
-                desenha_linha(linha, font_size_normal)
+    try:
+        with governador.reservar(params["custo_mb"], "assinatura"):
+            resultado = stamping.carimbar(params)
+        _relatar_carimbo(nome_final, resultado, params, "sincrono")
+        with metricas.etapa("registro"):
+            registrar_documento_assinado(crc, caminho_assinado, nome_final,
+                                         original_sha256, resultado["sha256"], processo)
+        lembrar_assinatura(chave, crc, nome_final, sha256_hex=resultado["sha256"])
+
+        signed_url = url_assinado(nome_final, resultado["sha256"])
+        return render_template(
+            "assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao,
+            show_result=True, is_pdf=nome_final.lower().endswith(stamping.PDF_EXTS),
+            signed_url=signed_url, arquivo=nome_final,
+            sha256_hex=resultado["sha256"]
+        )
 
-                # se esta linha é o órgão, desenha o STATUS logo em seguida
-                if linha.strip() == f"{orgao}".strip():
-                    desenha_status_depois_do_orgao()
+    except governor.Ocupado as e:
+        return _resposta_ocupado(e, nome=nome, cpf=cpf_masked, orgao=orgao)
+    except Exception as e:
+        db.session.rollback()
+        if os.path.exists(caminho_assinado):
+            os.remove(caminho_assinado)
+        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro=f"❌ Erro ao assinar: {e}")
 
 
-            # Salva
-            doc.save(caminho_assinado)
-            doc.close()
-            if os.path.exists(qr_path):
-                os.remove(qr_path)
+# ---------- Fila de assinatura (modo assíncrono) ----------
+def enfileirar_assinatura(params: dict, original_sha256: str, nome_final: str,
+                          processo: str, signatario: dict) -> SigningJob:
+    job = SigningJob(
+        id=uuid.uuid4().hex,
+        status="pendente",
+        progresso=0,
+        params=params,
+        user_email=signatario.get("email"),
+        signatario=signatario,
+        original_sha256=original_sha256,
+        filename=nome_final,
+        processo=processo or None,
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
 
-            # SHA-256 do arquivo final assinado
-            sha256_hex = sha256_of_file(caminho_assinado)
 
-            signed_url = f"/static/arquivos/assinados/{nome_final}"
-            return render_template(
-                "assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao,
-                show_result=True, is_pdf=True, signed_url=signed_url, arquivo=nome_final,
-                sha256_hex=sha256_hex
-            )
+@app.get("/assinar/status/<job_id>")
+@login_required
+def assinar_status(job_id):
+    usr = session.get("user") or {}
+    job = db.session.get(SigningJob, job_id)
+    if job is None or (job.user_email != usr.get("email") and not usr.get("is_admin")):
+        return jsonify({"erro": "Pedido não encontrado."}), 404
+    dados = job.to_dict()
+    if job.status == "concluido":
+        dados["signed_url"] = url_assinado(job.filename, job.sha256)
+        dados["download_url"] = url_for("download", filename=job.filename)
+    return jsonify(dados)
+
+
+def _reservar_jobs(limite: int):
+    """Marca até `limite` pedidos pendentes como em processamento (SKIP LOCKED entre workers)."""
+    jobs = (SigningJob.query.filter_by(status="pendente")
+            .order_by(SigningJob.created_at)
+            .limit(limite)
+            .with_for_update(skip_locked=True)
+            .all())
+    agora = datetime.now(timezone.utc)
+    reservados = []
+    for job in jobs:
+        job.status = "processando"
+        job.progresso = 10
+        job.started_at = agora
+        params = dict(job.params)
+        if params.get("origem_sha256"):
+            # caminho local neste nó (no backend S3, baixa para o cache se preciso)
+            params["origem"] = armazem.caminho_local(params["origem_sha256"])
+        reservados.append((job.id, params))
+    db.session.commit()
+    return reservados
+
+
+def _concluir_job(job_id: str, futuro):
+    job = db.session.get(SigningJob, job_id)
+    try:
+        resultado = futuro.result()
+        params = job.params
+        _relatar_carimbo(job.filename, resultado, params, "fila")
+        registrar_documento_assinado(params["crc"], params["destino"], job.filename,
+                                     job.original_sha256, resultado["sha256"],
+                                     job.processo or "", signatario=job.signatario or {})
+        job.status = "concluido"
+        job.sha256 = resultado["sha256"]
+        # pedido repetido do mesmo job passa a receber o arquivo direto
+        SigningRequestKey.query.filter_by(job_id=job_id).update({"sha256": resultado["sha256"]})
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(SigningJob, job_id)
+        job.status = "erro"
+        job.erro = str(e)
+        app.logger.exception("Falha no pedido de assinatura %s", job_id)
+    job.progresso = 100
+    job.finished_at = datetime.now(timezone.utc)
+    db.session.commit()
+
+
+def _recuperar_jobs_travados():
+    """Devolve à fila pedidos 'processando' há mais de SIGN_JOB_TIMEOUT (worker que caiu)."""
+    limite = datetime.now(timezone.utc) - timedelta(seconds=app.config["SIGN_JOB_TIMEOUT"])
+    n = (SigningJob.query
+         .filter(SigningJob.status == "processando", SigningJob.started_at < limite)
+         .update({"status": "pendente", "progresso": 0}, synchronize_session=False))
+    db.session.commit()
+    return n
+
+
+@app.cli.command("worker-assinatura")
+@click.option("--processos", type=int, default=None,
+              help="Processos do pool de carimbo (padrão: SIGN_WORKERS).")
+@click.option("--intervalo", type=float, default=1.0,
+              help="Segundos entre consultas à fila quando ociosa.")
+def worker_assinatura_cmd(processos, intervalo):
+    """Consome a fila de assinatura com um pool limitado de processos."""
+    processos = max(1, processos or app.config["SIGN_WORKERS"])
+    recuperados = _recuperar_jobs_travados()
+    if recuperados:
+        click.echo(f"{recuperados} pedido(s) travado(s) devolvido(s) à fila.")
+    click.echo(f"Worker de assinatura iniciado com {processos} processo(s).")
+
+    em_andamento = {}  # futuro -> job_id
+    with ProcessPoolExecutor(max_workers=processos, initializer=stamping.precarregar) as pool:
+        while True:
+            livres = processos - len(em_andamento)
+            if livres > 0:
+                for job_id, params in _reservar_jobs(livres):
+                    em_andamento[pool.submit(stamping.carimbar, params)] = job_id
+            if not em_andamento:
+                time.sleep(intervalo)
+                continue
+            feitos, _ = wait(em_andamento, timeout=intervalo, return_when=FIRST_COMPLETED)
+            for futuro in feitos:
+                _concluir_job(em_andamento.pop(futuro), futuro)
+            if feitos:
+                _publicar_metricas()
+
+
+# ---------- Pré-visualização de páginas ----------
+_ultima_poda_preview = 0.0
+
+def _previews_dir() -> str:
+    pasta = os.path.join(app.instance_path, "previews")
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+def _preview_origem(upload_id: str) -> str:
+    """O upload_id é o SHA-256 do PDF, guardado no armazém como qualquer upload."""
+    if not armazem.existe(upload_id):
+        abort(404)
+    return armazem.caminho_local(upload_id)
+
+def _upload_da_previa(upload_id: str):
+    """
+    (sha256, caminho) do PDF já enviado ao /preview, ou None se o id não veio, não é um
+    SHA-256 ou o arquivo não está mais no armazém. Renova a data do blob: o upload
+    segue protegido da limpeza enquanto é assinado.
+    """
+    upload_id = (upload_id or "").strip().lower()
+    if not re.fullmatch(r"[0-9a-f]{64}", upload_id) or not armazem.existe(upload_id):
+        return None
+    caminho = armazem.caminho_local(upload_id)
+    _registrar_blob(upload_id, os.path.getsize(caminho))
+    return upload_id, caminho
+
+def _podar_previews_se_preciso():
+    """No máximo uma poda por minuto por processo."""
+    global _ultima_poda_preview
+    agora = time.monotonic()
+    with _estado_lock:
+        if agora - _ultima_poda_preview < 60:
+            return
+        _ultima_poda_preview = agora      # esta thread poda; as demais seguem
+    preview.podar_cache(os.path.join(_previews_dir(), "cache"), app.config["PREVIEW_CACHE_MAX_BYTES"])
+
+@app.post("/preview")
+@login_required
+def preview_upload():
+    """
+    Recebe o PDF escolhido na tela de assinatura e devolve o `upload_id` (SHA-256 do
+    conteúdo), a quantidade de páginas e o tamanho de cada uma (pt, com rotação).
+    """
+    if not validate_csrf_from_form():
+        return jsonify({"erro": "CSRF inválido. Recarregue a página."}), 400
+    arquivo = request.files.get("arquivo")
+    if not arquivo or not arquivo.filename.lower().endswith(stamping.PDF_EXTS):
+        return jsonify({"erro": "Envie um PDF."}), 400
 
-        elif extensao in ['.jpg', '.jpeg', '.png']:
-            imagem = Image.open(caminho_upload).convert('RGB')
-            largura_real, altura_real = imagem.size
+    # mesmo conteúdo já enviado antes: reaproveita o arquivo (e os renders em cache);
+    # ao assinar, o upload do formulário cai no mesmo lugar do armazém
+    sha, _, origem = guardar_upload(arquivo)
 
-            # Salvaguarda: se canvas_w/h vierem 0
-            if canvas_w <= 0: canvas_w = largura_real
-            if canvas_h <= 0: canvas_h = altura_real
+    try:
+        meta = metadados_documento(sha, origem, ".pdf")
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"erro": f"Não foi possível abrir o PDF: {e}"}), 400
+    return jsonify({"upload_id": sha, "paginas": meta["paginas"], "tamanhos": meta["tamanhos"]})
 
-            draw = ImageDraw.Draw(imagem)
-            try:
-                fonte = ImageFont.truetype("static/fonts/DejaVuSans.ttf", size=12)
-                fonte_b = ImageFont.truetype("static/fonts/DejaVuSans-Bold.ttf", size=18)
-            except Exception:
-                fonte = ImageFont.load_default()
-                fonte_b = ImageFont.load_default()
-
-            # Escalas: do canvas (frontend) para a imagem real
-            escala_x = largura_real / canvas_w
-            escala_y = altura_real / canvas_h
-
-            x_real = int(x * escala_x)
-            y_real = int(y * escala_y)
-            w_real = max(1, int(w * escala_x))
-            h_real = max(1, int(h * escala_y))
-
-            # Moldura (debug)
-            draw.rectangle([x_real, y_real, x_real + w_real, y_real + h_real], outline="red", width=2)
-
-            # Ícones pequenos lado a lado
-            qr_rgba = Image.open(qr_path).convert("RGBA")  # 50x50
-            brasao = Image.open(brasao_path).resize((35, 50)).convert("RGBA")
-            gap_px = 6
-            total_icons_w = qr_rgba.width + gap_px + brasao.width
-            x_icones = x_real + int((w_real - total_icons_w) / 2)
-            y_icones = y_real + 10
-
-            imagem.paste(qr_rgba, (x_icones, y_icones), qr_rgba)
-            imagem.paste(brasao, (x_icones + qr_rgba.width + gap_px, y_icones), brasao)
-
-            # Texto
-            y_texto = y_icones + max(qr_rgba.height, brasao.height) + 8
-            for linha in linhas:
-                if not linha.strip():
-                    y_texto += fonte.size + 6
-                    continue
-                if status and linha.strip() == status.strip():
-                    bbox = fonte_b.getbbox(linha)
-                    largura_status = bbox[2] - bbox[0]
-                    x_render = x_real + (w_real - largura_status) // 2
-                    draw.text((x_render, y_texto), linha, font=fonte_b, fill=(0, 0, 0))
-                    y_texto += (bbox[3] - bbox[1]) + 8
-                    continue
-                for sub in textwrap.wrap(linha, width=40):
-                    bbox = fonte.getbbox(sub)
-                    largura_sub = bbox[2] - bbox[0]
-                    x_render = x_real + (w_real - largura_sub) // 2
-                    draw.text((x_render, y_texto), sub, font=fonte, fill=(0, 0, 0))
-                    y_texto += (bbox[3] - bbox[1]) + 2
-
-            imagem.save(caminho_assinado)
-            if os.path.exists(qr_path):
-                os.remove(qr_path)
-
-            # SHA-256 do arquivo final assinado
-            sha256_hex = sha256_of_file(caminho_assinado)
-
-            signed_url = f"/static/arquivos/assinados/{nome_final}"
-            return render_template(
-                "assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao,
-                show_result=True, is_pdf=False, signed_url=signed_url, arquivo=nome_final,
-                sha256_hex=sha256_hex
-            )
+@app.get("/preview/<upload_id>")
+@login_required
+def preview_info(upload_id):
+    meta = metadados_documento(upload_id, _preview_origem(upload_id), ".pdf")
+    return jsonify({"upload_id": upload_id, "paginas": meta["paginas"], "tamanhos": meta["tamanhos"]})
 
+@app.get("/preview/<upload_id>/<int:page>")
+@login_required
+def preview_pagina(upload_id, page):
+    """PNG de uma página na largura pedida (?w=, px), servido do cache quando possível."""
+    origem = _preview_origem(upload_id)
+    meta = metadados_documento(upload_id, origem, ".pdf")
+    if not 1 <= page <= meta["paginas"]:
+        abort(404)
+    largura = preview.largura_valida(request.args.get("w"))
+    cache_dir = os.path.join(_previews_dir(), "cache")
+    rotacao = meta["tamanhos"][page - 1]["rotacao"]
+    # acerto no cache não passa pelo controle de carga (não abre o PDF)
+    png = preview.pagina_em_cache(cache_dir, upload_id, page, largura, rotacao)
+    if png is None:
+        try:
+            with governador.reservar(governor.custo_render(meta, page, largura), "preview"):
+                png = preview.renderizar_pagina(origem, upload_id, page, largura, cache_dir,
+                                                rotacao=rotacao)
+        except IndexError:
+            abort(404)
+    _podar_previews_se_preciso()
+    # conteúdo endereçado pelo hash: o mesmo URL sempre devolve a mesma imagem
+    resp = send_file(png, mimetype="image/png", max_age=86400)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
+
+
+# ---------- Assinatura em lote ----------
+_pool_lote = None
+
+def _get_pool_lote() -> ProcessPoolExecutor:
+    """Pool de processos (criado sob demanda, um por worker web) para o carimbo em lote."""
+    global _pool_lote
+    with _estado_lock:
+        if _pool_lote is None:
+            _pool_lote = ProcessPoolExecutor(max_workers=app.config["BATCH_WORKERS"],
+                                             initializer=stamping.precarregar)
+        return _pool_lote
+
+def _lotes_dir() -> str:
+    pasta = os.path.join(app.instance_path, "lotes")
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+def _podar_lotes(horas: float) -> int:
+    """Remove os .zip de lotes gerados há mais de `horas`; devolve quantos saíram."""
+    limite = time.time() - horas * 3600
+    removidos = 0
+    for caminho in glob.glob(os.path.join(_lotes_dir(), "lote_*.zip")):
+        try:
+            if os.path.getmtime(caminho) < limite:
+                os.remove(caminho)
+                removidos += 1
+        except OSError:
+            continue                          # outro worker removeu antes
+    return removidos
+
+def _submeter_lote(pool, params, recursos) -> Future:
+    """
+    Envia um documento ao pool com o seu custo reservado no governador até o carimbo
+    terminar: o lote entra no mesmo orçamento das assinaturas avulsas, documento a
+    documento, em vez de passar por fora dele.
+    """
+    with ExitStack() as pilha:
+        pilha.enter_context(governador.reservar(params["custo_mb"], "lote"))
+        futuro = pool.submit(stamping.carimbar, params, recursos)
+        reserva = pilha.pop_all()
+    futuro.add_done_callback(lambda _f: reserva.close())
+    return futuro
+
+def _arquivos_do_lote():
+    """
+    Gera (nome_seguro, stream) de cada documento enviado: arquivos soltos em
+    `arquivos` e/ou o conteúdo de .zip (apenas PDF/JPG/PNG, sem subpastas).
+    """
+    aceitos = stamping.PDF_EXTS + stamping.IMAGEM_EXTS
+    limite_bytes = app.config["BATCH_MAX_BYTES"]
+    for up in request.files.getlist("arquivos"):
+        if not up or not up.filename.strip():
+            continue
+        nome = secure_filename(up.filename)
+        if nome.lower().endswith(".zip"):
+            with zipfile.ZipFile(up.stream) as zf:
+                membros = [m for m in zf.infolist() if not m.is_dir()]
+                if sum(m.file_size for m in membros) > limite_bytes:
+                    raise ValueError(f"{nome}: conteúdo descompactado excede o limite do lote.")
+                for m in membros:
+                    nome_m = secure_filename(os.path.basename(m.filename))
+                    if os.path.splitext(nome_m)[1].lower() in aceitos:
+                        with zf.open(m) as stream:
+                            yield nome_m, stream
         else:
-            if os.path.exists(qr_path):
-                os.remove(qr_path)
-            return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao,
-                                   erro="❌ Formato não suportado. Envie PDF/JPG/PNG.")
+            yield nome, up.stream
 
-    except Exception as e:
-        try:
-            if os.path.exists(qr_path):
-                os.remove(qr_path)
-        except Exception:
-            pass
-        return render_template("assinar.html", nome=nome, cpf=cpf_masked, orgao=orgao, erro=f"❌ Erro ao assinar: {e}")
+@app.post("/assinar/lote")
+@login_required
+def assinar_lote():
+    """
+    Assina vários documentos numa única submissão.
+    Posição comum nos campos x/y/w/h/canvas_w/canvas_h/page, ou por arquivo em
+    `posicoes` (JSON: {"nome.pdf": {"x":..., "y":..., ...}}). O carimbo roda em
+    paralelo no pool; a resposta traz o manifesto (CRC/SHA-256) e o link do .zip.
+    """
+    if not validate_csrf_from_form():
+        return jsonify({"erro": "CSRF inválido. Recarregue a página."}), 400
+
+    try:
+        posicoes = json.loads(request.form.get("posicoes") or "{}")
+    except ValueError:
+        return jsonify({"erro": "Campo 'posicoes' não é um JSON válido."}), 400
+    pos_padrao = _posicao(request.form)
+
+    # Contexto do signatário, data/hora e recursos do carimbo: uma vez por lote
+    usr = session.get("user") or {}
+    nome, cpf_masked, orgao = _dados_signatario(usr)
+    processo = (request.form.get('processo') or '').strip()
+    ctx = {
+        "nome": nome, "cpf_masked": cpf_masked, "orgao": orgao,
+        "matricula": (request.form.get('matricula') or '').strip(),
+        "status": (request.form.get('status', '') or '').strip(),
+        "imagem_em_pdf": _imagem_em_pdf(request.form),
+        "processo": processo,
+        "datahora": _datahora_carimbo(),
+        # a URL de verificação não depende do CRC: o mesmo QR serve para o lote todo
+        "qr_url": build_verification_url(""),
+    }
+    recursos = stamping.preparar_recursos(ctx["qr_url"])
+
+    # Grava os uploads no armazém (hash no mesmo passe) e monta os parâmetros de cada documento.
+    # Um documento que não abre (PDF corrompido, posição inválida...) vira erro no manifesto;
+    # os demais seguem.
+    itens = []                                # (arquivo, nome_final, sha256, params, erro)
+    try:
+        for nome_arquivo, stream in _arquivos_do_lote():
+            if len(itens) >= app.config["BATCH_MAX_FILES"]:
+                return jsonify({"erro": f"Limite de {app.config['BATCH_MAX_FILES']} documentos por lote."}), 400
+            original_sha256, _, caminho_upload = guardar_upload(stream)
+            try:
+                pos = _posicao(posicoes[nome_arquivo]) if nome_arquivo in posicoes else pos_padrao
+                nome_final, params = _preparar_carimbo(nome_arquivo, caminho_upload,
+                                                       original_sha256, ctx, pos)
+                itens.append((nome_arquivo, nome_final, original_sha256, params, None))
+            except Exception as e:
+                db.session.rollback()
+                itens.append((nome_arquivo, None, original_sha256, None, e))
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({"erro": str(e)}), 400
+    if not itens:
+        return jsonify({"erro": "Nenhum documento PDF/JPG/PNG enviado."}), 400
+
+    pool = _get_pool_lote()
+    futuros, ocupado = [], None
+    for *_, params, erro in itens:
+        if erro is None and ocupado is None:
+            try:
+                futuros.append(_submeter_lote(pool, params, recursos))
+                continue
+            except governor.Ocupado as e:
+                ocupado = e                   # sem orçamento no prazo: o resto do lote nem espera
+        futuro = Future()
+        futuro.set_exception(erro or ocupado)
+        futuros.append(futuro)
+    _podar_lotes(app.config["BATCH_ZIP_HOURS"])
+
+    lote_id = uuid.uuid4().hex
+    manifesto = []
+    zip_path = os.path.join(_lotes_dir(), f"lote_{lote_id}.zip")
+    # PDF/JPG/PNG já são comprimidos: ZIP_STORED evita gastar CPU à toa
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for (nome_arquivo, nome_final, original_sha256, params, _), futuro in zip(itens, futuros):
+            item = {"arquivo": nome_arquivo, "assinado": nome_final,
+                    "crc": params["crc"] if params else None, "original_sha256": original_sha256}
+            try:
+                resultado = futuro.result()
+                _relatar_carimbo(nome_final, resultado, params, "lote")
+                with metricas.etapa("registro"):
+                    registrar_documento_assinado(params["crc"], params["destino"], nome_final,
+                                                 original_sha256, resultado["sha256"], processo)
+                zf.write(armazem.caminho_local(resultado["sha256"]), arcname=nome_final)
+                item.update(sha256=resultado["sha256"], tamanho=resultado["size"])
+            except Exception as e:
+                db.session.rollback()
+                item["erro"] = str(e)
+            manifesto.append(item)
+        zf.writestr("manifesto.json", json.dumps(manifesto, ensure_ascii=False, indent=2))
+
+    falhas = sum(1 for m in manifesto if "erro" in m)
+    return jsonify({
+        "lote_id": lote_id,
+        "total": len(manifesto),
+        "assinados": len(manifesto) - falhas,
+        "falhas": falhas,
+        "manifesto": manifesto,
+        "zip_url": url_for("baixar_lote", lote_id=lote_id),
+    })
+
+@app.get("/assinar/lote/<lote_id>.zip")
+@login_required
+def baixar_lote(lote_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", lote_id):
+        abort(404)
+    zip_path = os.path.join(_lotes_dir(), f"lote_{lote_id}.zip")
+    if not os.path.isfile(zip_path):
+        abort(404)
+    return send_file(zip_path, as_attachment=True, download_name=f"lote_{lote_id}.zip")
 
-def sha256_of_file(path: str) -> str:
-    h = hashlib.sha256()
-    with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            h.update(chunk)
-    return h.hexdigest()
 
 def _validate_csrf_safe() -> bool:
     """Usa sua validate_csrf_from_form() se existir; senão, assume True."""
@@ -648,6 +1531,107 @@ ASSINADOS_DIRNAME = os.path.join('static', 'arquivos', 'assinados')
 def _assinados_abs_dir():
     return os.path.join(app.root_path, ASSINADOS_DIRNAME)
 
+def _buscar_oficial_por_crc(crc: str):
+    """Consulta indexada no registro; devolve (url da cópia oficial, sha256) ou (None, None)."""
+    doc = SignedDocument.query.filter_by(crc=crc).first()
+    if doc is None:
+        return None, None
+    return url_assinado(doc.filename, doc.sha256), doc.sha256
+
+
+# nome gerado em assinar(): assinado_<nome_base>_<crc>.<ext>
+_CRC_NO_NOME_RE = re.compile(r"_([0-9a-f]{10})\.[A-Za-z0-9]+$")
+
+# controle (por processo) da última sincronização automática da pasta com o registro
+_ultima_sincronizacao = 0.0
+
+def sincronizar_registro_assinados() -> int:
+    """
+    Sincroniza incrementalmente a pasta de assinados com signed_documents.
+    Só re-hasheia arquivos novos ou cujo (caminho, tamanho, mtime) mudou desde o
+    último registro; os demais custam apenas um stat(). Carrega só os registros que
+    apontam para a pasta (os do armazém ficam no banco); um arquivo sem registro
+    conhecido é procurado pelo CRC do nome. Devolve quantos registrou.
+    """
+    pasta = _assinados_abs_dir()
+    if not os.path.isdir(pasta):
+        return 0
+
+    conhecidos = {
+        d.filename: d for d in SignedDocument.query.with_entities(
+            SignedDocument.id, SignedDocument.filename,
+            SignedDocument.size_bytes, SignedDocument.file_mtime
+        ).filter(SignedDocument.stored_path.startswith(ASSINADOS_DIRNAME, autoescape=True))
+    }
+    alterados = varridos = 0
+    with os.scandir(pasta) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            varridos += 1
+            m = _CRC_NO_NOME_RE.search(entry.name)
+            if not m:
+                continue
+            st = entry.stat()
+            atual = conhecidos.get(entry.name)
+            if atual is not None and atual.size_bytes == st.st_size and atual.file_mtime == st.st_mtime:
+                continue
+
+            doc = (db.session.get(SignedDocument, atual.id) if atual is not None
+                   else SignedDocument.query.filter_by(crc=m.group(1)).first())
+            if doc is not None and (doc.filename != entry.name
+                                    or not doc.stored_path.startswith(ASSINADOS_DIRNAME)):
+                # CRC já registrado para outro arquivo (ou já no armazém): mantém o registro existente
+                continue
+
+            with metricas.etapa("hash"):
+                sha = sha256_of_file(entry.path)
+            HASH_BYTES.inc(st.st_size, origem="registro")
+            REGISTRO_HASHEADOS.inc()
+            if doc is None:
+                if SignedDocument.query.filter_by(sha256=sha).first():
+                    continue
+                doc = SignedDocument(crc=m.group(1),
+                                     signed_at=datetime.fromtimestamp(st.st_mtime, timezone.utc))
+                db.session.add(doc)
+            doc.sha256      = sha
+            doc.filename    = entry.name
+            doc.stored_path = os.path.join(ASSINADOS_DIRNAME, entry.name)
+            doc.size_bytes  = st.st_size
+            doc.file_mtime  = st.st_mtime
+            db.session.commit()
+            alterados += 1
+    REGISTRO_VARRIDOS.inc(varridos)
+    return alterados
+
+def _sincronizar_registro_se_preciso():
+    """Sincronização automática limitada a uma a cada REGISTRY_SYNC_INTERVAL segundos."""
+    global _ultima_sincronizacao
+    intervalo = app.config["REGISTRY_SYNC_INTERVAL"]
+    agora = time.monotonic()
+    with _estado_lock:
+        if _ultima_sincronizacao and agora - _ultima_sincronizacao < intervalo:
+            return
+        _ultima_sincronizacao = agora     # esta thread sincroniza; as demais seguem
+    try:
+        sincronizar_registro_assinados()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Falha ao sincronizar registro de assinados")
+
+def _buscar_oficial_por_sha256(sha256_hex: str):
+    """Consulta indexada por SHA-256 do arquivo final; devolve (url, sha256) ou (None, None)."""
+    doc = SignedDocument.query.filter_by(sha256=sha256_hex).first()
+    if doc is None:
+        return None, None
+    return url_assinado(doc.filename, doc.sha256), doc.sha256
+
+@app.cli.command("registrar-assinados")
+def registrar_assinados_cmd():
+    """Registra no banco arquivos assinados novos/alterados na pasta (ex.: anteriores à tabela)."""
+    novos = sincronizar_registro_assinados()
+    click.echo(f"{novos} documento(s) registrado(s).")
+
 
 # ---------- Menu (verificar.html) ----------
 @app.route("/verificar", methods=["GET"], endpoint="verificar")
@@ -658,7 +1642,6 @@ def verificar_menu():
 # ---------- Validar por CRC (validar_crc.html) ----------
 @app.route("/verificar/crc", methods=["GET", "POST"], endpoint="validar_crc")
 def validar_crc():
-    pasta = _assinados_abs_dir()
     erro = None
     caminho = None
     canonical_sha256 = None
@@ -675,17 +1658,9 @@ def validar_crc():
             if not re.fullmatch(r"[0-9a-f]{8,64}", crc):
                 erro = "CRC inválido. Use apenas caracteres hexadecimais."
             else:
-                try:
-                    for nome in os.listdir(pasta):
-                        if f"_{crc}" in nome:
-                            abs_path = os.path.join(pasta, nome)
-                            caminho = url_for('static', filename=f'arquivos/assinados/{nome}')
-                            canonical_sha256 = sha256_of_file(abs_path)
-                            break
-                    if not caminho:
-                        erro = "Documento não encontrado para o CRC fornecido."
-                except FileNotFoundError:
-                    erro = "Nenhum documento assinado foi encontrado."
+                caminho, canonical_sha256 = _buscar_oficial_por_crc(crc)
+                if not caminho:
+                    erro = "Documento não encontrado para o CRC fornecido."
 
     # POST: comparar upload com a oficial já encontrada
     if request.method == "POST":
@@ -696,17 +1671,9 @@ def validar_crc():
             if not crc or not re.fullmatch(r"[0-9a-f]{8,64}", crc):
                 erro = "CRC inválido. Use apenas caracteres hexadecimais."
             else:
-                try:
-                    for nome in os.listdir(pasta):
-                        if f"_{crc}" in nome:
-                            abs_path = os.path.join(pasta, nome)
-                            caminho = url_for('static', filename=f'arquivos/assinados/{nome}')
-                            canonical_sha256 = sha256_of_file(abs_path)
-                            break
-                    if not caminho:
-                        erro = "Documento não encontrado para o CRC fornecido."
-                except FileNotFoundError:
-                    erro = "Nenhum documento assinado foi encontrado."
+                caminho, canonical_sha256 = _buscar_oficial_por_crc(crc)
+                if not caminho:
+                    erro = "Documento não encontrado para o CRC fornecido."
 
             # Se já temos a oficial, compara
             if not erro and canonical_sha256:
@@ -714,10 +1681,11 @@ def validar_crc():
                 if not up:
                     erro = "Nenhum arquivo enviado para comparar."
                 else:
-                    data = up.read()
-                    user_sha256 = hashlib.sha256(data).hexdigest()
+                    user_sha256 = sha256_of_stream(up.stream)
                     match = (user_sha256 == canonical_sha256)
 
+    if crc:
+        VERIFICACOES.inc(tipo="crc", resultado=_resultado_verificacao(erro, match))
     return render_template(
         "validar_crc.html",
         crc=crc,
@@ -732,7 +1700,6 @@ def validar_crc():
 # ---------- Validar por Upload (validar_upload.html) ----------
 @app.route("/verificar/upload", methods=["GET", "POST"], endpoint="validar_upload")
 def validar_upload():
-    pasta = _assinados_abs_dir()
     erro = None
     caminho = None
     canonical_sha256 = None
@@ -747,24 +1714,18 @@ def validar_upload():
             if not up:
                 erro = "Nenhum arquivo enviado."
             else:
-                data = up.read()
-                user_sha256 = hashlib.sha256(data).hexdigest()
-
-                # Procura algum oficial com o mesmo SHA-256
-                try:
-                    for nome in os.listdir(pasta):
-                        abs_path = os.path.join(pasta, nome)
-                        sha = sha256_of_file(abs_path)
-                        if sha == user_sha256:
-                            match = True
-                            canonical_sha256 = sha
-                            caminho = url_for('static', filename=f'arquivos/assinados/{nome}')
-                            break
-                    if match is None:
-                        match = False
-                except FileNotFoundError:
-                    erro = "Nenhum documento assinado foi encontrado."
+                user_sha256 = sha256_of_stream(up.stream)
 
+                # Procura algum oficial com o mesmo SHA-256 (consulta indexada);
+                # em caso de ausência, incorpora arquivos novos da pasta e tenta de novo
+                caminho, canonical_sha256 = _buscar_oficial_por_sha256(user_sha256)
+                if not caminho:
+                    _sincronizar_registro_se_preciso()
+                    caminho, canonical_sha256 = _buscar_oficial_por_sha256(user_sha256)
+                match = bool(caminho)
+
+    if request.method == "POST":
+        VERIFICACOES.inc(tipo="upload", resultado=_resultado_verificacao(erro, match))
     return render_template(
         "validar_upload.html",
         caminho=caminho,
@@ -776,15 +1737,157 @@ def validar_upload():
 
 
 
+# ---------- Documentos assinados (armazém) ----------
+def _resolver_assinado(filename: str):
+    """
+    Documento assinado pelo nome: (registro, caminho_legado). Para os que estão no
+    armazém o caminho é None; legados na pasta antiga podem não ter registro.
+    A busca usa o CRC do nome (consulta indexada).
+    """
+    nome = os.path.basename(filename)
+    doc = None
+    m = _CRC_NO_NOME_RE.search(nome)
+    if m:
+        doc = SignedDocument.query.filter_by(crc=m.group(1)).first()
+        if doc is not None and doc.filename != nome:
+            doc = None
+        if doc is not None and not doc.stored_path.startswith(ASSINADOS_DIRNAME):
+            return doc, None
+    legado = os.path.join(_assinados_abs_dir(), nome)
+    if not os.path.isfile(legado):
+        return None, None
+    return doc, legado
+
+def url_assinado(nome: str, sha256_hex: str = None) -> str:
+    """
+    URL da cópia oficial. Com o SHA-256, leva `v=` (versão): esse URL nunca muda de
+    conteúdo e pode ser guardado em cache como imutável.
+    """
+    if sha256_hex:
+        return url_for("documento_assinado", filename=nome, v=sha256_hex[:16])
+    return url_for("documento_assinado", filename=nome)
+
+# maior trecho devolvido por um Range servido do backend (o cliente pede o resto depois)
+RANGE_MAX_BYTES = 16 * 1024 * 1024
+
+def _cabecalhos_cache(resp, sha256_hex: str, publico: bool):
+    """
+    ETag forte pelo SHA-256. URL versionado (?v=) é imutável; pelo nome, o conteúdo
+    muda se o original for reassinado, então o cliente revalida (barato: 304).
+    """
+    if sha256_hex:
+        resp.set_etag(sha256_hex)
+    if sha256_hex and request.args.get("v") == sha256_hex[:16]:
+        resp.cache_control.no_cache = False
+        resp.cache_control.max_age = 31536000
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    resp.cache_control.public = publico
+    resp.cache_control.private = not publico
+    return resp
+
+def _resposta_do_backend(sha256_hex: str, tamanho: int, mimetype: str):
+    """Conteúdo que não está em disco neste nó (S3): Range lido direto do backend ou stream em blocos."""
+    resp = app.response_class(mimetype=mimetype)
+    resp.accept_ranges = "bytes"
+    intervalo = request.range
+    if intervalo is not None and len(intervalo.ranges) == 1:
+        limites = intervalo.range_for_length(tamanho)
+        if limites is None:
+            resp.status_code = 416
+            resp.content_range = ContentRange("bytes", None, None, tamanho)
+            return resp
+        inicio, fim = limites[0], min(limites[1], limites[0] + RANGE_MAX_BYTES)
+        resp.set_data(armazem.ler_intervalo(sha256_hex, inicio, fim - 1))
+        resp.status_code = 206
+        resp.content_range = ContentRange("bytes", inicio, fim, tamanho)
+        return resp
+    corpo = armazem.abrir(sha256_hex)
+    resp.response = iter(lambda: corpo.read(storage.CHUNK), b"")
+    resp.content_length = tamanho
+    return resp
+
+def _enviar_assinado(filename: str, anexo: bool, publico: bool):
+    """
+    Entrega o documento com ETag forte, Range e cache: legado da pasta antiga, URL
+    pré-assinada (S3), X-Accel-Redirect/X-Sendfile (SENDFILE_MODE), arquivo local
+    ou, por fim, leitura direto do backend.
+    """
+    nome = os.path.basename(filename)
+    doc, legado = _resolver_assinado(filename)
+    if doc is None and legado is None:
+        return abort(404)
+    sha = doc.sha256 if doc is not None else None
+    mimetype = mimetypes.guess_type(nome)[0] or "application/octet-stream"
+
+    if sha and request.if_none_match.contains(sha):
+        return _cabecalhos_cache(app.response_class(status=304), sha, publico)
+
+    if legado:
+        resp = send_file(legado, mimetype=mimetype, as_attachment=anexo, download_name=nome,
+                         etag=sha or True, conditional=True)
+        return _cabecalhos_cache(resp, sha, publico)
+
+    if app.config["S3_PRESIGNED_DOWNLOADS"]:
+        url = armazem.url_download(sha, nome, anexo=anexo)
+        if url:
+            return redirect(url)
+
+    caminho = armazem.arquivo_local(sha)
+    if caminho and app.config["SENDFILE_MODE"] == "x-accel":
+        # o nginx entrega os bytes (e atende Range); aqui só os cabeçalhos
+        resp = app.response_class(mimetype=mimetype)
+        resp.headers["X-Accel-Redirect"] = app.config["SENDFILE_ACCEL_PREFIX"].rstrip("/") + "/" + storage.chave(sha)
+        resp.headers.set("Content-Disposition", "attachment" if anexo else "inline", filename=nome)
+    elif caminho:
+        # USE_X_SENDFILE (SENDFILE_MODE=x-sendfile) é tratado pelo próprio send_file
+        resp = send_file(caminho, mimetype=mimetype, as_attachment=anexo, download_name=nome,
+                         etag=sha, conditional=True)
+    else:
+        resp = _resposta_do_backend(sha, doc.size_bytes, mimetype)
+        resp.headers.set("Content-Disposition", "attachment" if anexo else "inline", filename=nome)
+    return _cabecalhos_cache(resp, sha, publico)
+
+@app.route('/documentos/<path:filename>', endpoint="documento_assinado")
+def documento_assinado(filename):
+    """Cópia oficial (links da verificação e do resultado), exibida no navegador."""
+    return _enviar_assinado(filename, anexo=False, publico=True)
+
+@app.cli.command("limpar-armazem")
+@click.option("--horas", type=float, default=None, help="Idade mínima sem referência (padrão: STORAGE_GC_HOURS).")
+def limpar_armazem_cmd(horas):
+    """
+    Remove do armazém arquivos sem referência (uploads não assinados, versões substituídas),
+    os .zip de lotes com mais de BATCH_ZIP_HOURS e, com S3, as cópias do cache local sem uso
+    há mais de STORAGE_CACHE_HOURS (rode em cada nó).
+    """
+    horas = app.config["STORAGE_GC_HOURS"] if horas is None else horas
+    limite = datetime.now(timezone.utc) - timedelta(hours=horas)
+    orfaos = (StoredBlob.query
+              .filter(StoredBlob.refcount <= 0, StoredBlob.updated_at < limite)
+              .with_for_update(skip_locked=True)
+              .all())
+    for blob in orfaos:
+        armazem.remover(blob.sha256)
+        db.session.delete(blob)
+    # chaves de pedidos repetidos fora da janela
+    janela = datetime.now(timezone.utc) - timedelta(minutes=app.config["SIGN_IDEMPOTENCY_MINUTES"])
+    SigningRequestKey.query.filter(SigningRequestKey.created_at < janela).delete()
+    db.session.commit()
+    temporarios = armazem.limpar_temporarios(horas * 3600)
+    lotes = _podar_lotes(app.config["BATCH_ZIP_HOURS"])
+    cache = armazem.limpar_cache(app.config["STORAGE_CACHE_HOURS"] * 3600,
+                                 app.config["STORAGE_CACHE_MAX_BYTES"])
+    click.echo(f"{len(orfaos)} arquivo(s) sem referência, {temporarios} temporário(s), "
+               f"{lotes} lote(s) .zip e {cache} cópia(s) do cache local removido(s).")
+
+
 # ---------- Download seguro ----------
 @app.route('/download/<path:filename>')
 @login_required
 def download(filename):
-    base_dir = os.path.join(app.root_path, 'static', 'arquivos', 'assinados')
-    file_path = os.path.normpath(os.path.join(base_dir, filename))
-    if not file_path.startswith(base_dir) or not os.path.isfile(file_path):
-        return abort(404)
-    return send_file(file_path, as_attachment=True, download_name=os.path.basename(file_path))
+    return _enviar_assinado(filename, anexo=True, publico=False)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
 # auth.py — Autenticação segura (Flask + SQLAlchemy)
-import re, time, secrets
+import re, time, secrets, threading
 from datetime import datetime
 from functools import wraps
 from flask import Blueprint, request, session, redirect, url_for, flash, current_app, render_template
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User
+from models import db, User, LoginAttempt
+import ratelimit
+import kdf
 
 bp = Blueprint("auth", __name__)
 
@@ -21,20 +22,35 @@ def normalize_cpf(cpf: str) -> str:
 def is_valid_cpf_digits(cpf: str) -> bool:
     return bool(_cpf_digits_re.match(cpf or ""))
 
+# serviços criados sob demanda; com workers gthread, uma thread só cria cada um
+_servicos_lock = threading.Lock()
+
+# KDF num pool limitado por processo (ver kdf.py); esquema e parâmetros em KDF_*
+def _kdf() -> kdf.ServicoKDF:
+    servico = current_app.extensions.get("kdf")
+    if servico is None:
+        with _servicos_lock:
+            servico = current_app.extensions.get("kdf")
+            if servico is None:
+                servico = kdf.criar_servico(current_app.config)
+                current_app.extensions["kdf"] = servico
+    return servico
+
 def _hash(texto: str) -> str:
-    return generate_password_hash(texto, method="pbkdf2:sha256", salt_length=16)
+    return _kdf().gerar(texto)
 
-def _check_hash(hashval: str, texto: str) -> bool:
-    try:
-        return check_password_hash(hashval or "", texto or "")
-    except Exception:
-        return False
+@bp.app_errorhandler(kdf.KDFOcupado)
+def _kdf_ocupado(_e):
+    # cadastro/importação durante um pico de logins: volta para a tela com aviso
+    flash("Servidor ocupado verificando acessos. Tente novamente em alguns segundos.", "warning")
+    return redirect(request.path if request.method == "POST" else url_for("home"))
 
 def _now() -> int:
     return int(time.time())
 
 def _cfg(key, default=None):
-    defaults = {"MAX_LOGIN_ATTEMPTS": 5, "LOCKOUT_SECONDS": 150}
+    defaults = {"MAX_LOGIN_ATTEMPTS": 5, "LOCKOUT_SECONDS": 150, "LOGIN_RATE_WINDOW": 900,
+                "LOGIN_RATE_BACKEND": "memoria", "LOGIN_RATE_MAX_KEYS": 10000}
     return current_app.config.get(key, defaults.get(key, default))
 
 # ----------------------- CSRF -----------------------
@@ -59,31 +75,33 @@ def inject_ctx():
     }
 
 # ----------------------- Rate limit de login -----------------------
-_login_attempts = {}
+# Backend em LOGIN_RATE_BACKEND (ver ratelimit.py): "memoria" conta por worker,
+# "banco"/"redis" compartilham a contagem entre todos os workers e nós.
+def _limite() -> ratelimit.LimiteTentativas:
+    limite = current_app.extensions.get("limite_login")
+    if limite is None:
+        with _servicos_lock:
+            limite = current_app.extensions.get("limite_login")
+            if limite is None:
+                config = {k: _cfg(k) for k in ("MAX_LOGIN_ATTEMPTS", "LOCKOUT_SECONDS", "LOGIN_RATE_WINDOW",
+                                               "LOGIN_RATE_BACKEND", "LOGIN_RATE_MAX_KEYS")}
+                config["LOGIN_RATE_REDIS_URL"] = current_app.config.get("LOGIN_RATE_REDIS_URL")
+                limite = ratelimit.criar_limite(config, engine=db.engine, tabela=LoginAttempt.__table__)
+                current_app.extensions["limite_login"] = limite
+    return limite
 
 def _key_for_login(email: str) -> str:
     ip = request.headers.get("X-Forwarded-For", request.remote_addr or "0.0.0.0").split(",")[0].strip()
     return f"{(email or '').lower()}|{ip}"
 
 def _is_locked(email: str) -> int:
-    entry = _login_attempts.get(_key_for_login(email))
-    if not entry:
-        return 0
-    if entry.get("lock_until", 0) > _now():
-        return max(0, entry["lock_until"] - _now())
-    return 0
+    return _limite().bloqueado(_key_for_login(email))
 
 def _register_fail(email: str):
-    key = _key_for_login(email)
-    e = _login_attempts.get(key, {"count": 0, "lock_until": 0})
-    e["count"] += 1
-    if e["count"] >= _cfg("MAX_LOGIN_ATTEMPTS"):
-        e["lock_until"] = _now() + _cfg("LOCKOUT_SECONDS")
-        e["count"] = 0
-    _login_attempts[key] = e
+    _limite().falhou(_key_for_login(email))
 
 def _clear_attempts(email: str):
-    _login_attempts.pop(_key_for_login(email), None)
+    _limite().limpar(_key_for_login(email))
 
 # ----------------------- Guards -----------------------
 def login_required(view):
@@ -136,11 +154,24 @@ def login():
         return redirect(url_for("auth.login"))
 
     u = User.query.filter_by(email=email).first()
-    if not u or not _check_hash(u.cpf_hash, cpf_digits):
+    try:
+        confere, hash_novo = _kdf().verificar(u.cpf_hash, cpf_digits) if u else (False, None)
+    except kdf.KDFOcupado:
+        # pico de logins: recusa rápida em vez de enfileirar sem limite
+        flash("Muitos acessos ao mesmo tempo. Tente novamente em alguns segundos.", "warning")
+        resp = current_app.make_response((render_template("login.html"), 503))
+        resp.headers["Retry-After"] = "5"
+        return resp
+    if not confere:
         _register_fail(email)
         flash("Usuário ou senha inválidos.", "danger")
         return redirect(url_for("auth.login"))
 
+    if hash_novo:
+        # hash antigo (PBKDF2 ou parâmetros desatualizados): regrava no esquema atual
+        u.cpf_hash = hash_novo
+        db.session.commit()
+
     _clear_attempts(email)
     session.clear()          # previne fixation
     ensure_csrf()          # novo token para sessão autenticada
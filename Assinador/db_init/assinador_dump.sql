@@ -32,6 +32,20 @@ CREATE EXTENSION IF NOT EXISTS citext WITH SCHEMA public;
 COMMENT ON EXTENSION citext IS 'data type for case-insensitive character strings';
 
 
+--
+-- Name: pg_trgm; Type: EXTENSION; Schema: -; Owner: -
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+
+--
+-- Name: EXTENSION pg_trgm; Type: COMMENT; Schema: -; Owner: 
+--
+
+COMMENT ON EXTENSION pg_trgm IS 'text similarity measurement and index searching based on trigrams';
+
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
@@ -118,6 +132,48 @@ ALTER TABLE ONLY public.users
 CREATE UNIQUE INDEX ix_users_email ON public.users USING btree (email);
 
 
+--
+-- Name: ix_users_created_at_id; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_created_at_id ON public.users USING btree (created_at, id);
+
+
+--
+-- Name: ix_users_nome_trgm; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_nome_trgm ON public.users USING gin (nome public.gin_trgm_ops);
+
+
+--
+-- Name: ix_users_email_trgm; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_email_trgm ON public.users USING gin (((email)::text) public.gin_trgm_ops);
+
+
+--
+-- Name: ix_users_matricula_trgm; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_matricula_trgm ON public.users USING gin (matricula public.gin_trgm_ops);
+
+
+--
+-- Name: ix_users_orgao_trgm; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_orgao_trgm ON public.users USING gin (orgao public.gin_trgm_ops);
+
+
+--
+-- Name: ix_users_setor_trgm; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_setor_trgm ON public.users USING gin (setor public.gin_trgm_ops);
+
+
 --
 -- PostgreSQL database dump complete
 --
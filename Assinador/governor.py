@@ -0,0 +1,136 @@
+# governor.py — Controle de admissão das operações pesadas (carimbo, render), sem dependência de Flask
+# Cada worker tem um orçamento de memória (MB estimados). Uma operação só começa quando o
+# seu custo cabe no que sobra; as demais esperam numa fila por ordem de chegada, até um
+# prazo. Estourado o prazo, a requisição recebe "ocupado, tente de novo" em vez de o
+# worker crescer até ser morto por falta de memória.
+import os, threading, time
+from collections import deque
+from contextlib import contextmanager
+import metricas
+
+MB = 1024 * 1024
+
+# Pesos da estimativa (MB). Ajustáveis por ambiente sem mexer no código.
+CUSTO_BASE_MB = float(os.environ.get("GOVERNOR_BASE_MB", "8"))
+FATOR_ARQUIVO = float(os.environ.get("GOVERNOR_FATOR_ARQUIVO", "3"))   # PDF aberto ≈ 3x o arquivo
+BYTES_POR_PT2 = float(os.environ.get("GOVERNOR_BYTES_POR_PT2", "4"))   # lista de exibição da página
+
+_ESPERA = metricas.REGISTRO.histograma(
+    "assinador_governador_espera_segundos", "Espera na fila do controle de carga até a admissão.")
+_RECUSAS = metricas.REGISTRO.contador(
+    "assinador_governador_recusas_total", "Operações recusadas pelo controle de carga (fila cheia ou prazo).")
+
+
+class Ocupado(Exception):
+    """Sem orçamento livre dentro do prazo de espera."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Servidor ocupado com outros documentos. Tente novamente em instantes.")
+        self.retry_after = retry_after
+
+
+def _maior_pagina_pt2(meta: dict) -> float:
+    tamanhos = meta.get("tamanhos") or []
+    return max((p["w"] * p["h"] for p in tamanhos), default=0.0)
+
+
+def custo_assinatura(meta: dict) -> int:
+    """
+    MB estimados para carimbar o documento descrito por `meta` (pré-análise):
+    arquivo aberto + maior página (PDF) ou a imagem decodificada em RGBA.
+    """
+    custo = CUSTO_BASE_MB + FATOR_ARQUIVO * meta["size_bytes"] / MB
+    if meta.get("tipo") == "imagem":
+        custo += (meta.get("width") or 0) * (meta.get("height") or 0) * 4 / MB
+    else:
+        custo += _maior_pagina_pt2(meta) * BYTES_POR_PT2 / MB
+    return int(custo + 0.5)
+
+
+def custo_render(meta: dict, page_num: int, largura_px: int) -> int:
+    """MB estimados para rasterizar a página `page_num` (1-based) com `largura_px`."""
+    pagina = meta["tamanhos"][page_num - 1]
+    altura_px = largura_px * pagina["h"] / max(pagina["w"], 1.0)
+    custo = (CUSTO_BASE_MB + FATOR_ARQUIVO * meta["size_bytes"] / MB
+             + pagina["w"] * pagina["h"] * BYTES_POR_PT2 / MB
+             + largura_px * altura_px * 3 / MB)      # pixmap RGB
+    return int(custo + 0.5)
+
+
+class Governador:
+    """
+    Semáforo ponderado com fila FIFO e prazo. `capacidade` e custos em MB estimados;
+    um custo maior que a capacidade é limitado a ela (roda sozinho, mas roda).
+    Vale por processo: o orçamento do nó é capacidade × workers do gunicorn.
+    """
+
+    def __init__(self, capacidade: int, espera_s: float, retry_after: int = 5, max_fila: int = 0):
+        self.capacidade = max(1, int(capacidade))
+        self.espera_s = espera_s
+        self.retry_after = retry_after
+        self.max_fila = max_fila            # 0 = sem limite além do prazo
+        self._cond = threading.Condition()
+        self._fila = deque()
+        self.em_uso = 0
+        self.ativos = {}                    # tipo -> operações em andamento
+        self.concluidos = 0
+        self.recusados = 0
+        self.espera_total_s = 0.0
+
+    @contextmanager
+    def reservar(self, custo: int, tipo: str = "operacao"):
+        """
+        Bloco executado com `custo` MB reservados. Levanta Ocupado se a fila estiver
+        cheia ou se o orçamento não liberar dentro de `espera_s`.
+        """
+        custo = max(1, min(int(custo), self.capacidade))
+        inicio = time.monotonic()
+        with self._cond:
+            if self.max_fila and len(self._fila) >= self.max_fila:
+                self.recusados += 1
+                _RECUSAS.inc(tipo=tipo)
+                raise Ocupado(self.retry_after)
+            vez = object()
+            self._fila.append(vez)
+            prazo = inicio + self.espera_s
+            try:
+                # por ordem de chegada: um documento grande não fica para trás indefinidamente
+                while self._fila[0] is not vez or self.em_uso + custo > self.capacidade:
+                    restante = prazo - time.monotonic()
+                    if restante <= 0:
+                        self.recusados += 1
+                        _RECUSAS.inc(tipo=tipo)
+                        raise Ocupado(self.retry_after)
+                    self._cond.wait(restante)
+            finally:
+                self._fila.remove(vez)
+                self._cond.notify_all()
+            self.em_uso += custo
+            self.ativos[tipo] = self.ativos.get(tipo, 0) + 1
+            espera = time.monotonic() - inicio
+            self.espera_total_s += espera
+        _ESPERA.observar(espera, tipo=tipo)
+        metricas.registrar_etapa("fila_carga", espera)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.em_uso -= custo
+                self.ativos[tipo] -= 1
+                self.concluidos += 1
+                self._cond.notify_all()
+
+    def metricas(self) -> dict:
+        with self._cond:
+            admitidos = self.concluidos + sum(self.ativos.values())
+            return {
+                "pid": os.getpid(),
+                "capacidade_mb": self.capacidade,
+                "em_uso_mb": self.em_uso,
+                "ativos": sum(self.ativos.values()),
+                "ativos_por_tipo": dict(self.ativos),
+                "na_fila": len(self._fila),
+                "concluidos": self.concluidos,
+                "recusados": self.recusados,
+                "espera_media_ms": round(1000 * self.espera_total_s / admitidos, 1) if admitidos else 0.0,
+            }
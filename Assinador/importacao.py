@@ -0,0 +1,202 @@
+# importacao.py — Importação em lote de usuários (CSV/XLSX)
+# Lê a planilha, valida linha a linha, descobre os e-mails já cadastrados numa consulta
+# IN, calcula os hashes de CPF num pool de processos e grava em lotes com
+# INSERT ... ON CONFLICT (email) DO UPDATE. Cada linha com problema vira uma entrada do
+# relatório de erros; as demais seguem. Ninguém vira administrador por importação.
+import csv, io, os, time, unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+import kdf
+from auth import normalize_cpf, is_valid_cpf_digits, is_valid_email
+
+OBRIGATORIAS = ("nome", "email", "cpf")
+OPCIONAIS = ("orgao", "setor", "matricula", "cargo")
+CONSULTA_IN_MAX = 1000              # e-mails por consulta IN (limite de parâmetros)
+
+
+def _coluna(titulo) -> str:
+    """Cabeçalho normalizado: sem acento, minúsculo, sem hífen/espaço ("E-mail" → "email")."""
+    texto = unicodedata.normalize("NFKD", str(titulo or "")).encode("ascii", "ignore").decode()
+    return "".join(c for c in texto.lower() if c.isalnum())
+
+
+def _celula(valor, coluna: str) -> str:
+    if valor is None:
+        return ""
+    if coluna == "cpf" and isinstance(valor, (int, float)):
+        # planilha guardou o CPF como número: zeros à esquerda somem
+        return str(int(valor)).zfill(11)
+    return str(valor).strip()
+
+
+def _linhas_csv(dados: bytes):
+    try:
+        texto = dados.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        texto = dados.decode("cp1252")       # CSV salvo pelo Excel em português
+    try:
+        dialeto = csv.Sniffer().sniff(texto[:4096], delimiters=";,\t")
+    except csv.Error:
+        dialeto = csv.excel
+    return csv.reader(io.StringIO(texto), dialeto)
+
+
+def _linhas_xlsx(dados: bytes):
+    try:
+        from openpyxl import load_workbook
+    except ImportError as e:  # dependência só da importação por XLSX
+        raise RuntimeError("Importar XLSX requer o pacote openpyxl (ou envie CSV).") from e
+    planilha = load_workbook(io.BytesIO(dados), read_only=True, data_only=True).active
+    return planilha.iter_rows(values_only=True)
+
+
+def ler_planilha(dados: bytes, nome_arquivo: str):
+    """
+    Linhas da planilha como [(número da linha, {coluna: texto})]. A primeira linha é o
+    cabeçalho (nome, email, cpf obrigatórios; orgao, setor, matricula, cargo opcionais).
+    Levanta ValueError se o formato ou o cabeçalho não servir.
+    """
+    extensao = os.path.splitext(nome_arquivo or "")[1].lower()
+    if extensao == ".csv":
+        linhas = _linhas_csv(dados)
+    elif extensao == ".xlsx":
+        linhas = _linhas_xlsx(dados)
+    else:
+        raise ValueError("Formato não suportado. Envie CSV ou XLSX.")
+
+    linhas = iter(linhas)
+    cabecalho = [_coluna(t) for t in next(linhas, [])]
+    faltando = [c for c in OBRIGATORIAS if c not in cabecalho]
+    if faltando:
+        raise ValueError(f"Coluna(s) obrigatória(s) ausente(s): {', '.join(faltando)}.")
+    indices = {c: cabecalho.index(c) for c in OBRIGATORIAS + OPCIONAIS if c in cabecalho}
+
+    saida = []
+    for numero, valores in enumerate(linhas, start=2):
+        valores = list(valores or [])
+        if not any(v not in (None, "") for v in valores):
+            continue                            # linha em branco
+        saida.append((numero, {c: _celula(valores[i] if i < len(valores) else None, c)
+                               for c, i in indices.items()}))
+    return saida
+
+
+def validar(linhas):
+    """
+    (válidas, erros): válidas já normalizadas; erros como {"linha", "email", "erro"}.
+    As colunas opcionais só aparecem nas válidas quando a planilha as traz.
+    """
+    validas, erros, vistos = [], [], {}
+    for numero, dados in linhas:
+        email = dados.get("email", "").lower()
+        cpf = normalize_cpf(dados.get("cpf"))
+        erro = None
+        if not dados.get("nome"):
+            erro = "Nome em branco."
+        elif not is_valid_email(email):
+            erro = "E-mail inválido."
+        elif not is_valid_cpf_digits(cpf):
+            erro = "CPF inválido (11 dígitos)."
+        elif email in vistos:
+            erro = f"E-mail repetido na planilha (linha {vistos[email]})."
+        if erro:
+            erros.append({"linha": numero, "email": email, "erro": erro})
+            continue
+        vistos[email] = numero
+        valida = {"linha": numero, "email": email, "nome": dados["nome"], "cpf": cpf}
+        valida.update({c: dados[c] for c in OPCIONAIS if c in dados})
+        if "orgao" in valida:
+            valida["orgao"] = valida["orgao"].upper()
+        validas.append(valida)
+    return validas, erros
+
+
+def _existentes(engine, tabela, emails):
+    """{email: cpf_hash} dos já cadastrados (uma consulta IN por bloco de e-mails)."""
+    achados = {}
+    with engine.connect() as con:
+        for i in range(0, len(emails), CONSULTA_IN_MAX):
+            bloco = emails[i:i + CONSULTA_IN_MAX]
+            for email, cpf_hash in con.execute(
+                    select(tabela.c.email, tabela.c.cpf_hash).where(tabela.c.email.in_(bloco))):
+                achados[email.lower()] = cpf_hash
+    return achados
+
+
+def _comando_upsert(engine, tabela, atualizar):
+    """INSERT ... ON CONFLICT (email) DO UPDATE só das colunas em `atualizar`."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f"Importação em lote não suportada no banco {engine.dialect.name!r}.")
+    ins = insert(tabela)
+    return ins.on_conflict_do_update(
+        index_elements=[tabela.c.email],
+        set_={**{c: ins.excluded[c] for c in atualizar}, "updated_at": func.now()},
+    )
+
+
+def importar(engine, tabela, linhas, kdf_config: dict, atualizar_cpf: bool = False,
+             workers: int = None, lote: int = 500) -> dict:
+    """
+    Grava as linhas de ler_planilha() na tabela de usuários. Cadastrados têm atualizados
+    o nome e as colunas opcionais que a planilha traz (as ausentes ficam como estão); o
+    CPF deles (hash e máscara juntos) só é trocado com `atualizar_cpf`. Devolve o relatório:
+    {"linhas", "criados", "atualizados", "erros": [...], "segundos"}.
+    """
+    inicio = time.perf_counter()
+    validas, erros = validar(linhas)
+    existentes = _existentes(engine, tabela, [r["email"] for r in validas])
+
+    # só quem vai gravar CPF novo passa pelo KDF (a parte cara), em paralelo
+    precisam = [r for r in validas if atualizar_cpf or r["email"] not in existentes]
+    if precisam:
+        workers = max(1, min(workers or os.cpu_count() or 1, len(precisam)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            hashes = pool.map(partial(kdf.gerar_hash, kdf_config), [r["cpf"] for r in precisam],
+                              chunksize=max(1, len(precisam) // (workers * 4)))
+            for r, h in zip(precisam, hashes):
+                r["cpf_hash"] = h
+
+    criados = atualizados = 0
+    atualizar = ["nome"] + [c for c in OPCIONAIS if any(c in r for r in validas)]
+    if atualizar_cpf:
+        atualizar += ["cpf_hash", "cpf_masked"]
+    comando = _comando_upsert(engine, tabela, atualizar)
+    for i in range(0, len(validas), lote):
+        bloco = validas[i:i + lote]
+        registros = [{
+            "email": r["email"], "nome": r["nome"],
+            "cpf_hash": r.get("cpf_hash") or existentes[r["email"]],
+            "cpf_masked": f"{r['cpf'][:3]}.{r['cpf'][3:6]}.{r['cpf'][6:9]}-{r['cpf'][9:]}",
+            **{c: r.get(c, "") for c in OPCIONAIS},
+        } for r in bloco]
+        try:
+            with engine.begin() as con:     # uma transação por lote
+                con.execute(comando, registros)
+        except SQLAlchemyError as e:
+            motivo = str(getattr(e, "orig", e)).splitlines()[0]
+            erros.extend({"linha": r["linha"], "email": r["email"], "erro": f"Falha ao gravar o lote: {motivo}"}
+                         for r in bloco)
+            continue
+        novos = sum(1 for r in bloco if r["email"] not in existentes)
+        criados += novos
+        atualizados += len(bloco) - novos
+
+    erros.sort(key=lambda e: e["linha"])
+    return {"linhas": len(linhas), "criados": criados, "atualizados": atualizados, "erros": erros,
+            "segundos": round(time.perf_counter() - inicio, 2)}
+
+
+def relatorio_csv(erros) -> str:
+    """Relatório de erros (linha;email;erro) para baixar/gravar."""
+    saida = io.StringIO()
+    escritor = csv.writer(saida, delimiter=";")
+    escritor.writerow(["linha", "email", "erro"])
+    for e in erros:
+        escritor.writerow([e["linha"], e["email"], e["erro"]])
+    return saida.getvalue()
@@ -0,0 +1,162 @@
+# kdf.py — Hash/verificação de credenciais num pool limitado, sem dependência de Flask
+# O KDF é CPU pura de propósito (centenas de ms). Aqui ele roda em poucas threads
+# dedicadas (argon2-cffi e hashlib liberam o GIL), com fila limitada: num pico de logins
+# a espera é previsível e, com a fila cheia, a recusa é imediata em vez de travar o worker.
+# Hashes antigos (PBKDF2 do werkzeug ou parâmetros desatualizados) são regravados no
+# esquema atual quando o login dá certo.
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+import metricas
+
+ESQUEMA_ARGON2 = "argon2"
+ESQUEMA_PBKDF2 = "pbkdf2"
+
+_ESPERA = metricas.REGISTRO.histograma(
+    "assinador_kdf_espera_segundos", "Espera na fila do KDF antes do cálculo.")
+_CALCULO = metricas.REGISTRO.histograma(
+    "assinador_kdf_segundos", "Tempo de cálculo do KDF (hash ou verificação).")
+_RECUSAS = metricas.REGISTRO.contador(
+    "assinador_kdf_recusas_total", "Pedidos ao KDF recusados (fila cheia ou prazo).")
+
+
+def _cronometrado(funcao, *args):
+    inicio = time.perf_counter()
+    return funcao(*args), time.perf_counter() - inicio
+
+
+class KDFOcupado(Exception):
+    """Fila de verificação cheia (ou espera além do prazo)."""
+
+
+class ServicoKDF:
+    """
+    `esquema` define o formato dos hashes novos: "argon2" (argon2id, parâmetros
+    `argon2_*`) ou "pbkdf2" (werkzeug, `pbkdf2_iteracoes`). A verificação aceita os dois.
+    """
+
+    def __init__(self, esquema: str = ESQUEMA_ARGON2, workers: int = 2, max_fila: int = 32,
+                 espera_s: float = 10.0, argon2_tempo: int = 3, argon2_memoria_kib: int = 65536,
+                 argon2_paralelismo: int = 4, pbkdf2_iteracoes: int = 600000):
+        if esquema not in (ESQUEMA_ARGON2, ESQUEMA_PBKDF2):
+            raise ValueError(f"KDF_SCHEME desconhecido: {esquema!r}")
+        from argon2 import PasswordHasher
+        self.esquema = esquema
+        self.argon2 = PasswordHasher(time_cost=argon2_tempo, memory_cost=argon2_memoria_kib,
+                                     parallelism=argon2_paralelismo)
+        self.pbkdf2_metodo = f"pbkdf2:sha256:{int(pbkdf2_iteracoes)}"
+        self.max_fila = max(1, int(max_fila))
+        self.espera_s = espera_s
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="kdf")
+        self._lock = threading.Lock()
+        self.pendentes = 0                  # na fila + em execução
+        self.recusados = 0
+
+    # ----- KDF (rodam nas threads do pool) -----
+    def _gerar(self, texto: str) -> str:
+        if self.esquema == ESQUEMA_ARGON2:
+            return self.argon2.hash(texto)
+        return generate_password_hash(texto, method=self.pbkdf2_metodo, salt_length=16)
+
+    def _precisa_regravar(self, hashval: str) -> bool:
+        if hashval.startswith("$argon2"):
+            return self.esquema != ESQUEMA_ARGON2 or self.argon2.check_needs_rehash(hashval)
+        # werkzeug: "pbkdf2:sha256:<iterações>$sal$hash"
+        return self.esquema != ESQUEMA_PBKDF2 or hashval.split("$", 1)[0] != self.pbkdf2_metodo
+
+    def _verificar(self, hashval: str, texto: str):
+        if hashval.startswith("$argon2"):
+            from argon2.exceptions import VerificationError, InvalidHashError
+            try:
+                self.argon2.verify(hashval, texto)
+            except (VerificationError, InvalidHashError):
+                return False, None
+        else:
+            try:
+                if not check_password_hash(hashval, texto):
+                    return False, None
+            except Exception:
+                return False, None
+        # senha conferida: é a única hora em que dá para regravar no esquema atual
+        return True, (self._gerar(texto) if self._precisa_regravar(hashval) else None)
+
+    # ----- fila -----
+    def _executar(self, operacao: str, funcao, *args):
+        inicio = time.perf_counter()
+        with self._lock:
+            if self.pendentes >= self.max_fila:
+                self.recusados += 1
+                _RECUSAS.inc(operacao=operacao)
+                raise KDFOcupado()
+            self.pendentes += 1
+        try:
+            futuro = self._pool.submit(_cronometrado, funcao, *args)
+        except BaseException:
+            with self._lock:
+                self.pendentes -= 1
+            raise
+        futuro.add_done_callback(self._liberar)
+        try:
+            resultado, calculo = futuro.result(timeout=self.espera_s)
+        except FuturoTimeout:
+            futuro.cancel()
+            with self._lock:
+                self.recusados += 1
+            _RECUSAS.inc(operacao=operacao)
+            raise KDFOcupado()
+        espera = max(0.0, time.perf_counter() - inicio - calculo)
+        _ESPERA.observar(espera, operacao=operacao)
+        _CALCULO.observar(calculo, operacao=operacao)
+        metricas.registrar_etapa("kdf_fila", espera)
+        metricas.registrar_etapa("kdf", calculo)
+        return resultado
+
+    def _liberar(self, _futuro):
+        with self._lock:
+            self.pendentes -= 1
+
+    # ----- API -----
+    def gerar(self, texto: str) -> str:
+        """Hash novo no esquema/parâmetros atuais."""
+        return self._executar("gerar", self._gerar, texto or "")
+
+    def verificar(self, hashval: str, texto: str):
+        """
+        (confere, hash_novo): `hash_novo` vem preenchido quando a credencial confere mas o
+        hash guardado está em esquema/parâmetros antigos. Levanta KDFOcupado com a fila cheia.
+        """
+        if not hashval:
+            return False, None
+        return self._executar("verificar", self._verificar, hashval, texto or "")
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {"esquema": self.esquema, "pendentes": self.pendentes, "recusados": self.recusados}
+
+
+def gerar_hash(config: dict, texto: str) -> str:
+    """
+    Hash avulso com as chaves KDF_* de `config`, fora do pool do serviço: função de
+    módulo para rodar em pools de processos (ex.: importação de usuários em lote).
+    """
+    if (config.get("KDF_SCHEME") or ESQUEMA_ARGON2).lower() == ESQUEMA_ARGON2:
+        from argon2 import PasswordHasher
+        return PasswordHasher(time_cost=config.get("KDF_ARGON2_TIME_COST", 3),
+                              memory_cost=config.get("KDF_ARGON2_MEMORY_KIB", 65536),
+                              parallelism=config.get("KDF_ARGON2_PARALLELISM", 4)).hash(texto)
+    return generate_password_hash(texto, salt_length=16,
+                                  method=f"pbkdf2:sha256:{int(config.get('KDF_PBKDF2_ITERATIONS', 600000))}")
+
+
+def criar_servico(config) -> ServicoKDF:
+    """Serviço conforme as chaves KDF_* de `config` (dict)."""
+    return ServicoKDF(
+        esquema=(config.get("KDF_SCHEME") or ESQUEMA_ARGON2).lower(),
+        workers=config.get("KDF_WORKERS", 2),
+        max_fila=config.get("KDF_MAX_QUEUE", 32),
+        espera_s=config.get("KDF_TIMEOUT", 10.0),
+        argon2_tempo=config.get("KDF_ARGON2_TIME_COST", 3),
+        argon2_memoria_kib=config.get("KDF_ARGON2_MEMORY_KIB", 65536),
+        argon2_paralelismo=config.get("KDF_ARGON2_PARALLELISM", 4),
+        pbkdf2_iteracoes=config.get("KDF_PBKDF2_ITERATIONS", 600000),
+    )
@@ -0,0 +1,358 @@
+# metricas.py — Métricas de desempenho no formato de texto do Prometheus, sem dependência de Flask
+# Contadores, histogramas e medidores por processo (thread-safe), mais um cronômetro por
+# etapa que decompõe cada requisição (gravação do upload, hash, QR, abertura do PDF,
+# carimbo, gravação...). Com vários workers do gunicorn, cada processo grava o seu retrato
+# numa pasta (METRICS_DIR) e quem atender o /metrics soma todos: o scrape cai num worker
+# qualquer, mas a resposta vale para o nó inteiro. O retrato de um worker que já terminou
+# (reciclado pelo gunicorn, derrubado) tem contadores e histogramas incorporados a um
+# retrato "encerrados" do host e é apagado: os totais não voltam para trás e os medidores
+# do processo morto somem.
+import bisect, glob, json, math, os, socket, tempfile, threading, time
+
+MB = 1024 * 1024
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_BYTES = (16 * 1024, 64 * 1024, 256 * 1024, 1 * MB, 4 * MB, 16 * MB, 64 * MB, 256 * MB)
+BUCKETS_PAGINAS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+CONTADOR = "counter"
+HISTOGRAMA = "histogram"
+MEDIDOR = "gauge"
+
+
+def _chave(rotulos: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in rotulos.items()))
+
+
+class Contador:
+    def __init__(self, registro, nome):
+        self._registro, self.nome = registro, nome
+
+    def inc(self, valor: float = 1, **rotulos):
+        self._registro._somar(self.nome, _chave(rotulos), valor)
+
+
+class Histograma:
+    def __init__(self, registro, nome, buckets):
+        self._registro, self.nome, self.buckets = registro, nome, buckets
+
+    def observar(self, valor: float, **rotulos):
+        self._registro._observar(self.nome, _chave(rotulos), bisect.bisect_left(self.buckets, valor), valor)
+
+
+class Registro:
+    """
+    Métricas de um processo. Séries por combinação de rótulos; os valores dos medidores
+    vêm de funções lidas na hora do retrato (ex.: orçamento em uso do governador).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metricas = {}                 # nome -> {"tipo", "ajuda", "buckets", "series"}
+        self._medidores = {}                # nome -> função () -> número ou [(rótulos, valor)]
+        self._ultima_gravacao = 0.0
+
+    def _declarar(self, nome, tipo, ajuda, buckets=None):
+        with self._lock:
+            atual = self._metricas.get(nome)
+            if atual is not None:
+                if atual["tipo"] != tipo:
+                    raise ValueError(f"Métrica {nome!r} já declarada como {atual['tipo']}")
+                return
+            self._metricas[nome] = {"tipo": tipo, "ajuda": ajuda,
+                                    "buckets": list(buckets) if buckets else None, "series": {}}
+
+    def contador(self, nome: str, ajuda: str) -> Contador:
+        self._declarar(nome, CONTADOR, ajuda)
+        return Contador(self, nome)
+
+    def histograma(self, nome: str, ajuda: str, buckets=BUCKETS_SEGUNDOS) -> Histograma:
+        buckets = tuple(sorted(buckets))
+        self._declarar(nome, HISTOGRAMA, ajuda, buckets)
+        return Histograma(self, nome, buckets)
+
+    def medidor(self, nome: str, ajuda: str, funcao):
+        """`funcao()` devolve um número ou uma lista [(rótulos, valor)]."""
+        self._declarar(nome, MEDIDOR, ajuda)
+        self._medidores[nome] = funcao
+
+    def _somar(self, nome, chave, valor):
+        with self._lock:
+            series = self._metricas[nome]["series"]
+            series[chave] = series.get(chave, 0) + valor
+
+    def _observar(self, nome, chave, indice, valor):
+        with self._lock:
+            metrica = self._metricas[nome]
+            serie = metrica["series"].get(chave)
+            if serie is None:
+                serie = metrica["series"][chave] = [[0] * (len(metrica["buckets"]) + 1), 0.0, 0]
+            serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    # ----- retrato / exposição -----
+    def retrato(self) -> dict:
+        """Estado atual serializável em JSON (o que cada worker grava em METRICS_DIR)."""
+        instancia = f"{socket.gethostname()}:{os.getpid()}"
+        medidos = {}
+        for nome, funcao in list(self._medidores.items()):
+            try:
+                valor = funcao()
+            except Exception:
+                continue                     # métrica de monitoramento não derruba a requisição
+            pares = valor if isinstance(valor, list) else [({}, valor)]
+            medidos[nome] = [[{**r, "instancia": instancia}, v] for r, v in pares]
+        with self._lock:
+            metricas = {}
+            for nome, m in self._metricas.items():
+                if m["tipo"] == MEDIDOR:
+                    series = medidos.get(nome, [])
+                elif m["tipo"] == HISTOGRAMA:
+                    series = [[dict(k), [list(s[0]), s[1], s[2]]] for k, s in m["series"].items()]
+                else:
+                    series = [[dict(k), v] for k, v in m["series"].items()]
+                metricas[nome] = {"tipo": m["tipo"], "ajuda": m["ajuda"], "buckets": m["buckets"],
+                                  "series": series}
+        return {"instancia": instancia, "metricas": metricas}
+
+    def _arquivo(self, pasta: str) -> str:
+        return os.path.join(pasta, f"metricas-{socket.gethostname()}-{os.getpid()}.json")
+
+    def gravar(self, pasta: str, intervalo_s: float = 0):
+        """Grava o retrato deste processo em `pasta` (no máximo um a cada `intervalo_s`)."""
+        agora = time.monotonic()
+        if intervalo_s and agora - self._ultima_gravacao < intervalo_s:
+            return
+        self._ultima_gravacao = agora
+        os.makedirs(pasta, exist_ok=True)
+        _gravar_json(pasta, self._arquivo(pasta), self.retrato())
+
+    def exportar(self, pasta: str = "", validade_s: float = 0) -> str:
+        """
+        Texto no formato de exposição do Prometheus (0.0.4). Com `pasta`, soma os
+        contadores/histogramas gravados pelos demais processos; os medidores saem por
+        instância (host:pid), no valor da última gravação de cada uma. Retratos de
+        processos mortos deste host são recolhidos antes (ver recolher_encerrados); de
+        outros hosts, onde não dá para consultar o PID, os medidores de um retrato sem
+        gravação há mais de `validade_s` (0 = sem limite) são ignorados.
+        """
+        retratos = [self.retrato()]
+        if pasta:
+            self.recolher_encerrados(pasta)
+            meu = self._arquivo(pasta)
+            deste_host = f"metricas-{socket.gethostname()}-"
+            limite = time.time() - validade_s
+            for caminho in glob.glob(os.path.join(pasta, "metricas-*.json")):
+                if caminho == meu:
+                    continue
+                try:
+                    with open(caminho) as f:
+                        retrato = json.load(f)
+                    velho = (validade_s and not os.path.basename(caminho).startswith(deste_host)
+                             and os.path.getmtime(caminho) < limite)
+                except (OSError, ValueError):
+                    continue                 # worker regravando ou arquivo de outra versão
+                retratos.append(_sem_medidores(retrato) if velho else retrato)
+        return _texto(_somar_retratos(retratos))
+
+    def recolher_encerrados(self, pasta: str) -> int:
+        """
+        Incorpora a metricas-<host>-encerrados.json os contadores/histogramas dos retratos
+        deste host cujo processo não existe mais e apaga esses retratos. Sob uma trava de
+        arquivo: dois workers atendendo /metrics ao mesmo tempo não somam o mesmo morto
+        duas vezes. Devolve quantos recolheu.
+        """
+        prefixo = f"metricas-{socket.gethostname()}-"
+        mortos = []
+        for caminho in glob.glob(os.path.join(pasta, f"{prefixo}*.json")):
+            pid = os.path.basename(caminho)[len(prefixo):-len(".json")]
+            if pid.isdigit() and not _pid_vivo(int(pid)):
+                mortos.append(caminho)
+        if not mortos:
+            return 0
+        import fcntl                          # só POSIX, como o gunicorn
+        destino = os.path.join(pasta, f"{prefixo}encerrados.json")
+        with open(os.path.join(pasta, ".metricas.lock"), "a") as trava:
+            fcntl.flock(trava, fcntl.LOCK_EX)
+            retratos, recolhidos = [], []
+            try:
+                with open(destino) as f:
+                    retratos.append(json.load(f))
+            except (OSError, ValueError):
+                pass                          # primeiro recolhimento (ou de outra versão)
+            for caminho in mortos:
+                try:
+                    with open(caminho) as f:
+                        retratos.append(_sem_medidores(json.load(f)))
+                except FileNotFoundError:
+                    continue                  # outro worker já recolheu
+                except ValueError:
+                    pass                      # gravação interrompida: só apaga
+                recolhidos.append(caminho)
+            if not recolhidos:
+                return 0
+            instancia = f"{socket.gethostname()}:encerrados"
+            _gravar_json(pasta, destino, _como_retrato(_somar_retratos(retratos), instancia))
+            for caminho in recolhidos:
+                os.remove(caminho)
+        return len(recolhidos)
+
+
+def _gravar_json(pasta: str, destino: str, dados: dict):
+    fd, tmp = tempfile.mkstemp(dir=pasta, prefix=".metricas-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(dados, f)
+        os.replace(tmp, destino)              # leitores nunca veem o arquivo pela metade
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _pid_vivo(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True                           # existe, só que de outro usuário
+    return True
+
+
+def _sem_medidores(retrato: dict) -> dict:
+    """O retrato sem as séries dos medidores (valores de um processo que não responde mais)."""
+    metricas = {nome: ({**m, "series": []} if m["tipo"] == MEDIDOR else m)
+                for nome, m in retrato["metricas"].items()}
+    return {**retrato, "metricas": metricas}
+
+
+def _como_retrato(total: dict, instancia: str) -> dict:
+    """Inverso de _somar_retratos: o total de volta no formato gravado em METRICS_DIR."""
+    metricas = {}
+    for nome, m in total.items():
+        series = [[dict(k), list(v) if m["tipo"] == HISTOGRAMA else v] for k, v in m["series"].items()]
+        metricas[nome] = {"tipo": m["tipo"], "ajuda": m["ajuda"], "buckets": m["buckets"],
+                          "series": series}
+    return {"instancia": instancia, "metricas": metricas}
+
+
+def _somar_retratos(retratos) -> dict:
+    total = {}
+    for retrato in retratos:
+        for nome, m in retrato["metricas"].items():
+            alvo = total.setdefault(nome, {"tipo": m["tipo"], "ajuda": m["ajuda"],
+                                           "buckets": m["buckets"], "series": {}})
+            if alvo["tipo"] != m["tipo"] or alvo["buckets"] != m["buckets"]:
+                continue                     # versão diferente do código em outro worker
+            for rotulos, valor in m["series"]:
+                chave = _chave(rotulos)
+                atual = alvo["series"].get(chave)
+                if m["tipo"] != HISTOGRAMA:
+                    alvo["series"][chave] = (atual or 0) + valor
+                elif atual is None:
+                    alvo["series"][chave] = [list(valor[0]), valor[1], valor[2]]
+                else:
+                    atual[0] = [a + b for a, b in zip(atual[0], valor[0])]
+                    atual[1] += valor[1]
+                    atual[2] += valor[2]
+    return total
+
+
+def _escapar(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _rotulos(chave, extra=()) -> str:
+    pares = list(chave) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}"
+
+
+def _numero(valor) -> str:
+    if isinstance(valor, float):
+        if math.isinf(valor):
+            return "+Inf" if valor > 0 else "-Inf"
+        return repr(valor)
+    return str(valor)
+
+
+def _texto(metricas: dict) -> str:
+    linhas = []
+    for nome in sorted(metricas):
+        m = metricas[nome]
+        linhas.append(f"# HELP {nome} {m['ajuda']}")
+        linhas.append(f"# TYPE {nome} {m['tipo']}")
+        for chave in sorted(m["series"]):
+            valor = m["series"][chave]
+            if m["tipo"] != HISTOGRAMA:
+                linhas.append(f"{nome}{_rotulos(chave)} {_numero(valor)}")
+                continue
+            contagens, soma, total = valor
+            acumulado = 0
+            for limite, n in zip(list(m["buckets"]) + [math.inf], contagens):
+                acumulado += n
+                linhas.append(f"{nome}_bucket{_rotulos(chave, [('le', _numero(float(limite)))])} {acumulado}")
+            linhas.append(f"{nome}_sum{_rotulos(chave)} {_numero(float(soma))}")
+            linhas.append(f"{nome}_count{_rotulos(chave)} {total}")
+    return "\n".join(linhas) + "\n"
+
+
+# ---------- Cronômetro por etapa ----------
+class Cronometro:
+    """Tempo acumulado por etapa (segundos), na ordem em que as etapas apareceram."""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.etapas = {}
+
+    def somar(self, etapa: str, segundos: float):
+        self.etapas[etapa] = self.etapas.get(etapa, 0.0) + segundos
+
+    def decorrido(self) -> float:
+        return time.perf_counter() - self.inicio
+
+    def resumo(self) -> str:
+        """Ex.: "upload=12ms abrir=40ms carimbo=85ms gravar=30ms"."""
+        return " ".join(f"{k}={1000 * v:.0f}ms" for k, v in self.etapas.items()) or "-"
+
+
+_local = threading.local()
+
+
+def ativar(cronometro):
+    """Torna `cronometro` (ou None) o ativo nesta thread; devolve o anterior."""
+    anterior = getattr(_local, "cronometro", None)
+    _local.cronometro = cronometro
+    return anterior
+
+
+def registrar_etapa(etapa: str, segundos: float):
+    """Soma `segundos` à etapa no cronômetro ativo desta thread (sem cronômetro, nada)."""
+    cronometro = getattr(_local, "cronometro", None)
+    if cronometro is not None:
+        cronometro.somar(etapa, segundos)
+
+
+class etapa:
+    """
+    `with metricas.etapa("abrir"): ...` cronometra o bloco no cronômetro ativo da thread.
+    Sem cronômetro ativo custa só um getattr: pode ficar no caminho quente.
+    """
+    __slots__ = ("nome", "_inicio")
+
+    def __init__(self, nome: str):
+        self.nome = nome
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        registrar_etapa(self.nome, time.perf_counter() - self._inicio)
+        return False
+
+
+REGISTRO = Registro()
@@ -28,6 +28,10 @@ class User(db.Model):
     updated_at  = db.Column(db.DateTime(timezone=True), server_default=func.now(),
                             onupdate=func.now(), nullable=False)
 
+    # listagem paginada por (created_at, id); os índices trigram da busca ficam no
+    # esquema do Postgres (db_init/assinador_dump.sql)
+    __table_args__ = (db.Index("ix_users_created_at_id", "created_at", "id"),)
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -45,3 +49,145 @@ class User(db.Model):
 
     def __repr__(self):
         return f"<User {self.email}>"
+
+
+class SignedDocument(db.Model):
+    """Registro de cada documento assinado (consulta por CRC/SHA-256 sem varrer a pasta)."""
+    __tablename__ = "signed_documents"
+
+    id              = db.Column(db.Integer, primary_key=True)
+    crc             = db.Column(db.String(16), unique=True, nullable=False, index=True)
+    sha256          = db.Column(db.String(64), unique=True, nullable=False, index=True)  # arquivo final assinado
+    original_sha256 = db.Column(db.String(64), index=True)                               # upload original (nulo p/ legados)
+
+    filename        = db.Column(db.String(255), nullable=False)   # ex.: assinado_<nome>_<crc>.pdf
+    stored_path     = db.Column(db.String(512), nullable=False)   # relativo a app.root_path
+    size_bytes      = db.Column(db.BigInteger, nullable=False)
+    file_mtime      = db.Column(db.Float)                         # junto com size_bytes, detecta arquivo alterado
+
+    signer_email    = db.Column(db.String(255))
+    signer_nome     = db.Column(db.String(255))
+    processo        = db.Column(db.String(120))
+
+    signed_at       = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    def __repr__(self):
+        return f"<SignedDocument {self.crc}>"
+
+
+class LoginAttempt(db.Model):
+    """Falhas de login por e-mail|IP (LOGIN_RATE_BACKEND=banco: compartilhado entre workers)."""
+    __tablename__ = "login_attempts"
+
+    key             = db.Column(db.String(320), primary_key=True)             # e-mail|IP
+    count           = db.Column(db.Integer, nullable=False, default=0)        # falhas na janela
+    lock_until      = db.Column(db.Float, nullable=False, default=0)          # epoch (s)
+    expires_at      = db.Column(db.Float, nullable=False, index=True)         # epoch (s)
+
+    def __repr__(self):
+        return f"<LoginAttempt {self.key} {self.count}>"
+
+
+class SigningJob(db.Model):
+    """Pedido de assinatura na fila (processado por `flask worker-assinatura`)."""
+    __tablename__ = "signing_jobs"
+
+    id              = db.Column(db.String(32), primary_key=True)              # uuid4 hex
+    status          = db.Column(db.String(16), nullable=False, default="pendente", index=True)
+    progresso       = db.Column(db.Integer, nullable=False, default=0)        # 0..100
+    params          = db.Column(db.JSON, nullable=False)                      # entrada de stamping.carimbar()
+
+    user_email      = db.Column(db.String(255), index=True)
+    signatario      = db.Column(db.JSON)                                      # dict da sessão no momento do pedido
+    original_sha256 = db.Column(db.String(64))
+    filename        = db.Column(db.String(255), nullable=False)
+    processo        = db.Column(db.String(120))
+
+    sha256          = db.Column(db.String(64))                                # preenchido ao concluir
+    erro            = db.Column(db.Text)
+
+    created_at      = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+    started_at      = db.Column(db.DateTime(timezone=True))
+    finished_at     = db.Column(db.DateTime(timezone=True))
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progresso": self.progresso,
+            "arquivo": self.filename,
+            "sha256": self.sha256,
+            "erro": self.erro,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f"<SigningJob {self.id} {self.status}>"
+
+
+class SigningRequestKey(db.Model):
+    """
+    Chave de idempotência de um pedido de assinatura: hash do original + signatário +
+    posição + textos do carimbo. Um pedido repetido dentro da janela recebe o mesmo
+    arquivo assinado (ou o mesmo pedido da fila) sem carimbar de novo.
+    """
+    __tablename__ = "signing_request_keys"
+
+    key             = db.Column(db.String(64), primary_key=True)              # sha256 dos dados do pedido
+    crc             = db.Column(db.String(16), nullable=False)
+    filename        = db.Column(db.String(255), nullable=False)
+    sha256          = db.Column(db.String(64))                                # assinado (após carimbar)
+    job_id          = db.Column(db.String(32))                                # pedido da fila, se assíncrono
+
+    created_at      = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<SigningRequestKey {self.key[:10]} {self.crc}>"
+
+
+class DocumentMetadata(db.Model):
+    """Pré-análise de um upload (páginas, tamanhos, rotação...), calculada uma vez por conteúdo."""
+    __tablename__ = "document_metadata"
+
+    sha256          = db.Column(db.String(64), primary_key=True)              # conteúdo do upload
+    tipo            = db.Column(db.String(8), nullable=False)                 # "pdf" | "imagem"
+    size_bytes      = db.Column(db.BigInteger, nullable=False)
+    page_count      = db.Column(db.Integer, nullable=False, default=1)
+    encrypted       = db.Column(db.Boolean, nullable=False, default=False)
+    pages           = db.Column(db.JSON)                                      # [{"w","h","rotacao","mediabox"}]
+    width           = db.Column(db.Integer)                                   # imagens (px)
+    height          = db.Column(db.Integer)
+
+    created_at      = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    def to_dict(self):
+        return {
+            "sha256": self.sha256,
+            "tipo": self.tipo,
+            "size_bytes": self.size_bytes,
+            "paginas": self.page_count,
+            "encrypted": self.encrypted,
+            "tamanhos": self.pages or [],
+            "width": self.width,
+            "height": self.height,
+        }
+
+    def __repr__(self):
+        return f"<DocumentMetadata {self.sha256[:10]} {self.tipo}>"
+
+
+class StoredBlob(db.Model):
+    """Arquivo no armazém endereçado por conteúdo, com contagem de referências."""
+    __tablename__ = "stored_blobs"
+
+    sha256          = db.Column(db.String(64), primary_key=True)
+    size_bytes      = db.Column(db.BigInteger, nullable=False)
+    refcount        = db.Column(db.Integer, nullable=False, default=0)        # registros que apontam para ele
+
+    created_at      = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at      = db.Column(db.DateTime(timezone=True), server_default=func.now(),
+                                onupdate=func.now(), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<StoredBlob {self.sha256[:10]} refs={self.refcount}>"
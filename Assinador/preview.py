@@ -0,0 +1,125 @@
+# preview.py — Pré-análise e pré-visualização de uploads (PyMuPDF + PIL), sem dependência de Flask
+# O navegador recebe só a página que está mostrando, já rasterizada na largura da tela,
+# em vez de baixar e renderizar o PDF inteiro com pdf.js.
+import os, threading
+from PIL import Image
+import fitz  # PyMuPDF
+from stamping import EXIF_ORIENTACAO, trava_fitz  # fitz não aceita threads simultâneas
+
+PREVIEW_MIN_WIDTH = 100
+PREVIEW_MAX_WIDTH = int(os.environ.get("PREVIEW_MAX_WIDTH", "2000"))
+
+
+def analisar_documento(caminho: str, extensao: str) -> dict:
+    """
+    Pré-análise feita uma vez na entrada do upload: páginas, tamanho (pt, já com a
+    rotação), rotação e mediabox de cada página e se o PDF é criptografado; para
+    JPG/PNG, as dimensões em px (só o cabeçalho é lido).
+    """
+    info = {"size_bytes": os.path.getsize(caminho)}
+    if extensao in (".jpg", ".jpeg", ".png"):
+        with Image.open(caminho) as img:
+            largura, altura = img.size
+            if img.getexif().get(EXIF_ORIENTACAO, 1) in (5, 6, 7, 8):  # como o navegador exibe
+                largura, altura = altura, largura
+        info.update(tipo="imagem", page_count=1, encrypted=False, pages=None,
+                    width=largura, height=altura)
+        return info
+
+    with trava_fitz(), fitz.open(caminho) as doc:
+        info.update(
+            tipo="pdf",
+            page_count=doc.page_count,
+            encrypted=bool(doc.is_encrypted or doc.needs_pass),
+            pages=[
+                {"w": round(p.rect.width, 2), "h": round(p.rect.height, 2), "rotacao": p.rotation,
+                 "mediabox": [round(v, 2) for v in p.mediabox]}
+                for p in doc
+            ],
+            width=None, height=None,
+        )
+    return info
+
+
+def largura_valida(largura) -> int:
+    try:
+        largura = int(largura)
+    except (TypeError, ValueError):
+        largura = 1100
+    return max(PREVIEW_MIN_WIDTH, min(PREVIEW_MAX_WIDTH, largura))
+
+
+def _caminho_cache(cache_dir: str, sha256_hex: str, page_num: int, largura: int, rotacao: int) -> str:
+    # (hash, página, largura, rotação); subpasta pelos 2 primeiros dígitos do hash
+    return os.path.join(cache_dir, sha256_hex[:2],
+                        f"{sha256_hex}_p{page_num}_w{largura}_r{rotacao}.png")
+
+
+def pagina_em_cache(cache_dir: str, sha256_hex: str, page_num: int, largura: int, rotacao: int):
+    """Caminho do PNG já renderizado (marcando uso recente), ou None."""
+    destino = _caminho_cache(cache_dir, sha256_hex, page_num, largura_valida(largura), rotacao)
+    if os.path.isfile(destino):
+        os.utime(destino)  # marca uso recente (poda por LRU)
+        return destino
+    return None
+
+
+def renderizar_pagina(origem: str, sha256_hex: str, page_num: int, largura: int,
+                      cache_dir: str, rotacao: int = None) -> str:
+    """
+    PNG da página `page_num` (1-based) com `largura` px, respeitando a rotação da
+    página (igual ao viewport do pdf.js). Reaproveita o render em disco se já existir;
+    com `rotacao` conhecida (pré-análise), o acerto no cache nem abre o PDF.
+    Devolve o caminho do PNG.
+    """
+    largura = largura_valida(largura)
+    if rotacao is not None:
+        destino = pagina_em_cache(cache_dir, sha256_hex, page_num, largura, rotacao)
+        if destino:
+            return destino
+
+    with trava_fitz(), fitz.open(origem) as doc:
+        if not 1 <= page_num <= doc.page_count:
+            raise IndexError(f"Página {page_num} inexistente (documento com {doc.page_count}).")
+        page = doc.load_page(page_num - 1)
+        destino = _caminho_cache(cache_dir, sha256_hex, page_num, largura, page.rotation)
+        if os.path.isfile(destino):
+            os.utime(destino)
+            return destino
+
+        zoom = largura / page.rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        tmp = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pix.save(tmp, output="png")
+    os.replace(tmp, destino)
+    return destino
+
+
+def podar_cache(cache_dir: str, limite_bytes: int) -> int:
+    """Remove os renders usados há mais tempo até o cache caber em `limite_bytes`. Devolve quantos saíram."""
+    arquivos = []
+    total = 0
+    for raiz, _, nomes in os.walk(cache_dir):
+        for nome in nomes:
+            if not nome.endswith(".png"):
+                continue
+            caminho = os.path.join(raiz, nome)
+            try:
+                st = os.stat(caminho)
+            except OSError:
+                continue
+            arquivos.append((st.st_mtime, st.st_size, caminho))
+            total += st.st_size
+    removidos = 0
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= limite_bytes:
+            break
+        try:
+            os.remove(caminho)
+        except OSError:
+            continue
+        total -= tamanho
+        removidos += 1
+    return removidos
@@ -0,0 +1,205 @@
+# ratelimit.py — Contagem de tentativas de login com expiração, sem dependência de Flask
+# Cada chave (e-mail|IP) acumula falhas numa janela; ao chegar no máximo, fica bloqueada
+# por um tempo. Três backends com a mesma interface:
+#   memória  — um processo só (TTL + LRU com teto de chaves: não cresce sem limite);
+#   banco    — tabela compartilhada por todos os workers/nós (SQLite ou Postgres);
+#   redis    — servidor Redis (ou compatível), INCR/EXPIRE atômicos.
+import threading, time
+from collections import OrderedDict
+from itertools import islice
+
+
+class LimiteTentativas:
+    """
+    Interface comum. `max_tentativas` falhas dentro de `janela_s` bloqueiam a chave por
+    `bloqueio_s`; a contagem de uma chave sem falhas novas expira com a janela.
+    """
+
+    def __init__(self, max_tentativas: int, bloqueio_s: int, janela_s: int):
+        self.max_tentativas = max(1, int(max_tentativas))
+        self.bloqueio_s = int(bloqueio_s)
+        self.janela_s = int(janela_s)
+
+    def bloqueado(self, chave: str) -> int:
+        """Segundos de bloqueio restantes (0 = liberada)."""
+        raise NotImplementedError
+
+    def falhou(self, chave: str) -> int:
+        """Registra uma falha; devolve os segundos de bloqueio se esta falha bloqueou, senão 0."""
+        raise NotImplementedError
+
+    def limpar(self, chave: str):
+        """Login bem-sucedido: esquece a chave."""
+        raise NotImplementedError
+
+
+class LimiteMemoria(LimiteTentativas):
+    """
+    Dicionário do processo com expiração e teto de `max_chaves`: as entradas vencidas
+    saem a cada escrita e, no teto, sai a atualizada há mais tempo entre as que não estão
+    bloqueadas. Um bloqueio em vigor nunca sai antes da hora (senão uma rajada de chaves
+    novas o derrubaria); se só restarem bloqueios, o teto é excedido até eles vencerem.
+    Cada worker conta por si — para vários workers use o banco ou o Redis.
+    """
+
+    def __init__(self, max_tentativas, bloqueio_s, janela_s, max_chaves: int = 10000):
+        super().__init__(max_tentativas, bloqueio_s, janela_s)
+        self.max_chaves = max(1, int(max_chaves))
+        self._lock = threading.Lock()
+        self._chaves = OrderedDict()        # chave -> [falhas, bloqueio_ate, expira_em]
+
+    def _podar(self, agora: float):
+        while self._chaves:
+            _, (_, _, expira) = next(iter(self._chaves.items()))
+            if expira > agora:
+                break
+            self._chaves.popitem(last=False)
+        if len(self._chaves) <= self.max_chaves:
+            return
+        # no teto: primeiro todas as vencidas, depois as mais antigas sem bloqueio ativo
+        for chave in [c for c, e in self._chaves.items() if e[2] <= agora]:
+            del self._chaves[chave]
+        excesso = len(self._chaves) - self.max_chaves
+        if excesso > 0:
+            livres = (c for c, e in self._chaves.items() if e[1] <= agora)
+            for chave in list(islice(livres, excesso)):
+                del self._chaves[chave]
+
+    def bloqueado(self, chave):
+        agora = time.time()
+        with self._lock:
+            entrada = self._chaves.get(chave)
+            return max(0, int(entrada[1] - agora + 0.999)) if entrada else 0
+
+    def falhou(self, chave):
+        agora = time.time()
+        with self._lock:
+            entrada = self._chaves.pop(chave, None)
+            if entrada is None or entrada[2] <= agora:
+                entrada = [0, 0.0, 0.0]
+            entrada[0] += 1
+            entrada[2] = agora + self.janela_s
+            bloqueio = 0
+            if entrada[0] >= self.max_tentativas:
+                entrada[0] = 0
+                entrada[1] = agora + self.bloqueio_s
+                entrada[2] = max(entrada[2], entrada[1])
+                bloqueio = self.bloqueio_s
+            self._chaves[chave] = entrada      # volta ao fim (mais recente)
+            self._podar(agora)
+            return bloqueio
+
+    def limpar(self, chave):
+        with self._lock:
+            self._chaves.pop(chave, None)
+
+
+class LimiteBanco(LimiteTentativas):
+    """
+    Tabela compartilhada (ver models.LoginAttempt), só com SQL atômico: o incremento é
+    um UPDATE count = count + 1 e o bloqueio é aplicado por um único UPDATE condicional,
+    então workers concorrentes não perdem falhas nem bloqueiam duas vezes.
+    As linhas vencidas são apagadas no máximo uma vez por minuto por processo.
+    """
+
+    def __init__(self, max_tentativas, bloqueio_s, janela_s, engine, tabela):
+        super().__init__(max_tentativas, bloqueio_s, janela_s)
+        self.engine = engine
+        self.t = tabela
+        self._ultima_poda = 0.0
+
+    def _podar(self, agora: float):
+        if time.monotonic() - self._ultima_poda < 60:
+            return
+        self._ultima_poda = time.monotonic()
+        with self.engine.begin() as con:
+            con.execute(self.t.delete().where(self.t.c.expires_at < agora))
+
+    def bloqueado(self, chave):
+        agora = time.time()
+        with self.engine.connect() as con:
+            bloqueio_ate = con.execute(
+                self.t.select().with_only_columns(self.t.c.lock_until).where(self.t.c.key == chave)
+            ).scalar()
+        return max(0, int((bloqueio_ate or 0) - agora + 0.999))
+
+    def falhou(self, chave):
+        from sqlalchemy import case
+        from sqlalchemy.exc import IntegrityError
+        agora = time.time()
+        t = self.t
+        incremento = (t.update().where(t.c.key == chave)
+                      .values(count=case((t.c.expires_at > agora, t.c.count + 1), else_=1),
+                              expires_at=agora + self.janela_s))
+        with self.engine.begin() as con:
+            atualizadas = con.execute(incremento).rowcount
+        if not atualizadas:
+            try:
+                with self.engine.begin() as con:
+                    con.execute(t.insert().values(key=chave, count=1, lock_until=0.0,
+                                                  expires_at=agora + self.janela_s))
+            except IntegrityError:
+                # outra requisição criou a linha entre o UPDATE e o INSERT
+                with self.engine.begin() as con:
+                    con.execute(incremento)
+
+        # só uma das requisições concorrentes que passarem do máximo aplica o bloqueio
+        fim = agora + self.bloqueio_s
+        with self.engine.begin() as con:
+            bloqueou = con.execute(
+                t.update().where(t.c.key == chave, t.c.count >= self.max_tentativas)
+                .values(count=0, lock_until=fim, expires_at=max(fim, agora + self.janela_s))
+            ).rowcount
+        self._podar(agora)
+        return self.bloqueio_s if bloqueou else 0
+
+    def limpar(self, chave):
+        with self.engine.begin() as con:
+            con.execute(self.t.delete().where(self.t.c.key == chave))
+
+
+class LimiteRedis(LimiteTentativas):
+    """Redis (ou compatível: Valkey, KeyDB, Dragonfly): contador com TTL e chave de bloqueio."""
+
+    def __init__(self, max_tentativas, bloqueio_s, janela_s, url: str, prefixo: str = "login:"):
+        try:
+            import redis
+        except ImportError as e:  # dependência só deste backend
+            raise RuntimeError("LOGIN_RATE_BACKEND=redis requer o pacote redis.") from e
+        super().__init__(max_tentativas, bloqueio_s, janela_s)
+        self.r = redis.Redis.from_url(url)
+        self.prefixo = prefixo
+
+    def bloqueado(self, chave):
+        return max(0, self.r.ttl(f"{self.prefixo}{chave}:bloqueio"))
+
+    def falhou(self, chave):
+        contador = f"{self.prefixo}{chave}:falhas"
+        pipe = self.r.pipeline()
+        pipe.incr(contador)
+        pipe.expire(contador, self.janela_s)
+        falhas, _ = pipe.execute()
+        if falhas < self.max_tentativas:
+            return 0
+        # SET NX: só a primeira requisição que passar do máximo bloqueia
+        if self.r.set(f"{self.prefixo}{chave}:bloqueio", 1, ex=self.bloqueio_s, nx=True):
+            self.r.delete(contador)
+            return self.bloqueio_s
+        return 0
+
+    def limpar(self, chave):
+        self.r.delete(f"{self.prefixo}{chave}:falhas", f"{self.prefixo}{chave}:bloqueio")
+
+
+def criar_limite(config, engine=None, tabela=None) -> LimiteTentativas:
+    """Backend conforme LOGIN_RATE_BACKEND ("memoria" | "banco" | "redis") e demais chaves de `config`."""
+    backend = (config.get("LOGIN_RATE_BACKEND") or "memoria").lower()
+    comuns = (config.get("MAX_LOGIN_ATTEMPTS", 5), config.get("LOCKOUT_SECONDS", 150),
+              config.get("LOGIN_RATE_WINDOW", 900))
+    if backend == "memoria":
+        return LimiteMemoria(*comuns, max_chaves=config.get("LOGIN_RATE_MAX_KEYS", 10000))
+    if backend == "banco":
+        return LimiteBanco(*comuns, engine=engine, tabela=tabela)
+    if backend == "redis":
+        return LimiteRedis(*comuns, url=config["LOGIN_RATE_REDIS_URL"])
+    raise ValueError(f"LOGIN_RATE_BACKEND desconhecido: {backend!r}")
@@ -0,0 +1,720 @@
+# stamping.py — Carimbo de assinatura em PDF/imagem (PyMuPDF + PIL), sem dependência de Flask
+# Tudo aqui recebe/devolve tipos simples para poder rodar tanto na requisição
+# quanto em processos do pool da fila de assinatura.
+import os, io, textwrap, hashlib, shutil, threading, time
+from contextlib import contextmanager
+from functools import lru_cache
+import qrcode
+from qrcode.constants import ERROR_CORRECT_Q, ERROR_CORRECT_H
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+import fitz  # PyMuPDF
+import metricas
+from metricas import etapa
+
+BRASAO_PATH = "static/brasao/brasao.png"
+BRASAO_IMG_SIZE = (35, 50)  # brasão no carimbo de imagens (px)
+FONTE_REGULAR_PATH = "static/fonts/DejaVuSans.ttf"
+FONTE_BOLD_PATH    = "static/fonts/DejaVuSans-Bold.ttf"
+PDF_EXTS    = (".pdf",)
+IMAGEM_EXTS = (".jpg", ".jpeg", ".png")
+
+# Gravação do PDF carimbado: "incremental" (anexa o carimbo ao original) ou "completo"
+PDF_SAVE_INCREMENTAL = "incremental"
+PDF_SAVE_COMPLETO    = "completo"
+
+# Otimização do PDF gerado (etapa opcional depois do carimbo, política por implantação):
+# "" desligada; "estrutura" (sem perdas: coleta de objetos órfãos, deduplicação de
+# streams, deflate de conteúdo/imagens/fontes, object streams); "imagens" (estrutura +
+# reamostra para JPEG as imagens exibidas acima de um DPI)
+PDF_OTIMIZAR_ESTRUTURA = "estrutura"
+PDF_OTIMIZAR_IMAGENS   = "imagens"
+# imagens menores que isso (px) não são reamostradas: QR e brasão do carimbo, ícones
+PDF_OTIMIZAR_MIN_PIXELS = 512 * 512
+
+# O PyMuPDF não aceita uso simultâneo por várias threads: com workers gthread, todo uso de
+# fitz no processo (carimbo, otimização, análise e render da pré-visualização) passa por
+# esta trava. Processos do pool têm a sua, sem disputa.
+FITZ_LOCK = threading.RLock()
+
+
+@contextmanager
+def trava_fitz():
+    """Uso exclusivo do fitz neste processo; a espera entra na etapa "fitz_espera"."""
+    inicio = time.perf_counter()
+    with FITZ_LOCK:
+        metricas.registrar_etapa("fitz_espera", time.perf_counter() - inicio)
+        yield
+
+# QRs renderizados mantidos em memória (por processo)
+QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE", "64"))
+
+# --- CONFIGS de quebra e fontes ---
+STATUS_WRAP_CHARS = 32  # limite de caracteres por linha do STATUS
+
+
+def sha256_of_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8192), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_qr_image(data: str, box_size: int = 12, border: int = 8, strong: bool = True):
+    """
+    Gera QR nítido com quiet zone maior.
+    - box_size: pixels por módulo (maior = mais nítido ao reduzir fisicamente)
+    - border:   quiet zone em módulos (>=4 recomendado; usamos 8 para garantir)
+    """
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=ERROR_CORRECT_H if strong else ERROR_CORRECT_Q,
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    # Preto puro em fundo branco, sem alpha e sem downscale
+    return qr.make_image(fill_color="black", back_color="white").convert("RGB")
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_png_bytes(url: str, box_size: int = 6, border: int = 4, strong: bool = True) -> bytes:
+    """
+    QR já codificado em PNG, gerado em memória (nada vai para static/).
+    Cache LRU por (url, box_size, border, ecc): a URL de verificação costuma ser a
+    mesma em todas as assinaturas, então o QR é gerado uma vez por processo.
+    Padrão: QR pequeno do carimbo (~50x50).
+    """
+    buf = io.BytesIO()
+    make_qr_image(url, box_size=box_size, border=border, strong=strong).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# ---------- Recursos fixos da implantação (carregados uma vez por processo) ----------
+@lru_cache(maxsize=None)
+def brasao_png_bytes() -> bytes:
+    with open(BRASAO_PATH, "rb") as f:
+        return f.read()
+
+@lru_cache(maxsize=None)
+def brasao_pixmap() -> fitz.Pixmap:
+    """Brasão já decodificado para o PyMuPDF (evita reler/decodificar o PNG a cada carimbo)."""
+    return fitz.Pixmap(brasao_png_bytes())
+
+@lru_cache(maxsize=None)
+def brasao_pdf() -> fitz.Document:
+    """
+    Brasão num PDF de uma página, com a imagem já comprimida: cada carimbo só copia o
+    stream (show_pdf_page) em vez de recomprimir o pixmap. Somente leitura, sob trava_fitz.
+    """
+    pix = brasao_pixmap()
+    doc = fitz.open()
+    page = doc.new_page(width=pix.width, height=pix.height)
+    page.insert_image(page.rect, pixmap=pix)
+    return fitz.open("pdf", doc.tobytes(garbage=1, deflate=True))
+
+@lru_cache(maxsize=8)
+def brasao_rgba(size=BRASAO_IMG_SIZE) -> Image.Image:
+    """Brasão redimensionado em RGBA para o carimbo de imagens (somente leitura)."""
+    return Image.open(io.BytesIO(brasao_png_bytes())).resize(size).convert("RGBA")
+
+@lru_cache(maxsize=16)
+def fontes_carimbo(size_normal: int = 12, size_bold: int = 18):
+    """(fonte, fonte_negrito) do carimbo de imagens, com fallback para a fonte padrão do PIL."""
+    try:
+        fonte = ImageFont.truetype(FONTE_REGULAR_PATH, size=size_normal)
+        fonte_b = ImageFont.truetype(FONTE_BOLD_PATH, size=size_bold)
+    except Exception:
+        fonte = ImageFont.load_default()
+        fonte_b = ImageFont.load_default()
+    return fonte, fonte_b
+
+def precarregar():
+    """
+    Aquece os recursos fixos (brasão, fontes). Chamado no import do app (início de
+    cada worker web) e como initializer dos pools de processos.
+    """
+    brasao_pdf()
+    brasao_rgba()
+    fontes_carimbo()
+
+
+def montar_linhas(nome, cpf_masked, matricula, orgao, processo, datahora, crc):
+    """Linhas do carimbo (o STATUS é desenhado à parte, logo após o órgão)."""
+    linhas = [
+        "Assinado eletrônicamente por",
+        f"{nome}",
+        f"{cpf_masked}",
+        (f"Matrícula: {matricula}" if matricula else ""),
+        f"{orgao}",
+        # (STATUS será renderizado JÁ JÁ, aqui logo após o órgão)
+    ]
+
+    if processo:
+        linhas.append(f"Processo n°: {processo}")
+
+    linhas.extend([
+        f"em: {datahora}",
+        f"CRC: {crc}",
+    ])
+
+    return [l for l in linhas if l and l.strip()]
+
+
+def abrir_pdf_para_carimbo(origem, destino, modo=PDF_SAVE_INCREMENTAL):
+    """
+    Abre o documento que vai receber o carimbo. Devolve (doc, incremental).
+    No modo incremental o original é copiado para `destino` e o carimbo é anexado
+    como atualização incremental: os bytes originais ficam intactos como prefixo
+    e só o carimbo (alguns KB) é escrito. Se o PDF não permitir (ex.: foi reparado
+    na abertura ou está criptografado), cai para a regravação completa.
+    """
+    if modo == PDF_SAVE_INCREMENTAL:
+        shutil.copyfile(origem, destino)
+        doc = fitz.open(destino)
+        if doc.can_save_incrementally() and not doc.is_encrypted:
+            return doc, True
+        doc.close()
+    return fitz.open(origem), False
+
+
+def salvar_pdf_carimbado(doc, destino, incremental):
+    if incremental:
+        # deflate só afeta os objetos novos (carimbo); o original não é reescrito
+        doc.save(doc.name, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=True)
+    else:
+        doc.save(destino, garbage=1, deflate=True)
+    doc.close()
+
+
+def _exibicao_imagens(doc):
+    """xref -> (largura, altura, página): maior tamanho (pt) em que a imagem aparece."""
+    exibicao = {}
+    for page in doc:
+        for info in page.get_images(full=True):
+            xref = info[0]
+            for r in page.get_image_rects(xref):
+                lw, lh, pno = exibicao.get(xref, (0.0, 0.0, page.number))
+                exibicao[xref] = (max(lw, r.width), max(lh, r.height), pno)
+    return exibicao
+
+
+def reduzir_imagens(doc, dpi_max: float, dpi_alvo: float, qualidade: int = 80) -> int:
+    """
+    Reamostra para `dpi_alvo` (JPEG) as imagens exibidas acima de `dpi_max`, pelo maior
+    tamanho em que aparecem. Ficam como estão: imagens pequenas (QR, brasão), com
+    máscara/transparência, de 1 bit (digitalizações P&B já compactas) e as que não
+    diminuiriam. Devolve quantas mudaram.
+    """
+    reduzidas = 0
+    for xref, (larg_pt, alt_pt, pno) in _exibicao_imagens(doc).items():
+        if larg_pt <= 0 or alt_pt <= 0:
+            continue
+        mascara = any(doc.xref_get_key(xref, k)[0] != "null" for k in ("SMask", "Mask"))
+        if mascara or doc.xref_get_key(xref, "BitsPerComponent")[1] == "1":
+            continue
+        largura_px = int(doc.xref_get_key(xref, "Width")[1] or 0)
+        altura_px = int(doc.xref_get_key(xref, "Height")[1] or 0)
+        if largura_px * altura_px < PDF_OTIMIZAR_MIN_PIXELS:
+            continue
+        pix = fitz.Pixmap(doc, xref)
+        dpi = min(pix.width / (larg_pt / 72.0), pix.height / (alt_pt / 72.0))
+        if dpi <= dpi_max:
+            continue
+        if pix.alpha or pix.n not in (1, 3):  # CMYK, indexada... → RGB
+            pix = fitz.Pixmap(fitz.csRGB, pix, 0)
+        img = Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples)
+        fator = dpi_alvo / dpi
+        img = img.resize((max(1, round(pix.width * fator)), max(1, round(pix.height * fator))),
+                         Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=qualidade, optimize=True)
+        if buf.tell() >= len(doc.xref_stream_raw(xref) or b""):
+            continue
+        doc[pno].replace_image(xref, stream=buf.getvalue())
+        reduzidas += 1
+    return reduzidas
+
+
+def otimizar_pdf(caminho: str, modo: str, dpi_max: float = 200, dpi_alvo: float = 150,
+                 qualidade: int = 80) -> dict:
+    """
+    Etapa opcional depois do carimbo: regrava `caminho` compactado (ver PDF_OTIMIZAR_*).
+    O resultado só substitui o arquivo se ficar menor; senão o carimbado fica como está
+    (inclusive a gravação incremental). Devolve o relatório de tamanho/tempo.
+    """
+    inicio = time.perf_counter()
+    antes = os.path.getsize(caminho)
+    tmp = f"{caminho}.otm"
+    imagens = 0
+    with fitz.open(caminho) as doc:
+        if modo == PDF_OTIMIZAR_IMAGENS and not doc.is_encrypted:
+            imagens = reduzir_imagens(doc, dpi_max, dpi_alvo, qualidade)
+        # garbage=4: remove órfãos, junta objetos e streams idênticos
+        doc.save(tmp, garbage=4, deflate=True, deflate_images=True, deflate_fonts=True,
+                 use_objstms=1, encryption=fitz.PDF_ENCRYPT_KEEP)
+    depois = os.path.getsize(tmp)
+    if depois < antes:
+        os.replace(tmp, caminho)
+    else:
+        os.remove(tmp)
+        depois = antes
+    return {"modo": modo, "bytes_antes": antes, "bytes_depois": depois, "imagens_reduzidas": imagens,
+            "ms": round((time.perf_counter() - inicio) * 1000, 1)}
+
+
+def resolver_paginas(spec: str, total: int, padrao: int):
+    """
+    Páginas (1-based, ordenadas) a carimbar. Vazio = só `padrao`.
+    Aceita "todas", "primeira", "ultima", números e intervalos, separados por
+    vírgula: ex. "1-3,5", "2-ultima", "ultima".
+    """
+    spec = (spec or "").strip().lower()
+    if not spec:
+        return [padrao]
+
+    def _numero(tok):
+        tok = tok.strip()
+        if tok in ("ultima", "última"):
+            return total
+        if tok == "primeira":
+            return 1
+        return int(tok)
+
+    paginas = set()
+    try:
+        for parte in spec.replace(";", ",").split(","):
+            parte = parte.strip()
+            if not parte:
+                continue
+            if parte == "todas":
+                paginas.update(range(1, total + 1))
+            elif "-" in parte:
+                ini, fim = parte.split("-", 1)
+                paginas.update(range(_numero(ini), _numero(fim) + 1))
+            else:
+                paginas.add(_numero(parte))
+    except ValueError:
+        raise ValueError(f"Intervalo de páginas inválido: {spec!r}")
+
+    paginas = sorted(p for p in paginas if 1 <= p <= total)
+    if not paginas:
+        raise ValueError(f"Nenhuma página válida em {spec!r} (documento com {total} páginas).")
+    return paginas
+
+
+def layout_carimbo_pdf(linhas, status, orgao, ponto_w, ponto_h):
+    """
+    Geometria do carimbo em pt, relativa ao canto superior esquerdo do retângulo:
+    retângulos do QR e do brasão e as linhas de texto (x, y_base, texto, fonte_pt, largura).
+    """
+    # ===== Escala pelo tamanho do retângulo (base pensado para A4) =====
+    BASE_W = 190.0
+    BASE_H = 180.0
+
+    s_w = ponto_w / BASE_W
+    s_h = ponto_h / BASE_H
+    s = max(0.6, min(4.0, min(s_w, s_h)))  # trava entre 60% e 400%
+
+    # mínimo ~20 mm (≈ 56.7 pt) para boa leitura
+    MIN_QR_PT_PDF = 25
+    qr_w = qr_h = max(MIN_QR_PT_PDF, int(round(35 * s)))
+
+    brasao_w = int(round(25 * s))
+    brasao_h = int(round(35 * s))
+    gap_pt = int(round(6 * s))
+
+    font_size_normal  = max(6, int(round(9 * s)))
+    font_size_status  = max(6, int(round(11 * s)))  # menor que o normal
+    espaco_entre_linhas = max(8, int(round(11 * s)))
+
+    # Centraliza ícones no topo do retângulo
+    total_icons_w = qr_w + gap_pt + brasao_w
+    x_icones = int((ponto_w - total_icons_w) / 2)
+    y_icones = int(round(10 * s))
+
+    # Texto (logo abaixo dos ícones)
+    inicio_y_texto = y_icones + max(qr_h, brasao_h) + int(round(8 * s))
+    textos = []
+
+    def linha_centralizada(sub, fonte_pt):
+        largura_sub = fitz.get_text_length(sub, fontname="helv", fontsize=fonte_pt)
+        textos.append(((ponto_w - largura_sub) / 2, inicio_y_texto, sub, fonte_pt, largura_sub))
+
+    def desenha_linha(texto, fonte_pt):
+        """Uma linha (com wrap) centralizada no retângulo."""
+        nonlocal inicio_y_texto
+        chars_por_linha = max(20, int((ponto_w - 16) / (fonte_pt * 0.6)))
+        for sub in textwrap.wrap(texto, width=chars_por_linha):
+            linha_centralizada(sub, fonte_pt)
+            inicio_y_texto += espaco_entre_linhas
+
+    def desenha_status_depois_do_orgao():
+        """O STATUS (se existir) com fonte própria e wrap, com respiros."""
+        nonlocal inicio_y_texto
+        if not status:
+            return
+        for sub in textwrap.wrap(status, width=STATUS_WRAP_CHARS):
+            linha_centralizada(sub, font_size_status)
+            # espaçamento entre linhas do STATUS
+            inicio_y_texto += font_size_status + int(round(2 * s))
+        # espaço extra após o bloco de STATUS
+        inicio_y_texto += int(round(6 * s))
+
+    # Loop principal: quando chegar na linha do órgão, injeta o STATUS logo depois
+    for linha in linhas:
+        if not linha.strip():
+            # se sobrar algo vazio (ex.: matrícula vazia que escapou), só dá um respiro leve
+            inicio_y_texto += int(round(5 * s))
+            continue
+
+        # linha atual com fonte "normal"
+        desenha_linha(linha, font_size_normal)
+
+        # se esta linha é o órgão, o STATUS vem logo em seguida
+        if linha.strip() == f"{orgao}".strip():
+            desenha_status_depois_do_orgao()
+
+    return {
+        "qr": fitz.Rect(x_icones, y_icones, x_icones + qr_w, y_icones + qr_h),
+        "brasao": fitz.Rect(x_icones + qr_w + gap_pt, y_icones,
+                            x_icones + qr_w + gap_pt + brasao_w, y_icones + brasao_h),
+        "textos": textos,
+        "y_fim": inicio_y_texto,
+        "largura": ponto_w,
+    }
+
+
+def montar_carimbo_pdf(linhas, status: str, orgao: str,
+                       ponto_w: int, ponto_h: int, qr_png: bytes):
+    """
+    Carimbo completo (QR, brasão, linhas e STATUS) num PDF avulso de uma página,
+    pronto para ser colado com um único show_pdf_page. Devolve (doc, caixa): `caixa`
+    é a área que a página ocupa no sistema do retângulo (pode passar um pouco dele
+    quando o texto transborda). Sem cache: QR, CRC e data/hora mudam a cada documento;
+    o que se repete (brasão comprimido, fontes) já vem pronto de brasao_pdf().
+    """
+    layout = layout_carimbo_pdf(linhas, status, orgao, ponto_w, ponto_h)
+    textos = layout["textos"]
+    x0 = min([0] + [t[0] for t in textos])
+    x1 = max([ponto_w] + [t[0] + t[4] for t in textos])
+    caixa = fitz.Rect(x0, 0, x1, max(layout["y_fim"], ponto_h))
+
+    doc = fitz.open()
+    page = doc.new_page(width=caixa.width, height=caixa.height)
+    desloca = fitz.Matrix(1, 1).pretranslate(-x0, 0)
+
+    # Ícones (topo, centralizados)
+    page.insert_image(layout["qr"] * desloca, stream=qr_png)
+    page.show_pdf_page(layout["brasao"] * desloca, brasao_pdf(), 0)
+
+    # Texto (logo abaixo dos ícones)
+    for x, y, sub, fonte_pt, _ in textos:
+        page.insert_text((x - x0, y), sub, fontsize=fonte_pt, fontname="helv", color=(0, 0, 0))
+
+    return doc, tuple(caixa)
+
+
+def aplicar_carimbo_pdf(doc, linhas, status, orgao, qr_png,
+                        page_num, x, y, w, h, canvas_w, canvas_h, paginas=""):
+    """
+    Carimba o documento aberto `doc`. O retângulo foi posicionado na página
+    `page_num`; `paginas` (opcional, ver resolver_paginas) replica o carimbo em
+    outras páginas na mesma posição relativa. O carimbo é montado uma vez
+    (montar_carimbo_pdf) e colado com show_pdf_page em cada página, todas
+    apontando para o mesmo Form XObject. Devolve a página de referência usada.
+    """
+    # Garantir página válida
+    total = doc.page_count
+    if page_num < 1:
+        page_num = 1
+    if page_num > total:
+        page_num = total
+
+    page = doc.load_page(page_num - 1)
+
+    pdf_w = page.rect.width
+    pdf_h = page.rect.height
+
+    # Salvaguarda: se canvas_w/h vierem 0 (por alguma razão), evita divisão por zero
+    if canvas_w <= 0: canvas_w = pdf_w
+    if canvas_h <= 0: canvas_h = pdf_h
+
+    # Escalas: do canvas (frontend) para a página real do PDF
+    escala_x = pdf_w / canvas_w
+    escala_y = pdf_h / canvas_h
+
+    ponto_x = int(x * escala_x)
+    ponto_y = int(y * escala_y)
+    ponto_w = max(1, int(w * escala_x))
+    ponto_h = max(1, int(h * escala_y))
+
+    with etapa("layout"):
+        carimbo, caixa = montar_carimbo_pdf(linhas, status, orgao, ponto_w, ponto_h, qr_png)
+    cx0, cy0, cx1, cy1 = caixa
+
+    with etapa("inserir"):
+        for numero in resolver_paginas(paginas, total, page_num):
+            page = doc.load_page(numero - 1)
+            # mesma posição relativa; se a página tiver outro tamanho, escala uniforme
+            k = min(page.rect.width / pdf_w, page.rect.height / pdf_h)
+            ox = ponto_x * page.rect.width / pdf_w
+            oy = ponto_y * page.rect.height / pdf_h
+            page.show_pdf_page(fitz.Rect(ox + cx0 * k, oy + cy0 * k, ox + cx1 * k, oy + cy1 * k),
+                               carimbo, 0)
+
+    carimbo.close()
+    return page_num
+
+
+def carimbar_pdf(origem, destino, linhas, status, orgao, qr_png,
+                 page_num, x, y, w, h, canvas_w, canvas_h,
+                 modo_gravacao=PDF_SAVE_INCREMENTAL, paginas=""):
+    """Carimba o PDF (ver aplicar_carimbo_pdf) e salva em `destino`. Devolve a página de referência."""
+    with etapa("abrir"):
+        doc, incremental = abrir_pdf_para_carimbo(origem, destino, modo_gravacao)
+    page_num = aplicar_carimbo_pdf(doc, linhas, status, orgao, qr_png,
+                                   page_num, x, y, w, h, canvas_w, canvas_h, paginas)
+
+    # Salva
+    with etapa("gravar"):
+        salvar_pdf_carimbado(doc, destino, incremental)
+    return page_num
+
+
+def _layout_carimbo_imagem(linhas, status, qr_rgba, brasao, fonte, fonte_b,
+                           x_real, y_real, w_real):
+    """
+    Elementos do carimbo de imagem em coordenadas da imagem:
+    [("img", imagem, (x, y)) | ("txt", texto, fonte, (x, y))] e a caixa que ocupam.
+    """
+    itens = []
+    caixa = [x_real, y_real, x_real + w_real, y_real + 1]
+
+    def ocupa(x0, y0, x1, y1):
+        caixa[0] = min(caixa[0], x0); caixa[1] = min(caixa[1], y0)
+        caixa[2] = max(caixa[2], x1); caixa[3] = max(caixa[3], y1)
+
+    # Ícones pequenos lado a lado
+    gap_px = 6
+    total_icons_w = qr_rgba.width + gap_px + brasao.width
+    x_icones = x_real + int((w_real - total_icons_w) / 2)
+    y_icones = y_real + 10
+    for img, xi in ((qr_rgba, x_icones), (brasao, x_icones + qr_rgba.width + gap_px)):
+        itens.append(("img", img, (xi, y_icones)))
+        ocupa(xi, y_icones, xi + img.width, y_icones + img.height)
+
+    # Texto
+    def texto(sub, f, x_t, y_t, bbox):
+        itens.append(("txt", sub, f, (x_t, y_t)))
+        ocupa(x_t + bbox[0], y_t + bbox[1], x_t + bbox[2], y_t + bbox[3])
+
+    y_texto = y_icones + max(qr_rgba.height, brasao.height) + 8
+    for linha in linhas:
+        if not linha.strip():
+            y_texto += fonte.size + 6
+            continue
+        if status and linha.strip() == status.strip():
+            bbox = fonte_b.getbbox(linha)
+            largura_status = bbox[2] - bbox[0]
+            texto(linha, fonte_b, x_real + (w_real - largura_status) // 2, y_texto, bbox)
+            y_texto += (bbox[3] - bbox[1]) + 8
+            continue
+        for sub in textwrap.wrap(linha, width=40):
+            bbox = fonte.getbbox(sub)
+            largura_sub = bbox[2] - bbox[0]
+            texto(sub, fonte, x_real + (w_real - largura_sub) // 2, y_texto, bbox)
+            y_texto += (bbox[3] - bbox[1]) + 2
+
+    return itens, tuple(int(v) for v in caixa)
+
+
+EXIF_ORIENTACAO = 0x0112
+# Orientação EXIF -> rotação equivalente no insert_image do fitz (as espelhadas, 2/4/5/7, não têm)
+ROTACAO_FITZ = {1: 0, 3: 180, 6: 270, 8: 90}
+
+
+def _opcoes_gravacao_imagem(original, imagem) -> dict:
+    """
+    Mantém o que dá do arquivo original: tabelas de quantização/subamostragem do
+    JPEG (quality="keep", sem perda de geração), EXIF, perfil ICC e DPI. Se `imagem`
+    não é mais o original (girada pela orientação EXIF ou convertida para RGB), o EXIF
+    vai sem a tag de orientação e o perfil ICC só vai se o modo de cor não mudou.
+    """
+    info = original.info
+    opcoes = {"dpi": info["dpi"]} if info.get("dpi") else {}
+    if info.get("icc_profile") and imagem.mode == original.mode:
+        opcoes["icc_profile"] = info["icc_profile"]
+    if imagem is original:
+        if info.get("exif"):
+            opcoes["exif"] = info["exif"]
+    elif info.get("exif"):
+        exif = original.getexif()
+        exif.pop(EXIF_ORIENTACAO, None)      # os pixels gravados já estão na orientação de exibição
+        opcoes["exif"] = exif.tobytes()
+    if original.format == "JPEG":
+        if imagem is original:
+            opcoes.update(quality="keep", subsampling="keep")
+        else:
+            opcoes.update(quality=95)
+        if info.get("progressive") or info.get("progression"):
+            opcoes["progressive"] = True
+    return opcoes
+
+
+def carimbar_imagem(origem, destino, linhas, status, qr_png,
+                    x, y, w, h, canvas_w, canvas_h):
+    """
+    Carimba uma imagem JPG/PNG e salva em `destino`. Só a região do carimbo é
+    copiada e desenhada (crop, carimbo, paste); o restante da imagem não passa por
+    cópia/conversão, e o JPEG é regravado com as tabelas de quantização originais.
+    """
+    with etapa("abrir"):
+        original = Image.open(origem)
+        # O navegador mostra (e o usuário posiciona o carimbo) já com a orientação EXIF
+        # aplicada: os pixels são girados antes de carimbar
+        imagem = original
+        if original.getexif().get(EXIF_ORIENTACAO, 1) != 1:
+            imagem = ImageOps.exif_transpose(original)
+        # RGB/RGBA recebem o carimbo direto; demais modos (P, L, CMYK...) como antes, em RGB
+        if imagem.mode not in ("RGB", "RGBA"):
+            imagem = imagem.convert("RGB")
+    largura_real, altura_real = imagem.size
+
+    # Salvaguarda: se canvas_w/h vierem 0
+    if canvas_w <= 0: canvas_w = largura_real
+    if canvas_h <= 0: canvas_h = altura_real
+
+    fonte, fonte_b = fontes_carimbo()
+
+    # Escalas: do canvas (frontend) para a imagem real
+    escala_x = largura_real / canvas_w
+    escala_y = altura_real / canvas_h
+
+    x_real = int(x * escala_x)
+    y_real = int(y * escala_y)
+    w_real = max(1, int(w * escala_x))
+
+    with etapa("layout"):
+        qr_rgba = Image.open(io.BytesIO(qr_png)).convert("RGBA")  # 50x50
+        itens, caixa = _layout_carimbo_imagem(linhas, status, qr_rgba, brasao_rgba(),
+                                              fonte, fonte_b, x_real, y_real, w_real)
+
+    # Região afetada (recortada aos limites da imagem)
+    rx0, ry0 = max(0, caixa[0]), max(0, caixa[1])
+    rx1, ry1 = min(largura_real, caixa[2]), min(altura_real, caixa[3])
+    if rx1 > rx0 and ry1 > ry0:
+        with etapa("inserir"):
+            regiao = imagem.crop((rx0, ry0, rx1, ry1))
+            draw = ImageDraw.Draw(regiao)
+            for item in itens:
+                if item[0] == "img":
+                    _, img, (xi, yi) = item
+                    regiao.paste(img, (xi - rx0, yi - ry0), img)
+                else:
+                    _, sub, f, (xt, yt) = item
+                    draw.text((xt - rx0, yt - ry0), sub, font=f, fill=(0, 0, 0))
+            imagem.paste(regiao, (rx0, ry0))
+
+    with etapa("gravar"):
+        imagem.save(destino, format=original.format or None, **_opcoes_gravacao_imagem(original, imagem))
+
+
+def carimbar_imagem_pdf(origem, destino, linhas, status, orgao, qr_png,
+                        x, y, w, h, canvas_w, canvas_h):
+    """
+    Alternativa ao raster: PDF de uma página com a imagem original embutida sem
+    recompressão (o JPEG vai como está) e o carimbo vetorial por cima. A imagem não
+    é decodificada para gravar, então a memória não cresce com a resolução.
+    """
+    with etapa("abrir"):
+        with Image.open(origem) as img:  # só o cabeçalho
+            largura_px, altura_px = img.size
+            dpi = (img.info.get("dpi") or (96, 96))[0] or 96
+            orientacao = img.getexif().get(EXIF_ORIENTACAO, 1)
+            # o fitz ignora a orientação EXIF; as espelhadas (raras) vão já transpostas
+            espelhada = None
+            if orientacao not in ROTACAO_FITZ:
+                espelhada = io.BytesIO()
+                ImageOps.exif_transpose(img).save(espelhada, format="PNG")
+        if orientacao in (5, 6, 7, 8):
+            largura_px, altura_px = altura_px, largura_px
+        escala = 72.0 / dpi
+
+        doc = fitz.open()
+        page = doc.new_page(width=largura_px * escala, height=altura_px * escala)
+        if espelhada is None:
+            page.insert_image(page.rect, filename=origem, rotate=ROTACAO_FITZ[orientacao])
+        else:
+            page.insert_image(page.rect, stream=espelhada.getvalue())
+    aplicar_carimbo_pdf(doc, linhas, status, orgao, qr_png, 1, x, y, w, h, canvas_w, canvas_h)
+    with etapa("gravar"):
+        doc.save(destino, garbage=1, deflate=True)
+        doc.close()
+
+
+def preparar_recursos(qr_url: str) -> dict:
+    """
+    QR já codificado, para reaproveitar entre vários documentos (ex.: assinatura
+    em lote). O QR só depende da URL de verificação; o brasão e as fontes ficam
+    nos caches do próprio processo (ver precarregar()).
+    """
+    return {"qr_png": qr_png_bytes(qr_url)}
+
+
+def carimbar(params: dict, recursos: dict = None) -> dict:
+    """
+    Ponto de entrada único do carimbo (requisição, fila ou lote).
+    `params` só contém tipos serializáveis (ver assinar() em app.py);
+    `recursos` (opcional) vem de preparar_recursos().
+    Devolve {"sha256", "size", "page", "otimizacao", "etapas"} do arquivo gerado;
+    `etapas` traz os segundos de cada etapa (qr, fitz_espera, abrir, layout, inserir,
+    gravar, otimizar, sha256), medidos aqui para valer também dentro dos processos do pool.
+    """
+    extensao = params["extensao"]
+    if extensao not in PDF_EXTS + IMAGEM_EXTS:
+        raise ValueError("Formato não suportado. Envie PDF/JPG/PNG.")
+
+    cronometro = metricas.Cronometro()
+    anterior = metricas.ativar(cronometro)
+    try:
+        # QR pequeno (50x50) em memória; brasão (35x50) vem do cache do processo
+        if recursos is None:
+            with etapa("qr"):
+                recursos = preparar_recursos(params["qr_url"])
+        qr_png = recursos["qr_png"]
+
+        pos = {k: params[k] for k in ("x", "y", "w", "h", "canvas_w", "canvas_h")}
+        if extensao in PDF_EXTS:
+            with trava_fitz():
+                page = carimbar_pdf(params["origem"], params["destino"], params["linhas"],
+                                    params["status"], params["orgao"], qr_png,
+                                    params["page"], **pos,
+                                    modo_gravacao=params.get("pdf_save_mode", PDF_SAVE_INCREMENTAL),
+                                    paginas=params.get("paginas", ""))
+        elif params.get("imagem_em_pdf"):
+            page = 1
+            with trava_fitz():
+                carimbar_imagem_pdf(params["origem"], params["destino"], params["linhas"],
+                                    params["status"], params["orgao"], qr_png, **pos)
+        else:
+            # saída raster: só PIL, sem disputar a trava do fitz
+            page = None
+            carimbar_imagem(params["origem"], params["destino"], params["linhas"],
+                            params["status"], qr_png, **pos)
+
+        # etapa opcional de otimização (só para saída em PDF)
+        otimizacao = None
+        politica = params.get("pdf_otimizar")
+        if politica and politica.get("modo") and page is not None:
+            with etapa("otimizar"), trava_fitz():
+                otimizacao = otimizar_pdf(params["destino"], **politica)
+
+        destino = params["destino"]
+        with etapa("sha256"):
+            sha = sha256_of_file(destino)
+    finally:
+        metricas.ativar(anterior)
+    return {"sha256": sha, "size": os.path.getsize(destino), "page": page,
+            "otimizacao": otimizacao, "etapas": cronometro.etapas}
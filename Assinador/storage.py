@@ -0,0 +1,331 @@
+# storage.py — Armazenamento endereçado por conteúdo (SHA-256), sem dependência de Flask
+# Cada arquivo fica na chave ab/cd/<sha256>: conteúdo repetido ocupa espaço uma vez só
+# e nenhuma pasta cresce sem limite (65.536 subpastas de 2 níveis).
+# Dois backends: disco local (ArmazemLocal) e S3/MinIO (ArmazemS3), para vários nós
+# atrás de um balanceador sem disco compartilhado.
+import os, hashlib, uuid, time
+
+CHUNK = 256 * 1024
+
+
+def chave(sha256_hex: str) -> str:
+    """Chave relativa do conteúdo: ab/cd/<sha256>."""
+    if len(sha256_hex or "") != 64 or any(c not in "0123456789abcdef" for c in sha256_hex):
+        raise ValueError(f"SHA-256 inválido: {sha256_hex!r}")
+    return f"{sha256_hex[:2]}/{sha256_hex[2:4]}/{sha256_hex}"
+
+
+def _sha_valido(sha256_hex: str) -> bool:
+    try:
+        chave(sha256_hex)
+        return True
+    except ValueError:
+        return False
+
+
+def _remover(caminho: str) -> bool:
+    try:
+        os.remove(caminho)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def podar_cache(pasta: str, idade_s: float, limite_bytes: int = 0, ignorar=("tmp",)) -> int:
+    """
+    Remove do cache em `pasta` os arquivos sem uso há mais de `idade_s` (mtime, renovado a
+    cada acesso) e, com `limite_bytes`, os usados há mais tempo até o total caber nele.
+    As subpastas de `ignorar` (temporários) ficam de fora. Devolve quantos saíram.
+    """
+    limite = time.time() - idade_s
+    arquivos, total, removidos = [], 0, 0
+    for raiz, subpastas, nomes in os.walk(pasta):
+        if raiz == pasta:
+            subpastas[:] = [d for d in subpastas if d not in ignorar]
+        for nome in nomes:
+            caminho = os.path.join(raiz, nome)
+            try:
+                st = os.stat(caminho)
+            except OSError:
+                continue
+            if st.st_mtime < limite:
+                if _remover(caminho):
+                    removidos += 1
+                continue
+            arquivos.append((st.st_mtime, st.st_size, caminho))
+            total += st.st_size
+    if limite_bytes:
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= limite_bytes:
+                break
+            if _remover(caminho):
+                removidos += 1
+            total -= tamanho
+    return removidos
+
+
+class ArmazemConteudo:
+    """
+    Base comum: a escrita passa sempre por um temporário local (o hash sai no mesmo
+    passe) e depois é incorporada ao backend com _publicar(). `tmp_dir` também recebe
+    as saídas do carimbo antes de irem para o armazém.
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.tmp_dir = tmp_dir
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    # ----- operações de cada backend -----
+    def existe(self, sha256_hex: str) -> bool:
+        raise NotImplementedError
+
+    def tamanho(self, sha256_hex: str) -> int:
+        raise NotImplementedError
+
+    def caminho_local(self, sha256_hex: str) -> str:
+        """Arquivo local com o conteúdo (PyMuPDF/PIL precisam de um caminho)."""
+        raise NotImplementedError
+
+    def arquivo_local(self, sha256_hex: str):
+        """Caminho local se o conteúdo já estiver em disco neste nó (sem buscar), senão None."""
+        return None
+
+    def abrir(self, sha256_hex: str):
+        """Stream binário de leitura (file-like, lido em blocos)."""
+        raise NotImplementedError
+
+    def ler_intervalo(self, sha256_hex: str, inicio: int, fim: int) -> bytes:
+        """Bytes [inicio, fim] (inclusivo, como no cabeçalho Range)."""
+        raise NotImplementedError
+
+    def url_download(self, sha256_hex: str, nome: str, anexo: bool = False, expira_s: int = 300):
+        """URL assinada para o cliente baixar direto do backend, ou None (servir pela app)."""
+        return None
+
+    def remover(self, sha256_hex: str) -> bool:
+        raise NotImplementedError
+
+    def _publicar(self, origem: str, sha256_hex: str) -> bool:
+        """Move o temporário `origem` para o armazém; devolve False se o conteúdo já existia."""
+        raise NotImplementedError
+
+    # ----- comuns -----
+    def temporario(self, sufixo: str = "") -> str:
+        """Caminho livre na pasta temporária (mesmo disco do armazém local: incorporar é um rename)."""
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}{sufixo}")
+
+    def guardar(self, stream):
+        """
+        Grava um stream binário calculando o SHA-256 no mesmo passe.
+        Devolve (sha256_hex, tamanho, novo); se o conteúdo já existia, `novo` é False
+        e a cópia recebida não é gravada de novo.
+        """
+        tmp = self.temporario()
+        h = hashlib.sha256()
+        tamanho = 0
+        try:
+            with open(tmp, "wb") as out:
+                for bloco in iter(lambda: stream.read(CHUNK), b""):
+                    h.update(bloco)
+                    out.write(bloco)
+                    tamanho += len(bloco)
+        except BaseException:
+            _remover(tmp)
+            raise
+        sha = h.hexdigest()
+        return sha, tamanho, self._publicar(tmp, sha)
+
+    def incorporar(self, caminho: str, sha256_hex: str = None):
+        """
+        Move para o armazém um arquivo já gravado (ex.: saída do carimbo). Com o
+        SHA-256 já conhecido não há releitura. Devolve (sha256_hex, tamanho, novo).
+        """
+        if sha256_hex is None:
+            h = hashlib.sha256()
+            with open(caminho, "rb") as f:
+                for bloco in iter(lambda: f.read(CHUNK), b""):
+                    h.update(bloco)
+            sha256_hex = h.hexdigest()
+        tamanho = os.path.getsize(caminho)
+        return sha256_hex, tamanho, self._publicar(caminho, sha256_hex)
+
+    def limpar_cache(self, idade_s: float, limite_bytes: int = 0) -> int:
+        """Poda o cache local de um backend remoto (ver podar_cache). No disco local não há cache."""
+        return 0
+
+    def limpar_temporarios(self, idade_s: float) -> int:
+        """Apaga sobras da pasta temporária (carimbos interrompidos) mais velhas que `idade_s`."""
+        limite = time.time() - idade_s
+        removidos = 0
+        with os.scandir(self.tmp_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.stat().st_mtime < limite and _remover(entry.path):
+                    removidos += 1
+        return removidos
+
+
+class ArmazemLocal(ArmazemConteudo):
+    """Disco local (ou volume montado): <raiz>/ab/cd/<sha256>."""
+
+    def __init__(self, raiz: str):
+        self.raiz = raiz
+        super().__init__(os.path.join(raiz, "tmp"))
+
+    def caminho(self, sha256_hex: str) -> str:
+        return os.path.join(self.raiz, *chave(sha256_hex).split("/"))
+
+    def existe(self, sha256_hex: str) -> bool:
+        return _sha_valido(sha256_hex) and os.path.isfile(self.caminho(sha256_hex))
+
+    def tamanho(self, sha256_hex: str) -> int:
+        return os.path.getsize(self.caminho(sha256_hex))
+
+    def caminho_local(self, sha256_hex: str) -> str:
+        return self.caminho(sha256_hex)
+
+    def arquivo_local(self, sha256_hex: str):
+        caminho = self.caminho(sha256_hex)
+        return caminho if os.path.isfile(caminho) else None
+
+    def abrir(self, sha256_hex: str):
+        return open(self.caminho(sha256_hex), "rb")
+
+    def ler_intervalo(self, sha256_hex: str, inicio: int, fim: int) -> bytes:
+        with open(self.caminho(sha256_hex), "rb") as f:
+            f.seek(inicio)
+            return f.read(fim - inicio + 1)
+
+    def remover(self, sha256_hex: str) -> bool:
+        return _remover(self.caminho(sha256_hex))
+
+    def _publicar(self, origem: str, sha256_hex: str) -> bool:
+        destino = self.caminho(sha256_hex)
+        if os.path.isfile(destino):
+            _remover(origem)
+            return False
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(origem, destino)
+        return True
+
+
+class ArmazemS3(ArmazemConteudo):
+    """
+    Bucket S3-compatível (AWS, MinIO...). Uploads em multipart com streaming
+    (upload_file), leituras em blocos/intervalos e downloads por URL pré-assinada.
+    Quem precisa de caminho local (carimbo, pré-visualização) usa um cache em disco
+    por nó, preenchido sob demanda.
+    """
+
+    def __init__(self, bucket: str, cache_dir: str, prefixo: str = "", endpoint_url: str = None,
+                 access_key: str = None, secret_key: str = None, regiao: str = None):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError as e:  # dependência só do backend S3
+            raise RuntimeError("STORAGE_BACKEND=s3 requer o pacote boto3.") from e
+        self.bucket = bucket
+        self.prefixo = prefixo.strip("/")
+        self.cache_dir = cache_dir
+        self.s3 = boto3.client(
+            "s3", endpoint_url=endpoint_url or None, region_name=regiao or None,
+            aws_access_key_id=access_key or None, aws_secret_access_key=secret_key or None,
+            # MinIO exige path-style e assinatura v4
+            config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+        )
+        super().__init__(os.path.join(cache_dir, "tmp"))
+
+    def _chave(self, sha256_hex: str) -> str:
+        return f"{self.prefixo}/{chave(sha256_hex)}" if self.prefixo else chave(sha256_hex)
+
+    def _cabecalho(self, sha256_hex: str):
+        from botocore.exceptions import ClientError
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=self._chave(sha256_hex))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def existe(self, sha256_hex: str) -> bool:
+        return _sha_valido(sha256_hex) and self._cabecalho(sha256_hex) is not None
+
+    def tamanho(self, sha256_hex: str) -> int:
+        cab = self._cabecalho(sha256_hex)
+        if cab is None:
+            raise FileNotFoundError(sha256_hex)
+        return cab["ContentLength"]
+
+    def _local(self, sha256_hex: str) -> str:
+        return os.path.join(self.cache_dir, *chave(sha256_hex).split("/"))
+
+    def caminho_local(self, sha256_hex: str) -> str:
+        local = self._local(sha256_hex)
+        try:
+            os.utime(local)                   # uso recente: fica no cache (ver limpar_cache)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            tmp = self.temporario()
+            try:
+                self.s3.download_file(self.bucket, self._chave(sha256_hex), tmp)
+                os.replace(tmp, local)
+            finally:
+                _remover(tmp)
+        return local
+
+    def arquivo_local(self, sha256_hex: str):
+        local = self._local(sha256_hex)
+        return local if os.path.isfile(local) else None
+
+    def limpar_cache(self, idade_s: float, limite_bytes: int = 0) -> int:
+        return podar_cache(self.cache_dir, idade_s, limite_bytes)
+
+    def abrir(self, sha256_hex: str):
+        return self.s3.get_object(Bucket=self.bucket, Key=self._chave(sha256_hex))["Body"]
+
+    def ler_intervalo(self, sha256_hex: str, inicio: int, fim: int) -> bytes:
+        resp = self.s3.get_object(Bucket=self.bucket, Key=self._chave(sha256_hex),
+                                  Range=f"bytes={inicio}-{fim}")
+        return resp["Body"].read()
+
+    def url_download(self, sha256_hex: str, nome: str, anexo: bool = False, expira_s: int = 300):
+        disposicao = "attachment" if anexo else "inline"
+        return self.s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._chave(sha256_hex),
+                    "ResponseContentDisposition": f'{disposicao}; filename="{nome}"'},
+            ExpiresIn=expira_s,
+        )
+
+    def remover(self, sha256_hex: str) -> bool:
+        self.s3.delete_object(Bucket=self.bucket, Key=self._chave(sha256_hex))
+        _remover(self._local(sha256_hex))
+        return True
+
+    def _publicar(self, origem: str, sha256_hex: str) -> bool:
+        novo = self._cabecalho(sha256_hex) is None
+        if novo:
+            self.s3.upload_file(origem, self.bucket, self._chave(sha256_hex))
+        # a cópia recém-gravada já serve de cache local deste nó (também quando o conteúdo
+        # já estava no bucket: quem enviou vai abri-lo em seguida, sem baixar de volta)
+        local = self._local(sha256_hex)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        os.replace(origem, local)             # mesmo conteúdo: trocar a cópia é inofensivo
+        return novo
+
+
+def criar_armazem(config) -> ArmazemConteudo:
+    """Backend conforme STORAGE_BACKEND ("local" | "s3") e demais chaves de `config` (dict)."""
+    backend = (config.get("STORAGE_BACKEND") or "local").lower()
+    if backend == "local":
+        return ArmazemLocal(config["STORAGE_DIR"])
+    if backend == "s3":
+        return ArmazemS3(
+            bucket=config["S3_BUCKET"],
+            cache_dir=config["STORAGE_DIR"],
+            prefixo=config.get("S3_PREFIX") or "",
+            endpoint_url=config.get("S3_ENDPOINT_URL"),
+            access_key=config.get("S3_ACCESS_KEY"),
+            secret_key=config.get("S3_SECRET_KEY"),
+            regiao=config.get("S3_REGION"),
+        )
+    raise ValueError(f"STORAGE_BACKEND desconhecido: {backend!r}")
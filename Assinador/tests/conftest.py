@@ -0,0 +1,45 @@
+# Testes rodam da pasta Assinador com `python -m pytest -q`. Os módulos sem dependência de
+# Flask são importados direto; os de rota usam a fixture `app_assinador` (SQLite e armazém
+# temporários, como o benchmark.py).
+import os, sys
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+USUARIO = {"email": "teste@exemplo.gov.br", "nome": "Usuário de Teste", "is_admin": False,
+           "cpf": "123.4******", "orgao": "TESTE", "matricula": "0001"}
+
+
+@pytest.fixture(scope="session")
+def app_assinador(tmp_path_factory):
+    """O app Flask importado uma vez por sessão, com banco, armazém e instance/ temporários."""
+    tmp = str(tmp_path_factory.mktemp("assinador"))
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'teste.db')}"
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["STORAGE_DIR"] = os.path.join(tmp, "storage")
+    os.environ.setdefault("SECRET_KEY", "teste")
+    os.environ["METRICS_DIR"] = ""
+    # CITEXT é do Postgres; no SQLite o equivalente é texto sem diferenciar maiúsculas
+    from sqlalchemy.ext.compiler import compiles
+    from sqlalchemy.dialects.postgresql import CITEXT
+
+    @compiles(CITEXT, "sqlite")
+    def _citext_sqlite(_tipo, _compilador, **_kw):
+        return "VARCHAR(255) COLLATE NOCASE"
+
+    os.chdir(RAIZ)                      # stamping usa caminhos relativos (brasão, fontes)
+    import app as appmod
+    appmod.app.config["TESTING"] = True
+    appmod.app.instance_path = os.path.join(tmp, "instance")
+    return appmod.app
+
+
+@pytest.fixture
+def cliente(app_assinador):
+    """Cliente já logado, com o token CSRF "teste" na sessão."""
+    c = app_assinador.test_client()
+    with c.session_transaction() as s:
+        s["csrf_token"] = "teste"
+        s["user"] = dict(USUARIO)
+    return c
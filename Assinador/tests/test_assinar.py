@@ -0,0 +1,41 @@
+import io
+import fitz
+
+POSICAO = {"x": "10", "y": "10", "w": "200", "h": "180", "canvas_w": "595", "canvas_h": "842",
+           "page": "1", "processo": "", "status": ""}
+
+
+def _pdf(texto: str) -> bytes:
+    doc = fitz.open()
+    doc.new_page(width=595, height=842).insert_text((72, 72), texto)
+    dados = doc.tobytes()
+    doc.close()
+    return dados
+
+
+def test_assinar_pelo_upload_id_da_previa_sem_reenviar_o_arquivo(cliente):
+    r = cliente.post("/preview", content_type="multipart/form-data", data={
+        "csrf_token": "teste", "arquivo": (io.BytesIO(_pdf("prévia")), "oficio.pdf")})
+    assert r.status_code == 200
+    upload_id = r.get_json()["upload_id"]
+
+    r = cliente.post("/assinar", content_type="multipart/form-data", data={
+        "csrf_token": "teste", "upload_id": upload_id, "upload_nome": "oficio.pdf", **POSICAO})
+
+    assert r.status_code == 200
+    assert "Arquivo gerado" in r.get_data(as_text=True)
+    assert f"assinado_oficio_{upload_id[:10]}.pdf" in r.get_data(as_text=True)
+
+
+def test_upload_id_desconhecido_cai_no_campo_do_arquivo(cliente):
+    r = cliente.post("/assinar", content_type="multipart/form-data", data={
+        "csrf_token": "teste", "upload_id": "0" * 64, "upload_nome": "outro.pdf",
+        "arquivo": (io.BytesIO(_pdf("direto")), "direto.pdf"), **POSICAO})
+
+    assert r.status_code == 200
+    assert "assinado_direto_" in r.get_data(as_text=True)
+
+
+def test_pagina_de_assinatura_nao_carrega_pdfjs_de_inicio(cliente):
+    html = cliente.get("/assinar").get_data(as_text=True)
+    assert 'src="https://cdnjs.cloudflare.com/ajax/libs/pdf.js' not in html
@@ -0,0 +1,66 @@
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table, create_engine, func,
+                        select)
+import importacao
+import kdf
+
+KDF_CONFIG = {"KDF_SCHEME": "pbkdf2", "KDF_PBKDF2_ITERATIONS": 1000}
+
+
+def _tabela_usuarios():
+    meta = MetaData()
+    tabela = Table(
+        "users", meta,
+        Column("id", Integer, primary_key=True),
+        Column("email", String(255), unique=True, nullable=False),
+        Column("nome", String(255), nullable=False),
+        Column("cpf_hash", String(255), nullable=False),
+        Column("cpf_masked", String(32), nullable=False),
+        Column("orgao", String(120)),
+        Column("setor", String(120)),
+        Column("matricula", String(50)),
+        Column("cargo", String(120)),
+        Column("updated_at", DateTime, server_default=func.now()),
+    )
+    engine = create_engine("sqlite://")
+    meta.create_all(engine)
+    return engine, tabela
+
+
+def _importar(engine, tabela, csv_texto, **kw):
+    linhas = importacao.ler_planilha(csv_texto.encode(), "usuarios.csv")
+    return importacao.importar(engine, tabela, linhas, KDF_CONFIG, workers=1, **kw)
+
+
+def _usuario(engine, tabela, email):
+    with engine.connect() as con:
+        return con.execute(select(tabela).where(tabela.c.email == email)).mappings().one()
+
+
+COMPLETA = ("nome;email;cpf;orgao;setor;matricula;cargo\n"
+            "Ana;ana@x.gov.br;52998224725;semit;TI;123;Analista\n")
+
+
+def test_planilha_mais_estreita_preserva_colunas_ausentes_e_cpf():
+    engine, tabela = _tabela_usuarios()
+    assert _importar(engine, tabela, COMPLETA)["criados"] == 1
+    antes = _usuario(engine, tabela, "ana@x.gov.br")
+
+    rel = _importar(engine, tabela, "nome;email;cpf\nAna Souza;ana@x.gov.br;11144477735\n")
+    assert rel["atualizados"] == 1 and not rel["erros"]
+    depois = _usuario(engine, tabela, "ana@x.gov.br")
+    assert depois["nome"] == "Ana Souza"
+    for coluna in ("orgao", "setor", "matricula", "cargo", "cpf_hash", "cpf_masked"):
+        assert depois[coluna] == antes[coluna], coluna
+    assert depois["cpf_masked"] == "529.982.247-25"
+
+
+def test_atualizar_cpf_troca_hash_e_mascara_juntos():
+    engine, tabela = _tabela_usuarios()
+    _importar(engine, tabela, COMPLETA)
+
+    _importar(engine, tabela, "nome;email;cpf;setor\nAna;ana@x.gov.br;11144477735;RH\n",
+              atualizar_cpf=True)
+    depois = _usuario(engine, tabela, "ana@x.gov.br")
+    assert depois["cpf_masked"] == "111.444.777-35"
+    assert kdf.criar_servico(KDF_CONFIG).verificar(depois["cpf_hash"], "11144477735")[0]
+    assert depois["setor"] == "RH" and depois["orgao"] == "SEMIT"
@@ -0,0 +1,32 @@
+import io, json, zipfile
+import fitz
+
+
+def _pdf(texto: str) -> bytes:
+    doc = fitz.open()
+    doc.new_page(width=595, height=842).insert_text((72, 72), texto)
+    dados = doc.tobytes()
+    doc.close()
+    return dados
+
+
+def test_pdf_corrompido_no_lote_vira_erro_no_manifesto(cliente):
+    bom = _pdf("documento bom")
+    corrompido = _pdf("documento corrompido")[:200]    # truncado: o fitz não abre
+    r = cliente.post("/assinar/lote", content_type="multipart/form-data", data={
+        "csrf_token": "teste", "x": "10", "y": "10", "w": "200", "h": "180",
+        "canvas_w": "595", "canvas_h": "842", "page": "1",
+        "arquivos": [(io.BytesIO(bom), "bom.pdf"), (io.BytesIO(corrompido), "corrompido.pdf")],
+    })
+
+    assert r.status_code == 200
+    lote = r.get_json()
+    assert (lote["total"], lote["assinados"], lote["falhas"]) == (2, 1, 1)
+    por_arquivo = {m["arquivo"]: m for m in lote["manifesto"]}
+    assert "erro" not in por_arquivo["bom.pdf"] and por_arquivo["bom.pdf"]["sha256"]
+    assert por_arquivo["corrompido.pdf"]["erro"]
+
+    z = cliente.get(lote["zip_url"])
+    with zipfile.ZipFile(io.BytesIO(z.data)) as zf:
+        assert sorted(zf.namelist()) == sorted([por_arquivo["bom.pdf"]["assinado"], "manifesto.json"])
+        assert len(json.loads(zf.read("manifesto.json"))) == 2
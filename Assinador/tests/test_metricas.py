@@ -0,0 +1,66 @@
+import json, os, socket, subprocess, sys, time
+import metricas
+
+
+def _pid_morto() -> int:
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def _retrato_de(pid, requisicoes, em_uso):
+    registro = metricas.Registro()
+    registro.contador("req_total", "Requisições.").inc(requisicoes, rota="/assinar")
+    registro.histograma("dur_segundos", "Duração.").observar(0.2, rota="/assinar")
+    registro.medidor("em_uso_mb", "Em uso.", lambda: em_uso)
+    retrato = registro.retrato()
+    instancia = f"{socket.gethostname()}:{pid}"
+    for m in retrato["metricas"].values():
+        for rotulos, _ in m["series"]:
+            if "instancia" in rotulos:
+                rotulos["instancia"] = instancia
+    return retrato
+
+
+def _gravar(pasta, nome, retrato):
+    with open(os.path.join(pasta, nome), "w") as f:
+        json.dump(retrato, f)
+
+
+def _linhas(texto, prefixo):
+    return sorted(l for l in texto.splitlines() if l.startswith(prefixo))
+
+
+def test_retrato_de_processo_morto_e_recolhido_sem_perder_contadores(tmp_path):
+    pasta, host = str(tmp_path), socket.gethostname()
+    for pid, n in ((_pid_morto(), 3), (_pid_morto(), 4)):
+        _gravar(pasta, f"metricas-{host}-{pid}.json", _retrato_de(pid, n, 128))
+    leitor = metricas.Registro()
+
+    texto = leitor.exportar(pasta)
+
+    assert _linhas(texto, "req_total") == ['req_total{rota="/assinar"} 7']
+    assert 'dur_segundos_count{rota="/assinar"} 2' in texto
+    assert not _linhas(texto, "em_uso_mb{")             # medidores do morto somem
+    assert sorted(os.listdir(pasta)) == [".metricas.lock", f"metricas-{host}-encerrados.json"]
+
+    # mais um worker encerrado: soma ao que já estava recolhido
+    pid = _pid_morto()
+    _gravar(pasta, f"metricas-{host}-{pid}.json", _retrato_de(pid, 5, 64))
+    assert _linhas(leitor.exportar(pasta), "req_total") == ['req_total{rota="/assinar"} 12']
+
+
+def test_processo_vivo_fica_e_outro_host_velho_perde_so_medidores(tmp_path):
+    pasta, host = str(tmp_path), socket.gethostname()
+    vivo = os.getppid()
+    _gravar(pasta, f"metricas-{host}-{vivo}.json", _retrato_de(vivo, 2, 32))
+    remoto = _retrato_de(999, 1, 16)
+    _gravar(pasta, "metricas-outro-no-999.json", remoto)
+    velho = time.time() - 3600
+    os.utime(os.path.join(pasta, "metricas-outro-no-999.json"), (velho, velho))
+
+    texto = metricas.Registro().exportar(pasta, validade_s=60)
+
+    assert _linhas(texto, "req_total") == ['req_total{rota="/assinar"} 3']
+    assert _linhas(texto, "em_uso_mb{") == [f'em_uso_mb{{instancia="{host}:{vivo}"}} 32']
+    assert os.path.exists(os.path.join(pasta, f"metricas-{host}-{vivo}.json"))
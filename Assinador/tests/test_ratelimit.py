@@ -0,0 +1,51 @@
+import ratelimit
+
+
+def _bloquear(limite, chave):
+    for _ in range(limite.max_tentativas):
+        limite.falhou(chave)
+
+
+def test_rajada_de_chaves_novas_nao_derruba_bloqueio():
+    limite = ratelimit.LimiteMemoria(3, bloqueio_s=600, janela_s=60, max_chaves=5)
+    _bloquear(limite, "vitima@x|1.2.3.4")
+    assert limite.bloqueado("vitima@x|1.2.3.4") > 0
+
+    for i in range(50):                       # chaves distintas, bem acima do teto
+        limite.falhou(f"lixo{i}@x|5.6.7.8")
+
+    assert limite.bloqueado("vitima@x|1.2.3.4") > 0
+    assert len(limite._chaves) <= limite.max_chaves
+
+
+def test_teto_descarta_vencidas_e_depois_as_livres_mais_antigas(monkeypatch):
+    agora = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: agora[0])
+    limite = ratelimit.LimiteMemoria(2, bloqueio_s=600, janela_s=60, max_chaves=3)
+
+    _bloquear(limite, "bloqueada")            # mais antiga, mas com bloqueio em vigor
+    limite.falhou("livre-antiga")
+    limite.falhou("livre-nova")
+    agora[0] += 30
+    limite.falhou("recente")                  # passa do teto: sai a livre mais antiga
+    assert set(limite._chaves) == {"bloqueada", "livre-nova", "recente"}
+
+    agora[0] += 45                            # "livre-nova" venceu, "recente" não
+    limite.falhou("outra")
+    limite.falhou("mais-uma")                 # teto: sai a vencida, depois "recente"
+    assert set(limite._chaves) == {"bloqueada", "outra", "mais-uma"}
+    assert limite.bloqueado("bloqueada") > 0
+
+
+def test_so_bloqueios_excedem_o_teto_ate_vencerem(monkeypatch):
+    agora = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: agora[0])
+    limite = ratelimit.LimiteMemoria(1, bloqueio_s=600, janela_s=60, max_chaves=2)
+
+    for i in range(4):
+        limite.falhou(f"k{i}")                # max_tentativas=1: cada falha já bloqueia
+    assert all(limite.bloqueado(f"k{i}") > 0 for i in range(4))
+
+    agora[0] += 601
+    limite.falhou("nova")
+    assert set(limite._chaves) == {"nova"}
@@ -0,0 +1,40 @@
+from PIL import Image, ImageChops, ImageCms, ImageOps
+import stamping
+
+LINHAS = ["Assinado por FULANO DE TAL", "CPF ***.123.456-**", "CRC 0123456789ABCDEF"]
+
+
+def _carimbar(origem, destino, x, y, w, canvas_w, canvas_h):
+    qr_png = stamping.qr_png_bytes("https://exemplo.gov.br/verificar/abc")
+    stamping.carimbar_imagem(str(origem), str(destino), LINHAS, "assinado", qr_png,
+                             x, y, w, 0, canvas_w, canvas_h)
+
+
+def test_orientacao_exif_carimbo_na_posicao_exibida(tmp_path):
+    # 400x200 gravada "deitada" com Orientation=6: o navegador exibe 200x400
+    cru = Image.new("RGB", (400, 200), "white")
+    exif = cru.getexif()
+    exif[stamping.EXIF_ORIENTACAO] = 6
+    origem, destino = tmp_path / "foto.png", tmp_path / "saida.png"
+    cru.save(origem, exif=exif.tobytes())
+
+    _carimbar(origem, destino, 0, 300, 150, 200, 400)   # embaixo, no espaço exibido
+
+    with Image.open(destino) as saida:
+        assert saida.size == (200, 400)
+        assert saida.getexif().get(stamping.EXIF_ORIENTACAO, 1) == 1
+        exibida = ImageOps.exif_transpose(Image.open(origem)).convert(saida.mode)
+        alterado = ImageChops.difference(saida, exibida).getbbox()
+    assert alterado is not None and alterado[1] >= 300
+
+
+def test_cmyk_convertido_nao_leva_perfil_icc(tmp_path):
+    perfil = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    origem, destino = tmp_path / "cmyk.jpg", tmp_path / "saida.jpg"
+    Image.new("CMYK", (300, 300), (0, 0, 0, 0)).save(origem, icc_profile=perfil)
+
+    _carimbar(origem, destino, 0, 0, 200, 300, 300)
+
+    with Image.open(destino) as saida:
+        assert saida.mode == "RGB"
+        assert not saida.info.get("icc_profile")
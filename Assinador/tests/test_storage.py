@@ -0,0 +1,61 @@
+import hashlib, io, os, time
+import pytest
+import storage
+
+
+def _gravar(pasta, nome, tamanho, idade_s):
+    caminho = os.path.join(pasta, nome)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    with open(caminho, "wb") as f:
+        f.write(b"x" * tamanho)
+    quando = time.time() - idade_s
+    os.utime(caminho, (quando, quando))
+    return caminho
+
+
+def test_podar_cache_por_idade_e_por_tamanho(tmp_path):
+    pasta = str(tmp_path)
+    velho = _gravar(pasta, "aa/bb/velho", 100, 10 * 3600)
+    antigo = _gravar(pasta, "aa/cc/antigo", 100, 3600)
+    recente = _gravar(pasta, "ab/cd/recente", 100, 60)
+    temporario = _gravar(pasta, "tmp/carimbo-em-andamento", 100, 10 * 3600)
+
+    assert storage.podar_cache(pasta, 5 * 3600) == 1
+    assert not os.path.exists(velho) and os.path.exists(antigo)
+
+    assert storage.podar_cache(pasta, 5 * 3600, limite_bytes=150) == 1   # sai o usado há mais tempo
+    assert not os.path.exists(antigo) and os.path.exists(recente)
+    assert os.path.exists(temporario)                                  # tmp/ fica com limpar_temporarios
+
+
+class _S3Falso:
+    def __init__(self):
+        self.objetos = {}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objetos:
+            from botocore.exceptions import ClientError
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(self.objetos[Key])}
+
+    def upload_file(self, origem, Bucket, Key):
+        with open(origem, "rb") as f:
+            self.objetos[Key] = f.read()
+
+    def download_file(self, Bucket, Key, destino):
+        raise AssertionError("não devia baixar: a cópia local já existe")
+
+
+def test_s3_upload_repetido_fica_no_cache_local(tmp_path):
+    pytest.importorskip("botocore")
+    armazem = storage.ArmazemS3.__new__(storage.ArmazemS3)
+    armazem.bucket, armazem.prefixo, armazem.cache_dir = "b", "", str(tmp_path)
+    armazem.s3 = _S3Falso()
+    storage.ArmazemConteudo.__init__(armazem, os.path.join(str(tmp_path), "tmp"))
+    dados = b"%PDF-1.7 conteudo"
+    sha = hashlib.sha256(dados).hexdigest()
+    armazem.s3.objetos[storage.chave(sha)] = dados   # outro nó já enviou
+
+    assert armazem.guardar(io.BytesIO(dados)) == (sha, len(dados), False)
+    with open(armazem.caminho_local(sha), "rb") as f:
+        assert f.read() == dados
@@ -0,0 +1,34 @@
+from datetime import datetime
+
+
+def _criar(db, User, n, quando):
+    u = User(email=f"paginacao{n}@exemplo.gov.br", nome=f"Paginação {n}", cpf_hash="x",
+             cpf_masked="123.***.***-**", created_at=quando)
+    db.session.add(u)
+    return u
+
+
+def test_cursor_da_listagem_vale_com_o_ultimo_usuario_excluido(app_assinador):
+    import app as appmod
+    from models import db, User
+
+    with app_assinador.app_context():
+        mesmo_instante = datetime(2026, 1, 2, 10, 0, 0)
+        usuarios = [_criar(db, User, 1, datetime(2026, 1, 1, 9, 0, 0)),
+                    _criar(db, User, 2, mesmo_instante),
+                    _criar(db, User, 3, mesmo_instante),
+                    _criar(db, User, 4, datetime(2026, 1, 3, 8, 0, 0))]
+        db.session.commit()
+        esperado = [u.email for u in reversed(usuarios)]          # created_at, id decrescentes
+
+        pagina, cursor = appmod.buscar_usuarios("paginacao", limite=2)
+        assert [u.email for u in pagina] == esperado[:2] and cursor
+
+        db.session.delete(pagina[-1])                               # some entre uma página e outra
+        db.session.commit()
+
+        pagina, proximo = appmod.buscar_usuarios("paginacao", apos=cursor, limite=2)
+        assert [u.email for u in pagina] == esperado[2:] and proximo is None
+
+        pagina, _ = appmod.buscar_usuarios("paginacao", apos="adulterado", limite=2)
+        assert [u.email for u in pagina] == [esperado[0], esperado[2]]